@@ -0,0 +1,73 @@
+import time
+import random
+import itertools
+from types import SimpleNamespace
+
+# 压测用的假群消息，代替 ncatbot 的 GroupMessage
+# 插件用到的属性（group_id / user_id / raw_message / sender.nickname / message_id / time）都有，
+# reply() 不发到QQ，只记录发送时间和内容，供压测统计回复数和回复延迟
+
+# 没有录制的聊天记录时用来合成消息的句子
+SAMPLE_TEXTS = [
+    "哈哈哈哈",
+    "有没有人知道这个怎么弄",
+    "今晚几点开始活动？",
+    "服务器IP是多少来着",
+    "确实",
+    "晚安",
+    "[CQ:face,id=178]",
+    "请问一下群规在哪里看",
+    "这个报错是什么意思，有人遇到过吗",
+    "草",
+    "/help",
+    "/summary",
+    "机器人你怎么看",
+    "好的好的",
+    "明天上班吗",
+]
+
+_message_ids = itertools.count(1)
+
+
+class FakeGroupMessage:
+    def __init__(self, group_id, user_id, raw_message, nickname=None, message_id=None, ts=None):
+        self.group_id = group_id
+        self.user_id = user_id
+        self.raw_message = raw_message
+        self.sender = SimpleNamespace(user_id=user_id, nickname=nickname or f"群友{user_id}")
+        self.message_id = message_id if message_id is not None else next(_message_ids)
+        self.time = ts or time.time()
+        # 创建（交给机器人）的时间，回复延迟从这里算起
+        self.created = time.monotonic()
+        # [(发送时间, 文本, 是否@, 图片)]
+        self.replies = []
+
+    async def reply(self, text=None, at=False, image=None, **kwargs):
+        self.replies.append((time.monotonic(), text, at, image))
+
+
+def make_message(group_id, user_id, raw_message, nickname=None, message_id=None, ts=None):
+    """创建一条假群消息"""
+    return FakeGroupMessage(group_id, user_id, raw_message, nickname, message_id, ts)
+
+
+def from_record(group_id, record):
+    """把数据库中的一条聊天记录（chat_db.Message）还原成群消息，时间改为现在"""
+    return make_message(group_id, record.qq_number, record.content or "", record.nickname)
+
+
+def synthetic_messages(count, groups, members=20, bot_qq=None, seed=0):
+    """
+    合成 count 条消息，轮流分到 groups 个群，每个群 members 个发言人
+    给出 bot_qq 时约十分之一的消息会@机器人
+    """
+    rng = random.Random(seed)
+    messages = []
+    for i in range(count):
+        group_id = 900000 + i % groups
+        user_id = 1000000 + rng.randrange(members)
+        text = rng.choice(SAMPLE_TEXTS)
+        if bot_qq and rng.random() < 0.1:
+            text = f"[CQ:at,qq={bot_qq}] {text}"
+        messages.append(make_message(group_id, user_id, text))
+    return messages
@@ -0,0 +1,199 @@
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import itertools
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 本地的 OpenAI 兼容接口桩服务，压测时代替真实的大模型接口
+# 只实现 POST /v1/chat/completions（流式和非流式），GET /stats 返回请求统计
+#
+# - 非流式请求（是否回复的判断）按 --reply-rate 的概率回复 y，否则回复一句原因
+# - 流式请求按脚本回复: 脚本是一个 JSON 列表，第 k 步对应对话中已经有 k 轮工具调用的请求，
+#   每一步是 {"text": "回复"} 或 {"tool_calls": [{"name": "search", "arguments": {"query": "..."}}]}，
+#   脚本用完后回复 --reply 的文本
+# - --latency 为收到请求到发出第一段的延迟，--token-delay 为流式响应每一段之间的间隔
+# - --error-rate 的概率返回 429（带 Retry-After），用来观察网关的退避和限流
+#
+# 用法: python bench/mock_openai.py --port 18080 --latency 0.5 --script tools.json
+
+DEFAULT_REPLY = "这是压测桩服务的回复。它会按句子分成好几段发送，用来模拟真实的流式输出。最后再补一句结尾！"
+# 流式响应每一段的字数
+CHUNK_CHARS = 4
+
+stats = {"requests": 0, "streams": 0, "tool_calls": 0, "errors_injected": 0}
+_stats_lock = threading.Lock()
+_ids = itertools.count(1)
+
+
+def count(name, value=1):
+    with _stats_lock:
+        stats[name] += value
+
+
+def tool_rounds(messages):
+    """请求中已经进行了几轮工具调用"""
+    return sum(1 for m in messages if m.get("role") == "assistant" and m.get("tool_calls"))
+
+
+def completion(model, content):
+    prompt_tokens = 100
+    completion_tokens = max(len(content), 1)
+    return {
+        "id": f"chatcmpl-bench-{next(_ids)}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": content},
+            "finish_reason": "stop",
+        }],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        },
+    }
+
+
+def chunk(model, delta, finish_reason=None):
+    return {
+        "id": f"chatcmpl-bench-{next(_ids)}",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+
+
+def stream_events(model, step, reply):
+    """按脚本的一步生成流式响应的各段"""
+    yield chunk(model, {"role": "assistant", "content": ""})
+    if step and step.get("tool_calls"):
+        for index, call in enumerate(step["tool_calls"]):
+            arguments = json.dumps(call.get("arguments", {}), ensure_ascii=False)
+            yield chunk(model, {"tool_calls": [{
+                "index": index,
+                "id": f"call_bench_{next(_ids)}",
+                "type": "function",
+                "function": {"name": call["name"], "arguments": ""},
+            }]})
+            # 参数分两段到达，和真实接口一样需要客户端拼接
+            half = len(arguments) // 2
+            for part in (arguments[:half], arguments[half:]):
+                yield chunk(model, {"tool_calls": [{"index": index, "function": {"arguments": part}}]})
+        yield chunk(model, {}, "tool_calls")
+        return
+    text = step.get("text", reply) if step else reply
+    for start in range(0, len(text), CHUNK_CHARS):
+        yield chunk(model, {"content": text[start:start + CHUNK_CHARS]})
+    yield chunk(model, {}, "stop")
+
+
+class MockOpenAIHandler(BaseHTTPRequestHandler):
+    # 支持长连接，流式响应用 chunked 编码
+    protocol_version = "HTTP/1.1"
+    options = None
+
+    def send_json(self, status, body, headers=()):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def write_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/stats":
+            with _stats_lock:
+                self.send_json(200, dict(stats))
+        else:
+            self.send_json(404, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self.send_json(404, {"error": {"message": "not found"}})
+            return
+        options = self.options
+        count("requests")
+        if random.random() < options.error_rate:
+            count("errors_injected")
+            self.send_json(429, {"error": {"message": "rate limited (bench)", "type": "rate_limit_error"}},
+                           [("Retry-After", str(options.retry_after))])
+            return
+
+        time.sleep(options.latency)
+        model = body.get("model") or "bench"
+        if not body.get("stream"):
+            reply = "y" if random.random() < options.reply_rate else "没有必要回复"
+            self.send_json(200, completion(model, reply))
+            return
+
+        count("streams")
+        rounds = tool_rounds(body.get("messages", []))
+        step = options.script[rounds] if rounds < len(options.script) else None
+        if step and step.get("tool_calls"):
+            count("tool_calls", len(step["tool_calls"]))
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for i, event in enumerate(stream_events(model, step, options.reply)):
+                if i and options.token_delay:
+                    time.sleep(options.token_delay)
+                self.write_chunk(f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode("utf-8"))
+            self.write_chunk(b"data: [DONE]\n\n")
+            self.write_chunk(b"")
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端提前关闭了流（例如机器人决定不再读取）
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+def load_script(path):
+    if not path:
+        return []
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="OpenAI 兼容接口桩服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--latency", type=float, default=0.3, help="发出第一段之前的延迟（秒）")
+    parser.add_argument("--token-delay", type=float, default=0.02, help="流式响应每一段之间的间隔（秒）")
+    parser.add_argument("--reply-rate", type=float, default=0.3, help="是否回复的判断中回复 y 的概率")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="返回 429 的概率")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="429 响应中的 Retry-After（秒）")
+    parser.add_argument("--reply", default=DEFAULT_REPLY, help="脚本用完后的回复文本")
+    parser.add_argument("--script", help="工具调用脚本（JSON 文件）")
+    options = parser.parse_args(argv)
+    options.script = load_script(options.script)
+    return options
+
+
+def serve(options):
+    MockOpenAIHandler.options = options
+    server = ThreadingHTTPServer((options.host, options.port), MockOpenAIHandler)
+    server.daemon_threads = True
+    print(f"OpenAI 桩服务已启动: http://{options.host}:{server.server_address[1]}/v1", flush=True)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    serve(parse_args(sys.argv[1:]))
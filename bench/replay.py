@@ -0,0 +1,326 @@
+import os
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import asyncio
+import argparse
+import tempfile
+import threading
+import subprocess
+import urllib.request
+
+# 回放压测: 把录制的 qq_chat.db 聊天记录（或合成的消息）按设定的速率喂给完整的消息处理流程，
+# 大模型请求发给本地的桩服务（mock_openai.py），最后输出吞吐量、各插件耗时分位数、数据库增长和内存峰值
+#
+# 压测在一个临时工作目录中进行: 插件目录链接到本仓库，数据库是录制数据库的副本，不会改动原来的文件
+# 用法: python bench/replay.py --db qq_chat.db --limit 2000 --rate 20 --groups 10 --json result.json
+# 限流等设置可以用 --env 传入，例如 --env LLM_RPM=600 --env LLM_GROUP_RPM=60
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(BENCH_DIR)
+sys.path.append(BENCH_DIR)
+sys.path.insert(0, PROJECT_ROOT)
+from fake_messages import from_record, synthetic_messages
+
+# 回放时重新分配的群号从这里开始
+GROUP_BASE = 900000
+BOT_QQ = "10000"
+QUANTILES = (0.5, 0.95, 0.99)
+
+# 压测时机器人使用的配置，LLM 地址在启动桩服务后填入
+BENCH_ENV = {
+    "API_KEY": "bench",
+    "LOW_COST_API_KEY": "bench",
+    "MODEL": "bench-model",
+    "LOW_COST_MODEL": "bench-cheap-model",
+    "IMAGE_MODEL": "bench-image-model",
+    "SEARCH_KEY": "",
+    "BOT_QQ": BOT_QQ,
+    "ROOT_QQ": "10001",
+    "SALT": "bench",
+    "METRICS_PORT": "0",
+    "METRICS_DUMP_INTERVAL": "0",
+}
+
+
+def prepare_workdir(workdir, source_db):
+    """准备工作目录: 链接插件目录，写入最简配置，复制录制的数据库（没有时新建）"""
+    from migrate_db import migrate, create_database_with_tables
+    os.makedirs(os.path.join(workdir, "bot_config"), exist_ok=True)
+    with open(os.path.join(workdir, "bot_config", "config.yaml"), "w", encoding="utf-8") as f:
+        f.write("persona: 压测用的机器人\n")
+    plugins = os.path.join(workdir, "qq_bot_plugins")
+    if not os.path.exists(plugins):
+        try:
+            os.symlink(os.path.join(PROJECT_ROOT, "qq_bot_plugins"), plugins, target_is_directory=True)
+        except OSError:
+            # 不支持符号链接（Windows 普通用户）时复制一份
+            shutil.copytree(os.path.join(PROJECT_ROOT, "qq_bot_plugins"), plugins,
+                            ignore=shutil.ignore_patterns("__pycache__"))
+
+    db_file = os.path.join(workdir, "qq_chat.db")
+    if source_db:
+        # 用 backup 复制，录制的数据库正在被机器人使用时也能得到一致的副本
+        source = sqlite3.connect(f"file:{os.path.abspath(source_db)}?mode=ro", uri=True)
+        target = sqlite3.connect(db_file)
+        source.backup(target)
+        source.close()
+        target.close()
+        migrate(db_file)
+    else:
+        create_database_with_tables(db_file)
+    return db_file
+
+
+def load_records(db_file, limit):
+    """读取最近 limit 条群友的消息（不含机器人的回复），按时间顺序返回 [(群号, chat_db.Message)]"""
+    sys.path.append(os.path.join(PROJECT_ROOT, "qq_bot_plugins"))
+    from chat_db import Message
+    conn = sqlite3.connect(db_file)
+    rows = conn.execute(
+        'SELECT group_id, message_id, qq_number, nickname, ts, is_bot, content FROM ('
+        ' SELECT * FROM messages WHERE is_bot = 0 ORDER BY ts DESC, id DESC LIMIT ?'
+        ') ORDER BY ts, id', (limit,)).fetchall()
+    conn.close()
+    return [(row[0], Message(*row[1:])) for row in rows]
+
+
+def build_messages(records, groups):
+    """把聊天记录还原成群消息，groups 大于0时按顺序轮流分到 groups 个群，否则保留原来的群"""
+    messages = []
+    for i, (group_id, record) in enumerate(records):
+        if groups:
+            group_id = GROUP_BASE + i % groups
+        messages.append(from_record(group_id, record))
+    return messages
+
+
+def schedule(records, count, rate, speed):
+    """
+    每条消息相对开始时间的发送时刻（秒）
+    rate 大于0时匀速每秒 rate 条；否则 speed 大于0时按录制时的间隔加速 speed 倍回放；都没有时一次全部发出
+    """
+    if rate > 0:
+        return [i / rate for i in range(count)]
+    if speed > 0 and records:
+        start = records[0][1].ts
+        return [(record.ts - start) / speed for group_id, record in records]
+    return [0.0] * count
+
+
+def start_mock_server(args):
+    """在子进程中启动桩服务（不和机器人抢 GIL，也不计入机器人的内存），返回 (进程, 接口地址)"""
+    command = [sys.executable, os.path.join(BENCH_DIR, "mock_openai.py"), "--port", "0",
+               "--latency", str(args.latency), "--token-delay", str(args.token_delay),
+               "--reply-rate", str(args.reply_rate), "--error-rate", str(args.error_rate)]
+    if args.script:
+        command += ["--script", os.path.abspath(args.script)]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True, encoding="utf-8")
+    line = process.stdout.readline()
+    if "http://" not in line:
+        process.kill()
+        raise RuntimeError(f"桩服务启动失败: {line}")
+    return process, line[line.index("http://"):].strip()
+
+
+def mock_stats(api_url):
+    try:
+        with urllib.request.urlopen(api_url.rsplit("/v1", 1)[0] + "/stats", timeout=5) as response:
+            return json.loads(response.read())
+    except Exception as e:
+        print(f"读取桩服务统计失败: {e}")
+        return None
+
+
+def wait_for_warm_up():
+    for thread in threading.enumerate():
+        if thread.name == "warm-up":
+            thread.join()
+
+
+def db_size(db_file):
+    return sum(os.path.getsize(db_file + suffix) for suffix in ("", "-wal") if os.path.exists(db_file + suffix))
+
+
+def db_rows(db_file):
+    conn = sqlite3.connect(db_file)
+    try:
+        return conn.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+    finally:
+        conn.close()
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 上单位是 KB，macOS 上是字节
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def percentiles(samples):
+    import metrics
+    return {"count": len(samples), **{f"p{int(q * 100)}": metrics.quantile(samples, q) for q in QUANTILES}}
+
+
+def latency_report(name, label):
+    """按某个标签汇总一个耗时指标的分位数"""
+    import metrics
+    report = {}
+    for labels, samples in metrics.latency_samples(name).items():
+        labels = dict(labels)
+        key = labels.get(label, "") if isinstance(label, str) else ".".join(labels.get(l, "") for l in label)
+        report.setdefault(key, []).extend(samples)
+    return {key: percentiles(samples) for key, samples in sorted(report.items())}
+
+
+async def handle_one(msg):
+    """
+    直接调用 brain.handle_group_message，有回复时发送
+    不经过群队列和队列满时的丢弃/合并，同一个群的消息会并发处理，只用来单独测插件本身的耗时
+    """
+    import brain
+    result = await brain.handle_group_message(msg)
+    if result:
+        await brain.send_reply(msg, result)
+
+
+async def replay(messages, offsets, mode):
+    """按 offsets 把消息交给机器人，等所有消息处理完、回复发完，返回耗时（秒）"""
+    import brain
+    start = time.monotonic()
+    tasks = []
+    for msg, offset in zip(messages, offsets):
+        delay = start + offset - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        msg.created = time.monotonic()
+        if mode == "handle":
+            tasks.append(asyncio.create_task(handle_one(msg)))
+        else:
+            # 和 run.py 一样放进群队列
+            brain.submit_group_message(msg)
+    await asyncio.gather(*tasks, return_exceptions=True)
+    while not brain.is_idle():
+        await asyncio.sleep(0.05)
+    return time.monotonic() - start
+
+
+def print_table(title, rows):
+    print(f"\n{title}")
+    print(f"{'':<36}{'次数':>8}{'p50(ms)':>10}{'p95(ms)':>10}{'p99(ms)':>10}")
+    for name, stats in rows.items():
+        print(f"{name:<36}{stats['count']:>8}{stats['p50'] * 1000:>10.1f}{stats['p95'] * 1000:>10.1f}{stats['p99'] * 1000:>10.1f}")
+
+
+def print_report(report):
+    print("\n===== 压测结果 =====")
+    print(f"消息数: {report['messages']}，耗时 {report['elapsed_seconds']:.1f} 秒，"
+          f"吞吐量 {report['throughput']:.1f} 条/秒")
+    print(f"回复: {report['replied_messages']} 条消息得到回复，共发送 {report['replies']} 段")
+    print_table("首段回复延迟", {"first_reply": report["first_reply_latency"]})
+    print_table("插件耗时", report["plugins"])
+    if report["llm_requests"]:
+        print_table("大模型请求耗时", report["llm_requests"])
+    print(f"\n数据库: 增加 {report['db_rows_added']} 行，{report['db_growth_bytes'] / 1024:.1f} KB")
+    if report["peak_rss_mb"] is not None:
+        print(f"内存峰值: {report['peak_rss_mb']:.1f} MB")
+    if report["mock_server"]:
+        print(f"桩服务: {report['mock_server']}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="回放聊天记录压测机器人的消息处理流程")
+    parser.add_argument("--db", help="录制的 qq_chat.db，不给时合成消息")
+    parser.add_argument("--limit", type=int, default=1000, help="回放最近多少条消息")
+    parser.add_argument("--groups", type=int, default=0, help="把消息轮流分到多少个群，0 为保留原来的群（合成消息时默认 10）")
+    parser.add_argument("--rate", type=float, default=0, help="每秒发送多少条消息")
+    parser.add_argument("--speed", type=float, default=0, help="没有 --rate 时按录制的间隔加速多少倍回放")
+    parser.add_argument("--mode", choices=("queue", "handle"), default="queue",
+                        help="queue: 和 run.py 一样放进群队列；handle: 绕过群队列直接调用 brain.handle_group_message，"
+                             "只用于单独测插件耗时")
+    parser.add_argument("--workdir", help="工作目录，默认新建临时目录，结束后删除")
+    parser.add_argument("--api-url", help="使用已经在运行的接口（不启动桩服务）")
+    parser.add_argument("--latency", type=float, default=0.3, help="桩服务发出第一段之前的延迟（秒）")
+    parser.add_argument("--token-delay", type=float, default=0.02, help="桩服务流式响应每一段之间的间隔（秒）")
+    parser.add_argument("--reply-rate", type=float, default=0.3, help="桩服务判断需要回复的概率")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="桩服务返回 429 的概率")
+    parser.add_argument("--script", help="桩服务的工具调用脚本（JSON 文件）")
+    parser.add_argument("--env", action="append", default=[], help="额外的环境变量 KEY=VALUE，可以多次使用")
+    parser.add_argument("--no-warm-up", action="store_true", help="不等插件预热完成就开始（计入冷启动耗时）")
+    parser.add_argument("--json", help="把结果写入 JSON 文件，用于和之前的结果比较")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    json_path = os.path.abspath(args.json) if args.json else None
+    workdir = args.workdir or tempfile.mkdtemp(prefix="qqbot_bench_")
+    db_file = prepare_workdir(workdir, args.db)
+    if args.db:
+        records = load_records(db_file, args.limit)
+        messages = build_messages(records, args.groups)
+    else:
+        records = []
+        messages = synthetic_messages(args.limit, args.groups or 10, bot_qq=BOT_QQ)
+    offsets = schedule(records, len(messages), args.rate, args.speed)
+    print(f"准备回放 {len(messages)} 条消息，工作目录 {workdir}")
+
+    process = None
+    api_url = args.api_url
+    if not api_url:
+        process, api_url = start_mock_server(args)
+    try:
+        os.environ.update(BENCH_ENV, API_URL=api_url, LOW_COST_API_URL=api_url)
+        os.environ.update(item.split("=", 1) for item in args.env)
+        os.chdir(workdir)
+
+        import metrics
+        # 压测期间保留所有样本，分位数按全部消息计算
+        metrics.SAMPLE_WINDOW = max(metrics.SAMPLE_WINDOW, len(messages) * 20)
+        import brain
+        brain.init_plugins()
+        brain.warm_up_plugins()
+        if not args.no_warm_up:
+            wait_for_warm_up()
+
+        size_before, rows_before = db_size(db_file), db_rows(db_file)
+        elapsed = asyncio.run(replay(messages, offsets, args.mode))
+        import chat_db
+        chat_db.flush(timeout=60)
+
+        first_replies = [msg.replies[0][0] - msg.created for msg in messages if msg.replies]
+        report = {
+            "messages": len(messages),
+            "mode": args.mode,
+            "elapsed_seconds": elapsed,
+            "throughput": len(messages) / elapsed if elapsed else 0.0,
+            "replied_messages": len(first_replies),
+            "replies": sum(len(msg.replies) for msg in messages),
+            "first_reply_latency": percentiles(first_replies),
+            "plugins": latency_report("plugin_latency_seconds", ("plugin", "handler")),
+            "llm_requests": latency_report("llm_request_seconds", "purpose"),
+            "db_growth_bytes": db_size(db_file) - size_before,
+            "db_rows_added": db_rows(db_file) - rows_before,
+            "peak_rss_mb": peak_rss_mb(),
+            "mock_server": mock_stats(api_url) if process else None,
+        }
+        print_report(report)
+        if json_path:
+            with open(json_path, "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+        return report
+    finally:
+        if process is not None:
+            process.terminate()
+        if not args.workdir:
+            os.chdir(PROJECT_ROOT)
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
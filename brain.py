@@ -1,43 +1,798 @@
 from ncatbot.core import GroupMessage
 import os
+import re
+import sys
+import json
+import time
+import random
+import asyncio
+import threading
+import contextlib
+import contextvars
 import importlib
+import importlib.util
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+import metrics
+# 插件通过 brain.shared_resource 或 shared.shared_resource 获取共享资源，两者是同一个函数
+from shared import shared_resource
+
+# 已加载的插件列表: [(优先级, 模块)]
+plugins = []
+
+# 插件导入和预热耗时（秒）: 模块名 -> {"import": 秒, "warm_up": 秒或None}
+plugin_timings = {}
+
+# 路由索引（在 init_plugins 中构建）
+# 命令 -> (优先级, 插件, 处理函数)，插件通过 COMMANDS 声明
+command_index = {}
+# 每条消息都会收到的观察者: [(优先级, 插件)]
+# 插件通过 observe_batch(消息列表) 或 observe_message(消息) 声明
+observers = []
+# 没有命令命中时按优先级依次询问的兜底插件: [(优先级, 插件)]，即旧式 handle_message
+responders = []
+
+# 插件工作类型，插件通过 WORK_KIND 声明，默认 io
+# cpu: 向量编码、模型推理等计算密集型工作
+# io: 调用大模型、HTTP 请求、读写数据库等
+WORK_KINDS = ("cpu", "io")
+
+# 同步插件线程池和 async 插件并发上限，按工作类型分开（在 init_plugins 中创建）
+_executors = {}
+_slots = {}
+# 当前 async 插件调用占用的并发名额: {"slot": 信号量, "held": 是否持有}，见 slot_released
+_current_slot = contextvars.ContextVar("plugin_slot", default=None)
+
+# 每个群一个 FIFO 队列，保证同一个群的回复顺序
+_group_queues = {}
+# 正在消费队列的任务: 群号 -> Task
+_group_workers = {}
+# 后台任务引用，防止被垃圾回收
+_background_tasks = set()
+# 每个群最后一个待发送回复的任务，用于保证回复顺序
+_reply_chains = {}
+
+# 调度设置（在 init_plugins 中读取）
+# GROUP_QUEUE_SIZE: 每个群最多排队的消息数
+# GROUP_QUEUE_POLICY: 队列满时的处理方式
+#   drop  - 丢弃新消息（仍会交给观察者记录，但不回复）
+#   merge - 用新消息替换队尾还没处理的消息，只回复最新的对话状态
+GROUP_QUEUE_SIZE = 20
+GROUP_QUEUE_POLICY = "merge"
+
+# 调度统计
+scheduler_stats = {"submitted": 0, "dropped": 0, "merged": 0}
+
+# 观察者流水线：消息先进入进程内队列，后台任务攒成小批次后交给观察者，不占用回复路径
+# 队列元素: (入队时间, 消息)
+_observer_queue = deque()
+# 还没被所有观察者处理完的消息: 群号 -> deque[消息]，供插件补全尚未落库的聊天记录
+_observer_pending = {}
+_observer_wakeup = None
+_observer_task = None
+
+# 观察者设置（在 init_plugins 中读取）
+# OBSERVER_BATCH_SIZE: 每批最多处理的消息数
+# OBSERVER_BATCH_INTERVAL: 攒批最长等待时间（秒）
+# OBSERVER_LAG_WARN: 延迟超过该秒数时打印警告
+# OBSERVER_RETRIES: 观察者处理一批消息失败后最多重试几次（只重试失败的观察者）
+OBSERVER_BATCH_SIZE = 50
+OBSERVER_BATCH_INTERVAL = 0.5
+OBSERVER_LAG_WARN = 10.0
+OBSERVER_RETRIES = 3
+# 第一次重试前等待的秒数，之后每次翻倍
+OBSERVER_RETRY_DELAY = 1.0
+
+# 观察者统计，lag 为消息从入队到被所有观察者处理完的秒数
+observer_stats = {
+    "queued": 0,
+    "processed": 0,
+    "batches": 0,
+    "errors": 0,
+    "retries": 0,
+    "dropped": 0,
+    "last_lag": 0.0,
+    "max_lag": 0.0,
+}
+
+# 插件通过这些属性声明自己的功能，一个都没有的模块是插件之间共用的辅助模块（chat_db、llm_gateway 等）
+# 其他插件用 from x import ... 引用辅助模块，重新加载后它们拿到的仍是旧版本，所以辅助模块不热重载
+PLUGIN_INTERFACE = ("COMMANDS", "handle_message", "observe_batch", "observe_message")
+
+# 热重载：插件文件的修改时间，模块名 -> mtime
+_plugin_mtimes = {}
+# 事件循环（收到第一条消息时记录），热重载在其他线程中完成加载后回到循环线程切换插件
+_loop = None
+# 管理员停用的插件（模块名），保存在 bot_config 中，重启后仍然有效
+DISABLED_PLUGINS_FILE = os.path.join("bot_config", "disabled_plugins.json")
+disabled_plugins = set()
+
+# 消息开头的 CQ 码（回复、@ 等），解析命令前需要去掉
+CQ_PREFIX_RE = re.compile(r'^(\[CQ:[^\]]*\]\s*)+')
+# 命令格式: / 加英文、数字或下划线，例如 /help /query_add
+COMMAND_RE = re.compile(r'/[A-Za-z0-9_]+')
 
 
 def init_plugins():
     """初始化所有插件"""
     global plugins
+    load_dotenv(os.path.join("bot_config", ".env"))
+    load_disabled_plugins()
     plugins = []
-    for file in os.listdir("qq_bot_plugins"):
+    _plugin_mtimes.update(scan_plugin_files())
+    for file in sorted(os.listdir("qq_bot_plugins")):
         if file.endswith(".py") and file != "__init__.py":
             module_name = file[:-3]  # Remove .py extension
+            start = time.perf_counter()
             try:
-                plugin = importlib.import_module(f"qq_bot_plugins.{module_name}")
+                plugin = import_plugin(module_name)
                 # 获取插件优先级，默认为100
                 priority = getattr(plugin, 'PRIORITY', 100)
                 plugins.append((priority, plugin))
             except Exception as e:
                 print(f"加载插件 {module_name} 失败: {e}")
-    
+            plugin_timings[module_name] = {"import": time.perf_counter() - start, "warm_up": None}
+
     # 按照优先级排序（数值越小优先级越高）
     plugins.sort(key=lambda x: x[0])
+    build_routes()
+    init_scheduler()
+    init_observer_settings()
+    metrics.register_gauges(collect_gauges)
+    metrics.init_metrics()
+    print_plugin_timings()
+    watch_plugins()
+
+
+def import_plugin(module_name):
+    """
+    导入插件模块
+    插件之间会把插件目录加入 sys.path 后用模块名直接互相导入（如 from record import ...），
+    这里让 qq_bot_plugins.xxx 和 xxx 指向同一个模块对象，避免同一个文件被加载两次、
+    模型等共享资源各自初始化一份
+    """
+    path = os.path.abspath(os.path.join("qq_bot_plugins", module_name + ".py"))
+    module = sys.modules.get(module_name)
+    if module is not None and os.path.abspath(getattr(module, '__file__', None) or '') == path:
+        sys.modules[f"qq_bot_plugins.{module_name}"] = module
+        return module
+    module = importlib.import_module(f"qq_bot_plugins.{module_name}")
+    sys.modules.setdefault(module_name, module)
+    return module
 
 
+def warm_up_plugins():
+    """
+    在后台线程中并发执行各插件的 warm_up()，提前加载模型、词典等重资源
+    不阻塞机器人连接，全部完成后打印耗时表
+    """
+    targets = [plugin for priority, plugin in plugins if hasattr(plugin, 'warm_up')]
+    if not targets:
+        return
 
-def handle_group_message(msg:GroupMessage):
-    # 处理插件消息，按照优先级顺序执行
+    def warm_up_one(plugin):
+        start = time.perf_counter()
+        try:
+            plugin.warm_up()
+        except Exception as e:
+            print(f"插件 {plugin.__name__} 预热失败: {e}")
+        plugin_timings[plugin_key(plugin)]["warm_up"] = time.perf_counter() - start
+
+    def run_all():
+        with ThreadPoolExecutor(max_workers=len(targets), thread_name_prefix="warm-up") as pool:
+            list(pool.map(warm_up_one, targets))
+        print_plugin_timings()
+
+    threading.Thread(target=run_all, name="warm-up", daemon=True).start()
+
+
+def plugin_key(plugin):
+    """插件在 plugin_timings 等表中使用的名字（不带包前缀）"""
+    return plugin.__name__.rsplit(".", 1)[-1]
+
+
+def print_plugin_timings():
+    """打印各插件的导入和预热耗时（毫秒）"""
+    print(f"{'插件':<24}{'导入(ms)':>10}{'预热(ms)':>10}")
+    for name, timing in sorted(plugin_timings.items(), key=lambda x: -(x[1]["import"] + (x[1]["warm_up"] or 0))):
+        warm_up = "-" if timing["warm_up"] is None else f"{timing['warm_up'] * 1000:.0f}"
+        print(f"{name:<24}{timing['import'] * 1000:>10.0f}{warm_up:>10}")
+
+
+def is_plugin(module):
+    """模块是否声明了插件接口（见 PLUGIN_INTERFACE）"""
+    return any(hasattr(module, name) for name in PLUGIN_INTERFACE)
+
+
+def is_helper_module(module_name):
+    """插件目录中已经加载、但没有声明插件接口的辅助模块"""
+    module = sys.modules.get(module_name)
+    return module is not None and not is_plugin(module)
+
+
+def plugin_path(module_name):
+    return os.path.abspath(os.path.join("qq_bot_plugins", module_name + ".py"))
+
+
+def scan_plugin_files():
+    """插件目录下所有插件文件的修改时间: 模块名 -> mtime"""
+    mtimes = {}
+    for file in os.listdir("qq_bot_plugins"):
+        if file.endswith(".py") and file != "__init__.py":
+            try:
+                mtimes[file[:-3]] = os.path.getmtime(os.path.join("qq_bot_plugins", file))
+            except OSError:
+                # 文件在扫描过程中被删除或正在替换，下一轮再处理
+                continue
+    return mtimes
+
+
+def watch_plugins():
+    """
+    在后台线程中轮询插件目录，文件有变化时自动重新加载对应插件
+    间隔由 PLUGIN_WATCH_INTERVAL 控制（秒，默认2，设为0关闭）
+    """
+    interval = float(os.getenv("PLUGIN_WATCH_INTERVAL", "2"))
+    if interval <= 0:
+        return
+
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                check_plugin_changes()
+            except Exception as e:
+                print(f"检查插件变化失败: {e}")
+
+    threading.Thread(target=run, name="plugin-watcher", daemon=True).start()
+
+
+def check_plugin_changes():
+    """对比插件文件的修改时间，重新加载有变化的插件、卸载被删除的插件"""
+    current = scan_plugin_files()
+    for module_name, mtime in current.items():
+        if _plugin_mtimes.get(module_name) != mtime:
+            _plugin_mtimes[module_name] = mtime
+            reload_plugin(module_name)
+    for module_name in set(_plugin_mtimes) - set(current):
+        del _plugin_mtimes[module_name]
+        run_on_loop(lambda name=module_name: uninstall_plugin(name))
+        print(f"插件 {module_name} 已卸载")
+
+
+def load_plugin_module(module_name):
+    """从文件加载一个全新的模块对象，出错时抛出异常，已加载的旧版本不受影响"""
+    spec = importlib.util.spec_from_file_location(f"qq_bot_plugins.{module_name}", plugin_path(module_name))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def reload_plugin(module_name):
+    """
+    重新加载一个插件
+    新版本在当前线程中完整加载成功后，才在事件循环线程中一次性替换旧版本和路由索引，
+    处理中的消息不会看到加载到一半的插件；加载失败则继续使用旧版本
+    辅助模块（没有声明插件接口）不重新加载，修改后需要重启机器人
+    """
+    if is_helper_module(module_name):
+        print(f"{module_name} 是插件共用的辅助模块，不能热重载，重启机器人后生效")
+        return False
+    start = time.perf_counter()
+    try:
+        module = load_plugin_module(module_name)
+    except Exception as e:
+        print(f"重新加载插件 {module_name} 失败，继续使用旧版本: {e}")
+        return False
+    if not is_plugin(module):
+        print(f"{module_name} 没有声明插件接口（{' / '.join(PLUGIN_INTERFACE)}），不作为插件加载")
+        return False
+    run_on_loop(lambda: install_plugin(module_name, module))
+    elapsed = time.perf_counter() - start
+    plugin_timings[module_name] = {"import": elapsed, "warm_up": None}
+    print(f"插件 {module_name} 已重新加载 ({elapsed * 1000:.0f} ms)")
+    if hasattr(module, 'warm_up'):
+        threading.Thread(target=module.warm_up, name=f"warm-up-{module_name}", daemon=True).start()
+    return True
+
+
+def run_on_loop(func):
+    """在事件循环线程中执行 func，事件循环还没启动时直接执行"""
+    if _loop is not None and _loop.is_running():
+        _loop.call_soon_threadsafe(func)
+    else:
+        func()
+
+
+def install_plugin(module_name, module):
+    """用新模块替换（或新增）插件，并重建路由索引"""
+    global plugins
+    sys.modules[f"qq_bot_plugins.{module_name}"] = module
+    sys.modules[module_name] = module
+    updated = [(priority, plugin) for priority, plugin in plugins if plugin_key(plugin) != module_name]
+    updated.append((getattr(module, 'PRIORITY', 100), module))
+    updated.sort(key=lambda x: x[0])
+    plugins = updated
+    build_routes()
+
+
+def uninstall_plugin(module_name):
+    """移除插件并重建路由索引"""
     global plugins
-    
+    plugins = [(priority, plugin) for priority, plugin in plugins if plugin_key(plugin) != module_name]
+    build_routes()
+
+
+def load_disabled_plugins():
+    disabled_plugins.clear()
+    if os.path.exists(DISABLED_PLUGINS_FILE):
+        with open(DISABLED_PLUGINS_FILE, 'r', encoding='utf-8') as f:
+            disabled_plugins.update(json.load(f))
+
+
+def set_plugin_enabled(module_name, enabled):
+    """运行时启用或停用插件（不需要重启），返回是否找到该插件"""
+    if module_name not in {plugin_key(plugin) for priority, plugin in plugins}:
+        return False
+    if enabled:
+        disabled_plugins.discard(module_name)
+    else:
+        disabled_plugins.add(module_name)
+    with open(DISABLED_PLUGINS_FILE, 'w', encoding='utf-8') as f:
+        json.dump(sorted(disabled_plugins), f, ensure_ascii=False, indent=2)
+    return True
+
+
+def list_plugins():
+    """[(模块名, 优先级, 是否启用)]，按优先级排序"""
+    return [(plugin_key(plugin), priority, is_enabled(plugin)) for priority, plugin in plugins]
+
+
+def init_scheduler():
+    """读取调度设置，创建 cpu / io 两类线程池和并发上限"""
+    global GROUP_QUEUE_SIZE, GROUP_QUEUE_POLICY
+    GROUP_QUEUE_SIZE = int(os.getenv("GROUP_QUEUE_SIZE", str(GROUP_QUEUE_SIZE)))
+    GROUP_QUEUE_POLICY = os.getenv("GROUP_QUEUE_POLICY", GROUP_QUEUE_POLICY)
+    if GROUP_QUEUE_POLICY not in ("drop", "merge"):
+        print(f"未知的 GROUP_QUEUE_POLICY: {GROUP_QUEUE_POLICY}，使用 merge")
+        GROUP_QUEUE_POLICY = "merge"
+
+    limits = {
+        # 计算密集型工作超过 CPU 核数没有意义
+        "cpu": int(os.getenv("CPU_WORKERS", str(os.cpu_count() or 2))),
+        # 网络请求大部分时间在等待，可以开得多一些
+        "io": int(os.getenv("IO_WORKERS", "16")),
+    }
+    for kind in WORK_KINDS:
+        _executors[kind] = ThreadPoolExecutor(max_workers=limits[kind], thread_name_prefix=f"plugin-{kind}")
+        _slots[kind] = asyncio.Semaphore(limits[kind])
+
+
+def init_observer_settings():
+    """读取观察者流水线设置"""
+    global OBSERVER_BATCH_SIZE, OBSERVER_BATCH_INTERVAL, OBSERVER_LAG_WARN, OBSERVER_RETRIES
+    OBSERVER_BATCH_SIZE = int(os.getenv("OBSERVER_BATCH_SIZE", str(OBSERVER_BATCH_SIZE)))
+    OBSERVER_BATCH_INTERVAL = float(os.getenv("OBSERVER_BATCH_INTERVAL", str(OBSERVER_BATCH_INTERVAL)))
+    OBSERVER_LAG_WARN = float(os.getenv("OBSERVER_LAG_WARN", str(OBSERVER_LAG_WARN)))
+    OBSERVER_RETRIES = int(os.getenv("OBSERVER_RETRIES", str(OBSERVER_RETRIES)))
+
+
+def build_routes():
+    """根据插件声明的 COMMANDS / observe_batch / observe_message / handle_message 构建路由索引"""
+    global command_index, observers, responders
+    new_index = {}
+    new_observers = []
+    new_responders = []
+    for priority, plugin in plugins:
+        for command, handler in getattr(plugin, 'COMMANDS', {}).items():
+            if command in new_index:
+                # plugins 已按优先级排序，先注册的优先级更高
+                print(f"命令 {command} 已被 {new_index[command][1].__name__} 注册，忽略 {plugin.__name__} 中的同名命令")
+                continue
+            new_index[command] = (priority, plugin, handler)
+        if hasattr(plugin, 'observe_batch') or hasattr(plugin, 'observe_message'):
+            new_observers.append((priority, plugin))
+        if hasattr(plugin, 'handle_message'):
+            new_responders.append((priority, plugin))
+    command_index, observers, responders = new_index, new_observers, new_responders
+
+
+def parse_command(raw_msg:str):
+    """取出消息开头的命令，没有命令返回 None"""
+    text = CQ_PREFIX_RE.sub('', raw_msg.strip())
+    match = COMMAND_RE.match(text)
+    return match.group(0) if match else None
+
+
+def is_enabled(plugin):
+    return getattr(plugin, 'plugin_enabled', True) and plugin_key(plugin) not in disabled_plugins
+
+
+def work_kind(plugin):
+    kind = getattr(plugin, 'WORK_KIND', 'io')
+    return kind if kind in WORK_KINDS else 'io'
+
+
+async def call_plugin(plugin, func, msg:GroupMessage):
+    """
+    调用插件函数：async 函数直接 await，同步函数放进线程池执行
+    两种方式都受插件工作类型（cpu / io）的全局并发上限约束
+    每次调用都会记录调用次数、命中次数（返回了回复）、异常次数和耗时
+    """
+    kind = work_kind(plugin)
+    labels = {"plugin": plugin_key(plugin), "handler": func.__name__}
+    metrics.inc("plugin_calls_total", **labels)
+    start = time.perf_counter()
+    try:
+        if asyncio.iscoroutinefunction(func):
+            slot = {"slot": _slots[kind], "held": False}
+            await slot["slot"].acquire()
+            slot["held"] = True
+            token = _current_slot.set(slot)
+            try:
+                result = await func(msg)
+            finally:
+                _current_slot.reset(token)
+                if slot["held"]:
+                    slot["slot"].release()
+        else:
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(_executors[kind], func, msg)
+    except Exception:
+        metrics.inc("plugin_errors_total", **labels)
+        raise
+    finally:
+        metrics.observe("plugin_latency_seconds", time.perf_counter() - start, **labels)
+    if result:
+        metrics.inc("plugin_hits_total", **labels)
+    return result
+
+
+@contextlib.asynccontextmanager
+async def slot_released():
+    """
+    在 async 插件中临时让出并发名额，用于防抖、等待前一条回复发完等不需要占用名额的等待
+    退出时重新排队获取名额；不在 call_plugin 调用中时什么也不做
+    """
+    slot = _current_slot.get()
+    if slot is None or not slot["held"]:
+        yield
+        return
+    slot["slot"].release()
+    slot["held"] = False
+    try:
+        yield
+    finally:
+        await slot["slot"].acquire()
+        slot["held"] = True
+
+
+async def run_blocking(kind, func, *args):
+    """在 async 插件中执行阻塞函数（编码、同步 HTTP 请求等），放进对应工作类型的线程池"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executors[kind], lambda: func(*args))
+
+
+def enqueue_observation(msg:GroupMessage):
+    """把消息放进观察者队列，立即返回"""
+    global _observer_wakeup, _observer_task, _loop
+    _loop = asyncio.get_running_loop()
+    _observer_queue.append((time.monotonic(), msg))
+    _observer_pending.setdefault(msg.group_id, deque()).append(msg)
+    observer_stats["queued"] += 1
+    if _observer_task is None or _observer_task.done():
+        _observer_wakeup = asyncio.Event()
+        _observer_task = spawn(run_observer_pipeline())
+    _observer_wakeup.set()
+
+
+def queued_messages(group_id):
+    """某个群队列中还在排队、没有开始处理的消息数（都比正在处理的消息新）"""
+    return len(_group_queues.get(group_id, ()))
+
+
+def pending_messages(group_id):
+    """
+    返回某个群已收到、但观察者还没处理完（例如还没写入数据库）的消息，按接收顺序排列
+    插件可能在线程池中调用，list() 复制 deque 时持有 GIL，不会读到一半
+    """
+    return list(_observer_pending.get(group_id, ()))
+
+
+async def observe_batch(plugin, msgs):
+    """把一批消息交给一个观察者，优先使用 observe_batch，否则逐条调用 observe_message"""
+    if hasattr(plugin, 'observe_batch'):
+        await call_plugin(plugin, plugin.observe_batch, msgs)
+        return
+    for msg in msgs:
+        try:
+            await call_plugin(plugin, plugin.observe_message, msg)
+        except Exception as e:
+            observer_stats["errors"] += 1
+            print(f"Error in plugin {plugin.__name__} observe_message: {e}")
+
+
+async def run_observer_pipeline():
+    """后台任务：从观察者队列中攒批，交给所有观察者并发处理"""
+    while True:
+        if not _observer_queue:
+            _observer_wakeup.clear()
+            await _observer_wakeup.wait()
+        # 给后续消息一点时间凑成一批，队列已经够一批时不用等
+        if len(_observer_queue) < OBSERVER_BATCH_SIZE:
+            await asyncio.sleep(OBSERVER_BATCH_INTERVAL)
+
+        batch = [_observer_queue.popleft() for _ in range(min(OBSERVER_BATCH_SIZE, len(_observer_queue)))]
+        msgs = [msg for enqueued_at, msg in batch]
+        active = [plugin for priority, plugin in observers if is_enabled(plugin)]
+        failed = await run_observers(active, msgs)
+        if failed:
+            # 失败的观察者稍后单独重试，重试结束前这批消息仍然留在 pending_messages 中
+            spawn(retry_observers(failed, msgs))
+        else:
+            release_pending(msgs)
+
+        lag = time.monotonic() - batch[0][0]
+        metrics.observe("observer_lag_seconds", lag)
+        observer_stats["processed"] += len(msgs)
+        observer_stats["batches"] += 1
+        observer_stats["last_lag"] = lag
+        observer_stats["max_lag"] = max(observer_stats["max_lag"], lag)
+        if lag > OBSERVER_LAG_WARN:
+            print(f"观察者处理延迟 {lag:.1f} 秒，队列中还有 {len(_observer_queue)} 条消息")
+
+
+async def run_observers(active, msgs):
+    """把一批消息交给多个观察者并发处理，返回处理失败的观察者"""
+    results = await asyncio.gather(*(observe_batch(plugin, msgs) for plugin in active), return_exceptions=True)
+    failed = []
+    for plugin, result in zip(active, results):
+        if isinstance(result, Exception):
+            observer_stats["errors"] += 1
+            print(f"Error in plugin {plugin.__name__} observe: {result}")
+            failed.append(plugin)
+    return failed
+
+
+async def retry_observers(failed, msgs):
+    """
+    退避后让失败的观察者重新处理这批消息（例如数据库写入失败的记录插件）
+    都成功或重试次数用完后，才把这批消息移出 pending_messages
+    """
+    try:
+        for attempt in range(OBSERVER_RETRIES):
+            await asyncio.sleep(OBSERVER_RETRY_DELAY * 2 ** attempt)
+            observer_stats["retries"] += 1
+            failed = await run_observers([plugin for plugin in failed if is_enabled(plugin)], msgs)
+            if not failed:
+                return
+        for plugin in failed:
+            observer_stats["dropped"] += len(msgs)
+            metrics.inc("observer_dropped_total", len(msgs), plugin=plugin_key(plugin))
+            print(f"插件 {plugin.__name__} 重试 {OBSERVER_RETRIES} 次后仍然失败，放弃 {len(msgs)} 条消息")
+    finally:
+        release_pending(msgs)
+
+
+def release_pending(msgs):
+    """观察者处理完一批消息后，把它们移出 pending_messages（重试的批次可能晚于后面的批次完成）"""
+    for msg in msgs:
+        pending = _observer_pending.get(msg.group_id)
+        if not pending:
+            continue
+        if pending[0] is msg:
+            pending.popleft()
+        else:
+            try:
+                pending.remove(msg)
+            except ValueError:
+                pass
+        if not pending:
+            del _observer_pending[msg.group_id]
+
+
+async def find_reply(msg:GroupMessage):
+    """
+    为消息找到回复，返回 (产生回复的插件, 回复)，没有回复时返回 (None, None):
+    1. 消息以命令开头时，只交给注册了该命令的插件处理
+    2. 否则按优先级依次询问兜底插件，第一个有返回值的作为回复
+    """
+    command = parse_command(msg.raw_message)
+    route = command_index.get(command) if command else None
+    if route:
+        priority, plugin, handler = route
+        if not is_enabled(plugin):
+            return None, None
+        try:
+            result = await call_plugin(plugin, handler, msg)
+            return (plugin, result) if result else (None, None)
+        except Exception as e:
+            print(f"Error in plugin {plugin.__name__} command {command}: {e}")
+            return None, None
+
+    for priority, plugin in responders:
+        if not is_enabled(plugin):
+            continue
+        try:
+            result = await call_plugin(plugin, plugin.handle_message, msg)
+            if result:
+                return plugin, result
+        except Exception as e:
+            print(f"Error in plugin {plugin.__name__} handle_message: {e}")
+
+    return None, None
+
+
+async def respond_group_message(msg:GroupMessage):
+    """为消息找到回复，返回值格式: (回复内容, 是否@发送者, 图片路径)，没有回复时返回 None"""
+    plugin, result = await find_reply(msg)
+    return result
+
+
+async def handle_group_message(msg:GroupMessage):
+    """处理一条群消息：放进观察者队列后查找回复，记录、建索引不占用回复时间"""
     # 如果插件未初始化，返回默认值
     if not plugins:
         return None
-    
-    for priority, plugin in plugins:
-        if hasattr(plugin, 'handle_message'):
+
+    enqueue_observation(msg)
+    return await respond_group_message(msg)
+
+
+async def send_reply(msg:GroupMessage, result):
+    """
+    把插件返回的 (回复内容, 是否@发送者, 图片路径) 发送到群里
+    回复内容可以是异步迭代器（流式回复），每产出一段就发送一条消息，@和图片只放在第一条
+    回复内容是异步生成器时，发出一段后通过 asend 把这条消息的 ID 传回给它（没发出或拿不到 ID 时为 None）
+    """
+    if not result:
+        return
+    text, is_at, image = result
+    if not hasattr(text, "__aiter__"):
+        await send_text(msg, text, is_at, image)
+        return
+    text = text.__aiter__()
+    send = getattr(text, "asend", None)
+    message_id = None
+    try:
+        while True:
+            try:
+                part = await (send(message_id) if send is not None else text.__anext__())
+            except StopAsyncIteration:
+                break
+            message_id = None
+            part = part.strip()
+            if not part:
+                continue
+            message_id = await send_text(msg, part, is_at, image)
+            is_at, image = False, None
+    finally:
+        close = getattr(text, "aclose", None)
+        if close is not None:
+            await close()
+
+
+async def send_text(msg:GroupMessage, text, is_at, image):
+    """发送一条消息，返回发出的消息 ID（字符串，拿不到时为 None）"""
+    with metrics.timer("reply"):
+        if is_at:
+            result = await msg.reply(text=text, at=True, image=image)
+        else:
+            result = await msg.reply(text=text, image=image)
+    return sent_message_id(result)
+
+
+def sent_message_id(result):
+    """从 msg.reply 的返回值中取出消息 ID: OneBot 的响应 {"data": {"message_id": ...}}，或者直接就是 ID"""
+    if isinstance(result, dict):
+        data = result.get("data")
+        result = data.get("message_id") if isinstance(data, dict) else None
+    if result is None or result == "":
+        return None
+    return str(result)
+
+
+def reply_delay(plugin):
+    """
+    插件声明的拟人化回复延迟（秒），REPLY_DELAY = (最短, 最长)，未声明则不等待
+    """
+    delay = getattr(plugin, 'REPLY_DELAY', None)
+    if not delay:
+        return 0
+    low, high = delay
+    return random.uniform(low, high)
+
+
+def schedule_reply(msg:GroupMessage, result, delay):
+    """
+    在 delay 秒后发送回复，立即返回，等待期间不占用群队列和线程池
+    同一个群的回复排成一条链，后面的回复一定在前面的回复发出之后才发送
+    """
+    previous = _reply_chains.get(msg.group_id)
+    send_at = time.monotonic() + delay
+
+    async def send_later():
+        if previous is not None:
+            await asyncio.gather(previous, return_exceptions=True)
+        await asyncio.sleep(max(0, send_at - time.monotonic()))
+        try:
+            await send_reply(msg, result)
+        except Exception as e:
+            print(f"发送群 {msg.group_id} 回复失败: {e}")
+        finally:
+            if _reply_chains.get(msg.group_id) is task:
+                del _reply_chains[msg.group_id]
+
+    task = spawn(send_later())
+    _reply_chains[msg.group_id] = task
+    return task
+
+
+def spawn(coro):
+    """启动后台任务并保存引用"""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+def submit_group_message(msg:GroupMessage):
+    """
+    把消息放进所在群的 FIFO 队列，立即返回
+    同一个群的消息按顺序处理，不同群之间并发处理
+    """
+    scheduler_stats["submitted"] += 1
+    # 每条消息都要被观察者记录，与是否回复无关
+    enqueue_observation(msg)
+    # 队列元素: (入队时间, 消息)
+    queue = _group_queues.setdefault(msg.group_id, deque())
+    if len(queue) >= GROUP_QUEUE_SIZE:
+        if GROUP_QUEUE_POLICY == "merge":
+            # 用新消息顶替队尾还没处理的消息
+            queue.pop()
+            queue.append((time.monotonic(), msg))
+            scheduler_stats["merged"] += 1
+        else:
+            scheduler_stats["dropped"] += 1
+    else:
+        queue.append((time.monotonic(), msg))
+
+    if msg.group_id not in _group_workers:
+        _group_workers[msg.group_id] = spawn(drain_group_queue(msg.group_id))
+
+
+async def drain_group_queue(group_id):
+    """依次处理一个群队列中的消息，队列空了就退出"""
+    queue = _group_queues[group_id]
+    try:
+        while queue:
+            submitted_at, msg = queue.popleft()
+            metrics.observe("group_queue_wait_seconds", time.monotonic() - submitted_at)
             try:
-                result = plugin.handle_message(msg)
+                plugin, result = await find_reply(msg)
                 if result:
-                    return result
+                    schedule_reply(msg, result, reply_delay(plugin))
             except Exception as e:
-                print(f"Error in plugin {plugin.__name__ if hasattr(plugin, '__name__') else plugin} handle_message: {e}")
-    
-    return None
\ No newline at end of file
+                print(f"处理群 {group_id} 消息失败: {e}")
+            # 从收到消息到回复生成（或确定不回复）的耗时，不含拟人化等待
+            metrics.observe("message_latency_seconds", time.monotonic() - submitted_at)
+    finally:
+        del _group_workers[group_id]
+        if not queue:
+            del _group_queues[group_id]
+
+
+def is_idle():
+    """没有排队、处理中或等待发送的消息，观察者也已经处理完所有消息（压测时用来等待处理结束）"""
+    return not (_group_queues or _group_workers or _reply_chains or _observer_queue or _observer_pending)
+
+
+def collect_gauges():
+    """调度器和观察者流水线的当前状态，供 metrics 输出"""
+    gauges = {f"scheduler_{name}_total": value for name, value in scheduler_stats.items()}
+    gauges.update({f"observer_{name}": value for name, value in observer_stats.items()})
+    gauges["observer_queue_depth"] = len(_observer_queue)
+    gauges["group_queues_active"] = len(_group_queues)
+    gauges["group_queue_depth_total"] = sum(len(q) for q in _group_queues.values())
+    return gauges
\ No newline at end of file
@@ -0,0 +1,165 @@
+import os
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 进程内指标统计，输出 Prometheus 文本格式
+# 计数器: inc()，耗时: observe() / timer()，其他模块的统计字典通过 register_gauges() 接入
+#
+# 相关设置（写在 .env 中，可选）
+# METRICS_PORT: 大于0时在 127.0.0.1 上开启 http://127.0.0.1:端口/metrics
+# METRICS_DUMP_INTERVAL: 大于0时每隔多少秒把指标打印到控制台
+
+PREFIX = "qqbot_"
+# 每个耗时指标保留最近多少次样本用于计算分位数
+SAMPLE_WINDOW = 2048
+QUANTILES = (0.5, 0.95, 0.99)
+
+_lock = threading.Lock()
+# (指标名, 标签) -> 数值
+_counters = {}
+# (指标名, 标签) -> {"count": 次数, "sum": 总秒数, "samples": 最近的样本}
+_latencies = {}
+# 返回 {指标名: 数值} 的回调函数
+_gauge_sources = []
+
+
+def _key(name, labels):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def inc(name, value=1, **labels):
+    """计数器加 value"""
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, seconds, **labels):
+    """记录一次耗时（秒）"""
+    key = _key(name, labels)
+    with _lock:
+        stats = _latencies.get(key)
+        if stats is None:
+            stats = _latencies[key] = {"count": 0, "sum": 0.0, "samples": deque(maxlen=SAMPLE_WINDOW)}
+        stats["count"] += 1
+        stats["sum"] += seconds
+        stats["samples"].append(seconds)
+
+
+@contextmanager
+def timer(name, **labels):
+    """
+    统计代码块耗时，出现异常时额外计入 {name}_errors_total
+    用法: with metrics.timer("llm_request", model="xxx"): ...
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        inc(f"{name}_errors_total", **labels)
+        raise
+    finally:
+        observe(f"{name}_seconds", time.perf_counter() - start, **labels)
+
+
+def latency_samples(name):
+    """某个耗时指标最近的样本: {标签字典(tuple): [秒, ...]}，供压测报告计算分位数"""
+    with _lock:
+        return {labels: list(stats["samples"]) for (metric, labels), stats in _latencies.items() if metric == name}
+
+
+def register_gauges(source):
+    """注册一个返回 {指标名: 数值} 的函数，每次输出指标时调用"""
+    _gauge_sources.append(source)
+
+
+def quantile(samples, q):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def _format_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+
+def render():
+    """输出 Prometheus 文本格式的全部指标"""
+    lines = []
+    with _lock:
+        counters = sorted(_counters.items())
+        latencies = sorted((key, dict(stats, samples=list(stats["samples"]))) for key, stats in _latencies.items())
+
+    for (name, labels), value in counters:
+        lines.append(f"{PREFIX}{name}{_format_labels(labels)} {value}")
+
+    # 耗时按 Prometheus summary 输出: 分位数（最近 SAMPLE_WINDOW 次） + _count + _sum
+    for (name, labels), stats in latencies:
+        for q in QUANTILES:
+            lines.append(f"{PREFIX}{name}{_format_labels(labels, [('quantile', q)])} {quantile(stats['samples'], q):.6f}")
+        lines.append(f"{PREFIX}{name}_count{_format_labels(labels)} {stats['count']}")
+        lines.append(f"{PREFIX}{name}_sum{_format_labels(labels)} {stats['sum']:.6f}")
+
+    for source in _gauge_sources:
+        try:
+            for name, value in source().items():
+                lines.append(f"{PREFIX}{name} {value}")
+        except Exception as e:
+            print(f"读取指标失败: {e}")
+
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # 不把每次抓取都打印到控制台
+        pass
+
+
+def start_server(port, host="127.0.0.1"):
+    """在后台线程中开启指标 HTTP 服务，只监听本机"""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    print(f"指标服务已启动: http://{host}:{port}/metrics")
+    return server
+
+
+def start_dump(interval):
+    """在后台线程中每隔 interval 秒打印一次指标"""
+    def run():
+        while True:
+            time.sleep(interval)
+            print(render())
+
+    threading.Thread(target=run, name="metrics-dump", daemon=True).start()
+
+
+def init_metrics():
+    """按 .env 中的设置开启指标服务或定时打印"""
+    port = int(os.getenv("METRICS_PORT", "0"))
+    interval = float(os.getenv("METRICS_DUMP_INTERVAL", "0"))
+    if port > 0:
+        try:
+            start_server(port)
+        except OSError as e:
+            print(f"指标服务启动失败: {e}")
+    if interval > 0:
+        start_dump(interval)
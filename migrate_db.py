@@ -0,0 +1,209 @@
+import re
+import sys
+import time
+import sqlite3
+import datetime
+
+# qq_chat.db 结构升级工具
+#
+# v1: messages(group_id, qq_number, content)，昵称和时间拼在 content 里: [#QQ号#][昵称][时间]消息，
+#     机器人的回复是 [AI][QQ BOT]回复，没有任何索引
+# v2: messages 拆出 ts / nickname / is_bot / message_id 列，content 只保存消息本身，
+#     并建立 (group_id, ts) 索引，按群取最近的消息和按时间段查询都是索引范围扫描
+# v3: 新增 pseudonyms 表（匿名 hash -> QQ号），由 pseudonym 插件在启动时补登记已有成员
+#
+# 升级是分批进行的：先把旧表按 rowid 分批解析复制到 messages_v2（每批一个短事务，读连接不受影响，
+# 中断后再次运行会从上次的位置继续），最后在一个事务里补齐剩余的行并替换旧表
+# 用法: python migrate_db.py [数据库文件]，run.py 启动时也会自动检查并升级
+
+SCHEMA_VERSION = 3
+# 每批复制的行数
+MIGRATE_BATCH_SIZE = 5000
+
+BOT_MARK = "[AI][QQ BOT]"
+PACKED_PATTERN = re.compile(r'^\[#(\d+)#\]\[(.*?)\]\[(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})\](.*)$', re.S)
+
+
+def create_messages_table(cursor, table="messages"):
+    """创建 v2 结构的消息表"""
+    cursor.execute(f'''
+    CREATE TABLE IF NOT EXISTS {table} (
+        id INTEGER PRIMARY KEY,
+        group_id INTEGER NOT NULL,
+        qq_number INTEGER,
+        nickname TEXT,
+        ts REAL NOT NULL,
+        is_bot INTEGER NOT NULL DEFAULT 0,
+        message_id TEXT,
+        content TEXT,
+        FOREIGN KEY (group_id) REFERENCES groups(group_id)
+    )
+    ''')
+
+
+def create_indexes(cursor):
+    # 按群取最近的消息: WHERE group_id = ? ORDER BY ts DESC, id DESC LIMIT n（id 即 rowid，索引中自带）
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_group_ts ON messages (group_id, ts)')
+
+
+def create_pseudonyms_table(cursor):
+    """创建匿名 hash -> QQ号 的反查表"""
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS pseudonyms (
+        hash TEXT PRIMARY KEY,
+        qq_number INTEGER NOT NULL
+    )
+    ''')
+
+
+def set_schema_version(cursor, version=SCHEMA_VERSION):
+    cursor.execute('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)')
+    cursor.execute('DELETE FROM schema_version')
+    cursor.execute('INSERT INTO schema_version (version) VALUES (?)', (version,))
+
+
+def create_database_with_tables(db_file):
+    """创建数据库和所有表"""
+    conn = sqlite3.connect(db_file)
+    cursor = conn.cursor()
+    
+    # 删除可能存在的旧表（避免冲突）
+    cursor.execute('DROP TABLE IF EXISTS messages')
+    cursor.execute('DROP TABLE IF EXISTS messages_v2')
+    cursor.execute('DROP TABLE IF EXISTS schema_version')
+    cursor.execute('DROP TABLE IF EXISTS pseudonyms')
+    cursor.execute('DROP TABLE IF EXISTS members')
+    cursor.execute('DROP TABLE IF EXISTS groups')
+    
+    # 重新创建表（最简化结构）
+    cursor.execute('''
+    CREATE TABLE groups (
+        group_id INTEGER PRIMARY KEY
+    )
+    ''')
+    
+    cursor.execute('''
+    CREATE TABLE members (
+        group_id INTEGER,
+        qq_number INTEGER,
+        PRIMARY KEY (group_id, qq_number),
+        FOREIGN KEY (group_id) REFERENCES groups(group_id)
+    )
+    ''')
+    
+    # 消息表使用 v2 结构（带时间、昵称等列和按群按时间的索引）
+    create_messages_table(cursor)
+    create_indexes(cursor)
+    # 匿名 hash -> QQ号 的反查表
+    create_pseudonyms_table(cursor)
+    set_schema_version(cursor)
+    
+    conn.commit()
+    conn.close()
+    print("✅ 数据库创建完成！")
+
+
+def get_schema_version(conn):
+    """读取数据库结构版本，没有版本表的是 v1"""
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+    if 'schema_version' not in tables:
+        return 1
+    row = conn.execute('SELECT version FROM schema_version').fetchone()
+    return row[0] if row else 1
+
+
+def parse_packed(qq_number, content, last_ts):
+    """
+    把 v1 的一行消息解析成 (qq_number, nickname, ts, is_bot, content)
+    机器人的回复和无法解析的行没有时间，沿用上一条消息的时间，保证顺序不变
+    """
+    if content is None:
+        return qq_number, None, last_ts, 0, content
+    if content.startswith(BOT_MARK):
+        return qq_number, None, last_ts, 1, content[len(BOT_MARK):]
+    match = PACKED_PATTERN.match(content)
+    if not match:
+        return qq_number, None, last_ts, 0, content
+    qq, nickname, time_str, text = match.groups()
+    ts = datetime.datetime.strptime(time_str, '%Y-%m-%d %H:%M:%S').timestamp()
+    return int(qq), nickname, ts, 0, text
+
+
+def _copy_rows(conn, start_rowid, last_ts, limit=None):
+    """把旧表中 rowid > start_rowid 的行解析后写入 messages_v2，返回 (最后的 rowid, 最后的时间, 行数)"""
+    sql = 'SELECT rowid, group_id, qq_number, content FROM messages WHERE rowid > ? ORDER BY rowid'
+    params = (start_rowid,)
+    if limit:
+        sql += ' LIMIT ?'
+        params = (start_rowid, limit)
+    rows = []
+    for rowid, group_id, qq_number, content in conn.execute(sql, params).fetchall():
+        qq_number, nickname, ts, is_bot, content = parse_packed(qq_number, content, last_ts)
+        last_ts = ts
+        rows.append((rowid, group_id, qq_number, nickname, ts, is_bot, content))
+        start_rowid = rowid
+    conn.executemany('INSERT INTO messages_v2 (id, group_id, qq_number, nickname, ts, is_bot, content) '
+                     'VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+    return start_rowid, last_ts, len(rows)
+
+
+def migrate(db_file='qq_chat.db', batch_size=MIGRATE_BATCH_SIZE):
+    """把数据库升级到最新版本，已经是最新版本时什么都不做"""
+    conn = sqlite3.connect(db_file)
+    try:
+        version = get_schema_version(conn)
+        if version >= SCHEMA_VERSION:
+            return False
+        if version < 2:
+            migrate_v2(conn, batch_size)
+        if version < 3:
+            with conn:
+                cursor = conn.cursor()
+                create_pseudonyms_table(cursor)
+                set_schema_version(cursor, 3)
+            print("✅ 数据库已升级到 v3")
+        return True
+    finally:
+        conn.close()
+
+
+def migrate_v2(conn, batch_size=MIGRATE_BATCH_SIZE):
+    """把 v1 的 messages 表分批解析升级到 v2"""
+    print("🔄 正在升级聊天数据库结构到 v2...")
+    start = time.perf_counter()
+    with conn:
+        create_messages_table(conn.cursor(), "messages_v2")
+
+    # 从上次中断的位置继续
+    last_rowid, last_ts = conn.execute('SELECT COALESCE(MAX(id), 0), COALESCE(MAX(ts), 0) FROM messages_v2').fetchone()
+    total = 0
+    while True:
+        with conn:
+            last_rowid, last_ts, count = _copy_rows(conn, last_rowid, last_ts, batch_size)
+        total += count
+        if count < batch_size:
+            break
+        print(f"已升级 {total} 条消息")
+
+    # 最后一步加写锁：补上复制期间新写入的行，再替换旧表
+    conn.isolation_level = None
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        last_rowid, last_ts, count = _copy_rows(conn, last_rowid, last_ts)
+        total += count
+        conn.execute('DROP TABLE messages')
+        conn.execute('ALTER TABLE messages_v2 RENAME TO messages')
+        cursor = conn.cursor()
+        create_indexes(cursor)
+        set_schema_version(cursor, 2)
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.isolation_level = ''
+    print(f"✅ 数据库升级完成，共 {total} 条消息，耗时 {time.perf_counter() - start:.1f} 秒")
+
+
+if __name__ == "__main__":
+    migrate(sys.argv[1] if len(sys.argv) > 1 else 'qq_chat.db')
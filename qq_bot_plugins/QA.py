@@ -1,11 +1,10 @@
 import os
 import json
-import time
-import random
 import sys
 
 # 添加当前目录到Python路径，确保可以导入同目录模块
-sys.path.append(os.path.dirname(__file__))
+if os.path.dirname(__file__) not in sys.path:
+    sys.path.append(os.path.dirname(__file__))
 from text_classification import classification
 from ncatbot.core import GroupMessage
 
@@ -19,6 +18,12 @@ plugin_enabled = True
 
 PRIORITY = 3
 
+# 回复前随机等待的秒数范围，模拟真人打字，由调度器在发送时异步等待
+REPLY_DELAY = (0.5, 2)
+
+# 工作类型: 向量编码属于计算密集型，使用 cpu 线程池
+WORK_KIND = "cpu"
+
 HELP = """问答系统命令:
 /ask 问题 - 向问答系统提问"""
 
@@ -31,67 +36,65 @@ SYS_HELP = """问答系统命令:
 /add_del - 删除所有问答对
 /bind_del - 删除所有绑定群聊"""
 
-def handle_message(msg: GroupMessage):
-    """处理群消息"""
-    if not plugin_enabled:
+def is_root(msg: GroupMessage):
+    return msg.user_id == os.getenv("ROOT_QQ")
+
+def cmd_add_del(msg: GroupMessage):
+    """/add_del - 删除所有问答对"""
+    if not is_root(msg):
+        return None
+    if os.path.exists("qa.json"):
+        os.remove("qa.json")
+    return "已删除问答对", True, None
+
+def cmd_bind_del(msg: GroupMessage):
+    """/bind_del - 删除所有绑定群聊"""
+    if not is_root(msg):
+        return None
+    if os.path.exists("bind_qa.json"):
+        os.remove("bind_qa.json")
+    return "已删除群聊绑定", True, None
+
+def cmd_add(msg: GroupMessage):
+    """/add 问题 答案 - 添加问答对"""
+    if not is_root(msg):
         return None
-    
-    raw_msg = msg.raw_message.strip()
-    
-    # 处理问答系统命令
-    
-    if "/add_del" in raw_msg:
-        time.sleep(random.uniform(0.5, 2))
-        if msg.user_id == os.getenv("ROOT_QQ"):
-            if os.path.exists("qa.json"):
-                os.remove("qa.json")
-            return "已删除问答对", True, None
-        else:
-            return None
-    
-    elif "/bind_del" in raw_msg:
-        time.sleep(random.uniform(0.5, 2))
-        if msg.user_id == os.getenv("ROOT_QQ"):
-            if os.path.exists("bind_qa.json"):
-                os.remove("bind_qa.json")
-            return "已删除群聊绑定", True, None
-        else:
-            return None
-    elif "/add" in raw_msg:
-        time.sleep(random.uniform(0.5, 2))
-        if msg.user_id == os.getenv("ROOT_QQ"):
-            add_qa(raw_msg)
-            return "已保存问答对", True, None
-        else:
-            return None
-    
-    elif "/query_add" in raw_msg:
-        time.sleep(random.uniform(0.5, 2))
-        if msg.user_id == os.getenv("ROOT_QQ"):
-            return str(query_add()), True, None
-        else:
-            return None
-    
-    elif "/bindqa" in raw_msg:
-        time.sleep(random.uniform(0.5, 2))
-        if msg.user_id == os.getenv("ROOT_QQ"):
-            bind_qa(raw_msg.replace("self", str(msg.group_id)))
-            return "已绑定", True, None
-        else:
-            return None
-    
-    elif "/query_bind" in raw_msg:
-        time.sleep(random.uniform(0.5, 2))
-        if msg.user_id == os.getenv("ROOT_QQ"):
-            return str(query_bind()), True, None
-        else:
-            return None
-    
-    elif "/ask" in raw_msg:
-        time.sleep(random.uniform(0.5, 2))
-        return ask_qa(msg), True, None
-    
-    return None
+    add_qa(msg.raw_message.strip())
+    return "已保存问答对", True, None
+
+def cmd_query_add(msg: GroupMessage):
+    """/query_add - 查询所有问答对"""
+    if not is_root(msg):
+        return None
+    return str(query_add()), True, None
+
+def cmd_bindqa(msg: GroupMessage):
+    """/bindqa self - 绑定当前群聊"""
+    if not is_root(msg):
+        return None
+    bind_qa(msg.raw_message.strip().replace("self", str(msg.group_id)))
+    return "已绑定", True, None
+
+def cmd_query_bind(msg: GroupMessage):
+    """/query_bind - 查询所有绑定群聊"""
+    if not is_root(msg):
+        return None
+    return str(query_bind()), True, None
+
+def cmd_ask(msg: GroupMessage):
+    """/ask 问题 - 向问答系统提问"""
+    return ask_qa(msg), True, None
+
+# 插件命令表: 命令 -> 处理函数
+COMMANDS = {
+    "/add_del": cmd_add_del,
+    "/bind_del": cmd_bind_del,
+    "/add": cmd_add,
+    "/query_add": cmd_query_add,
+    "/bindqa": cmd_bindqa,
+    "/query_bind": cmd_query_bind,
+    "/ask": cmd_ask,
+}
 
 def add_qa(raw_message:str):
     parts = raw_message.strip().split("|")
@@ -1,13 +1,19 @@
-import random
 import faiss
 import numpy as np
 import os
 import sqlite3
-import onnxruntime
-import time
-from tokenizers import BertWordPieceTokenizer
+import sys
+import threading
 from ncatbot.core import GroupMessage
 
+# 添加当前插件目录到Python路径，确保可以导入同目录模块
+if os.path.dirname(__file__) not in sys.path:
+    sys.path.append(os.path.dirname(__file__))
+# 与问答匹配共用同一个编码服务
+from sentence_encoder import get_encoder
+import metrics
+import brain
+
 # 插件信息
 PLUGIN_NAME = "聊天记录查询插件"
 PLUGIN_VERSION = "1.0.0"
@@ -19,107 +25,152 @@ plugin_enabled = True
 # 插件优先级 (数值越小优先级越高，默认100)
 PRIORITY = 2
 
+# 回复前随机等待的秒数范围，模拟真人打字，由调度器在发送时异步等待
+REPLY_DELAY = (1, 3)
+
+# 工作类型: 向量编码属于计算密集型，使用 cpu 线程池
+WORK_KIND = "cpu"
+
 HELP = """聊天记录查询命令:
 /query 查询词 - 查询聊天记录"""
 
-# ================= ONNX 模型封装 (保留并微调) =================
-
-class ONNXSentenceEncoder:
-    def __init__(self, model_path, vocab_path, max_seq_len=128):
-        # 强制使用 CPU 提高兼容性
-        self.session = onnxruntime.InferenceSession(model_path, providers=['CPUExecutionProvider'])
-        self.tokenizer = BertWordPieceTokenizer(vocab=vocab_path, lowercase=True)
-        self.max_seq_len = max_seq_len
-        self.input_names = [inp.name for inp in self.session.get_inputs()]
-
-    def _tokenize(self, text):
-        encoded = self.tokenizer.encode(text)
-        ids = encoded.ids[:self.max_seq_len]
-        mask = encoded.attention_mask[:self.max_seq_len]
-        p_len = self.max_seq_len - len(ids)
-        return np.array([ids + [0]*p_len], dtype=np.int64), \
-               np.array([mask + [0]*p_len], dtype=np.int64)
-
-    def encode(self, texts):
-        if isinstance(texts, str): texts = [texts]
-        embeddings = []
-        for text in texts:
-            input_ids, attention_mask = self._tokenize(text)
-            inputs = {"input_ids": input_ids, "attention_mask": attention_mask}
-            # 兼容你的模型输入名
-            if "token_type_ids" in self.input_names:
-                inputs["token_type_ids"] = np.zeros_like(input_ids)
-            
-            outputs = self.session.run(None, inputs)
-            last_hidden_state = outputs[0]
-            # 池化操作
-            mask_expanded = np.expand_dims(attention_mask, axis=-1).astype(float)
-            sentence_embedding = np.sum(last_hidden_state * mask_expanded, axis=1) / np.clip(mask_expanded.sum(axis=1), 1e-9, None)
-            # 归一化
-            norm = np.linalg.norm(sentence_embedding, axis=1, keepdims=True)
-            embeddings.append((sentence_embedding / norm)[0])
-        return np.array(embeddings).astype('float32')
-
-# ================= 2. 数据库逻辑 (路径优化版) =================
+# ================= 数据库逻辑 (路径优化版) =================
 
 # --- 配置路径 ---
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 # 定位到上一级目录
 PARENT_DIR = os.path.dirname(SCRIPT_DIR)
-ONNX_DIR = os.path.join(SCRIPT_DIR, "onnx_models")
 
 # 为文件增加标识性前缀，防止冲突，并存储在上一级目录
 FAISS_INDEX_PATH = os.path.join(PARENT_DIR, "qq_bot_vector_space.index")
 SQLITE_DB_PATH = os.path.join(PARENT_DIR, "qq_bot_message_data.db")
 
-# 初始化模型
-encoder = ONNXSentenceEncoder(
-    os.path.join(ONNX_DIR, "model.onnx"), 
-    os.path.join(ONNX_DIR, "vocab.txt")
-)
+def load_vector_index():
+    """
+    从文件加载 Faiss 索引，文件不存在时为 None（第一次写入时再按向量维度创建）
+    索引中每个向量的编号就是它在 group_msg_records 中的 row_id
+    旧版本的索引（IndexFlatL2，向量的位置就是 row_id）加载时转换成按编号保存的 IndexIDMap
+    """
+    prepare_records_table()
+    index = faiss.read_index(FAISS_INDEX_PATH) if os.path.exists(FAISS_INDEX_PATH) else None
+    if index is not None and not isinstance(index, faiss.IndexIDMap):
+        index = to_id_map(index)
+    # unmarked: 已经加入索引、但还没在 SQLite 中标记为已写入的 row_id
+    return {"index": index, "lock": threading.Lock(), "unmarked": set()}
+
+def to_id_map(flat_index):
+    """把按位置编号的旧索引转换成 IndexIDMap，编号不变"""
+    id_map = faiss.IndexIDMap(faiss.IndexFlatL2(flat_index.d))
+    if flat_index.ntotal:
+        id_map.add_with_ids(flat_index.reconstruct_n(0, flat_index.ntotal), np.arange(flat_index.ntotal, dtype="int64"))
+    return id_map
+
+def prepare_records_table():
+    """创建或升级 group_msg_records 表: 按 (群号, 消息ID) 去重，indexed 标记向量是否已经写入索引"""
+    conn = sqlite3.connect(SQLITE_DB_PATH)
+    conn.execute("CREATE TABLE IF NOT EXISTS group_msg_records "
+                 "(row_id INTEGER, group_id TEXT, content TEXT, message_id TEXT, indexed INTEGER NOT NULL DEFAULT 0)")
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(group_msg_records)")}
+    if "message_id" not in columns:
+        # 旧版本的表，已有的记录都已经写入了向量索引
+        conn.execute("ALTER TABLE group_msg_records ADD COLUMN message_id TEXT")
+        conn.execute("ALTER TABLE group_msg_records ADD COLUMN indexed INTEGER NOT NULL DEFAULT 1")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_group_msg_records_row_id ON group_msg_records (row_id)")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_group_msg_records_message "
+                 "ON group_msg_records (group_id, message_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_group_msg_records_unindexed "
+                 "ON group_msg_records (row_id) WHERE indexed = 0")
+    conn.commit()
+    conn.close()
+
+def get_vector_index():
+    """
+    常驻内存的 Faiss 索引，不用每次读写都重新读文件
+    保存在 brain 的共享资源中，插件热重载后不会重新加载
+    返回 {"index": 索引或None, "lock": 读写索引时需要持有的锁, "unmarked": 见 load_vector_index}
+    """
+    return brain.shared_resource("faiss_index", load_vector_index)
 
-# 自动获取模型维度
-MODEL_DIM = encoder.encode("test").shape[1]
+def warm_up():
+    """启动后在后台加载向量索引"""
+    get_vector_index()
+
+def add_messages(records):
+    """
+    接收一批消息并存入数据库 (数据存储在上一级目录)
+    :param records: [(group_id, message_id, text), ...]
+    先写入 SQLite，再把还没写入索引的记录按 row_id 加入 Faiss 索引，最后在 SQLite 中标记为已写入
+    整批重试时不会重复写入: 已有的消息（同一个群的同一个消息ID）不再插入，已经在索引中的 row_id 不再加入
+    一批消息只写一次 Faiss 索引文件
+    """
+    if not records:
+        return
+    state = get_vector_index()
+    conn = sqlite3.connect(SQLITE_DB_PATH)
+    try:
+        # 1. 存入 SQLite，row_id 依次递增
+        with metrics.timer("sqlite_write", table="group_msg_records"):
+            conn.executemany(
+                "INSERT OR IGNORE INTO group_msg_records (row_id, group_id, content, message_id, indexed) "
+                "VALUES ((SELECT COALESCE(MAX(row_id), -1) + 1 FROM group_msg_records), ?, ?, ?, 0)",
+                [(str(group_id), text, None if message_id is None else str(message_id))
+                 for group_id, message_id, text in records])
+            conn.commit()
+        # 还没写入索引的记录（包括之前失败的批次留下的）
+        rows = conn.execute("SELECT row_id, content FROM group_msg_records WHERE indexed = 0 ORDER BY row_id").fetchall()
+        if not rows:
+            return
+        with state["lock"]:
+            rows_to_add = [(row_id, text) for row_id, text in rows if row_id not in state["unmarked"]]
+
+        # 2. 向量化
+        vectors = get_encoder().encode([text for row_id, text in rows_to_add]) if rows_to_add else None
+
+        # 3. 存入 Faiss，向量的编号就是 row_id
+        with metrics.timer("faiss_write"), state["lock"]:
+            # 编码期间其他批次可能已经加入了同样的记录
+            keep = [i for i, (row_id, text) in enumerate(rows_to_add) if row_id not in state["unmarked"]]
+            if keep:
+                if state["index"] is None:
+                    # 维度直接取自向量，不需要额外编码一次探测
+                    state["index"] = faiss.IndexIDMap(faiss.IndexFlatL2(vectors.shape[1]))
+                ids = np.array([rows_to_add[i][0] for i in keep], dtype="int64")
+                state["index"].add_with_ids(np.ascontiguousarray(vectors[keep]), ids)
+                state["unmarked"].update(int(row_id) for row_id in ids)
+            if state["index"] is None:
+                return
+            faiss.write_index(state["index"], FAISS_INDEX_PATH)
+            written = {row_id for row_id, text in rows if row_id in state["unmarked"]}
+
+        # 4. 标记为已写入索引
+        with metrics.timer("sqlite_write", table="group_msg_records"):
+            conn.executemany("UPDATE group_msg_records SET indexed = 1 WHERE row_id = ?", [(row_id,) for row_id in written])
+            conn.commit()
+        with state["lock"]:
+            state["unmarked"] -= written
+    finally:
+        conn.close()
 
 def add_message(group_id, text):
     """
     接收消息并存入数据库 (数据存储在上一级目录)
     """
-    # 1. 向量化
-    vector = encoder.encode(text)
-    
-    # 2. 存入 Faiss
-    if os.path.exists(FAISS_INDEX_PATH):
-        index = faiss.read_index(FAISS_INDEX_PATH)
-    else:
-        index = faiss.IndexFlatL2(MODEL_DIM)
-    
-    row_id = index.ntotal 
-    index.add(vector)
-    faiss.write_index(index, FAISS_INDEX_PATH)
-    
-    # 3. 存入 SQLite
-    conn = sqlite3.connect(SQLITE_DB_PATH)
-    cursor = conn.cursor()
-    # 增加表名标识度
-    cursor.execute("CREATE TABLE IF NOT EXISTS group_msg_records (row_id INTEGER, group_id TEXT, content TEXT)")
-    cursor.execute("INSERT INTO group_msg_records VALUES (?, ?, ?)", (row_id, str(group_id), text))
-    conn.commit()
-    conn.close()
+    add_messages([(group_id, None, text)])
 
 def search_message(group_id, query_text, top_k=5):
     """
     在指定群聊内搜索最相似的消息
     """
-    if not os.path.exists(FAISS_INDEX_PATH):
+    state = get_vector_index()
+    if state["index"] is None:
         return []
 
     # 1. 查询向量化
-    query_vector = encoder.encode(query_text)
+    query_vector = get_encoder().encode(query_text)
     
     # 2. Faiss 检索
-    index = faiss.read_index(FAISS_INDEX_PATH)
-    distances, indices = index.search(query_vector, 100) 
+    with state["lock"]:
+        distances, indices = state["index"].search(query_vector, 100) 
     
     # 3. SQLite 过滤群号
     conn = sqlite3.connect(SQLITE_DB_PATH)
@@ -139,27 +190,28 @@ def search_message(group_id, query_text, top_k=5):
     conn.close()
     return final_results
 
-def handle_message(msg: GroupMessage):
+def query_messages(msg: GroupMessage):
     """
-    处理群消息
+    处理 /query 命令
     返回值格式: (回复内容, 是否@发送者, 图片路径)
-    如果不需要回复，返回 None
     """
-    if not plugin_enabled:
-        return None
-    
     raw_msg = msg.raw_message.strip()
-    if "/query" in raw_msg:
-        time.sleep(random.uniform(1, 3))
-        query_text = raw_msg.replace("/query", "").strip()
-        add_message(msg.group_id, raw_msg)
-        if query_text:
-            results = search_message(msg.group_id, query_text)
-            if results:
-                reply = "检索内容:\n" + "\n".join([f"{i+1}.{t}" for i, t in enumerate(results)])
-                return reply, True, None
-            else:
-                return "没有找到相关消息", True, None
+    query_text = raw_msg.replace("/query", "").strip()
+    if query_text:
+        results = search_message(msg.group_id, query_text)
+        if results:
+            reply = "检索内容:\n" + "\n".join([f"{i+1}.{t}" for i, t in enumerate(results)])
+            return reply, True, None
         else:
-            return "请输入查询内容", True, None
-    add_message(msg.group_id, raw_msg)
\ No newline at end of file
+            return "没有找到相关消息", True, None
+    else:
+        return "请输入查询内容", True, None
+
+def observe_batch(msgs):
+    """每条群消息都写入向量索引，由观察者流水线批量调用（失败后整批重试，见 add_messages）"""
+    add_messages([(msg.group_id, getattr(msg, "message_id", None), msg.raw_message.strip()) for msg in msgs])
+
+# 插件命令表: 命令 -> 处理函数
+COMMANDS = {
+    "/query": query_messages,
+}
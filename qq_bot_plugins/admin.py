@@ -0,0 +1,76 @@
+from ncatbot.core import GroupMessage
+import os
+import re
+import brain
+
+# 插件信息
+PLUGIN_NAME = "插件管理"
+PLUGIN_VERSION = "1.0.0"
+PLUGIN_DESCRIPTION = "运行时启用、停用和重新加载插件，不需要重启机器人"
+
+# 插件状态
+plugin_enabled = True
+
+# 插件优先级 (数值越小优先级越高，默认100)
+PRIORITY = 0
+
+SYS_HELP = """插件管理命令:
+/plugins - 查看所有插件及状态
+/plugin_on 插件名 - 启用插件
+/plugin_off 插件名 - 停用插件
+/reload 插件名 - 重新加载插件"""
+
+def is_root(msg: GroupMessage):
+    return str(msg.user_id) == os.getenv("ROOT_QQ")
+
+def get_argument(msg: GroupMessage, command: str):
+    return msg.raw_message.strip().replace(command, "", 1).strip()
+
+def list_plugins(msg: GroupMessage):
+    """/plugins - 查看所有插件及状态"""
+    if not is_root(msg):
+        return None
+    lines = [f"{name} (优先级 {priority}) {'启用' if enabled else '停用'}" for name, priority, enabled in brain.list_plugins()]
+    return "插件列表:\n" + "\n".join(lines), True, None
+
+def enable_plugin(msg: GroupMessage):
+    """/plugin_on 插件名 - 启用插件"""
+    if not is_root(msg):
+        return None
+    name = get_argument(msg, "/plugin_on")
+    if not brain.set_plugin_enabled(name, True):
+        return f"没有找到插件 {name}", True, None
+    return f"已启用插件 {name}", True, None
+
+def disable_plugin(msg: GroupMessage):
+    """/plugin_off 插件名 - 停用插件"""
+    if not is_root(msg):
+        return None
+    name = get_argument(msg, "/plugin_off")
+    if name == "admin":
+        return "不能停用插件管理插件", True, None
+    if not brain.set_plugin_enabled(name, False):
+        return f"没有找到插件 {name}", True, None
+    return f"已停用插件 {name}", True, None
+
+def reload_plugin(msg: GroupMessage):
+    """/reload 插件名 - 重新加载插件"""
+    if not is_root(msg):
+        return None
+    name = get_argument(msg, "/reload")
+    # 只接受模块名，防止加载插件目录以外的文件
+    if not re.fullmatch(r'[A-Za-z0-9_]+', name) or not os.path.exists(brain.plugin_path(name)):
+        return f"没有找到插件 {name}", True, None
+    if brain.is_helper_module(name):
+        return f"{name} 是插件共用的辅助模块，不能热重载，请重启机器人", True, None
+    if not brain.reload_plugin(name):
+        return f"插件 {name} 重新加载失败，继续使用旧版本", True, None
+    return f"已重新加载插件 {name}", True, None
+
+# 插件命令表: 命令 -> 处理函数
+COMMANDS = {
+    "/plugins": list_plugins,
+    "/plugin_on": enable_plugin,
+    "/plugin_off": disable_plugin,
+    "/reload": reload_plugin,
+}
@@ -1,15 +1,32 @@
 from ncatbot.core import GroupMessage
 import sys
 import os
-import re
 # 添加当前插件目录到Python路径，确保可以导入同目录模块
-sys.path.append(os.path.dirname(__file__))
-from text_classification import classification
+if os.path.dirname(__file__) not in sys.path:
+    sys.path.append(os.path.dirname(__file__))
+from record import recent_dialog, recent_messages, remember, find_message, load_recent
+import reply_gate
+import llm_client
+import llm_gateway
+import context_builder
+import chat_db
+import brain
+import metrics
 import yaml
 from dotenv import load_dotenv
-import sqlite3
-import datetime
 import json
+import time
+import asyncio
+import functools
+
+# 回复缓存依赖句向量模型，模型不可用时不使用缓存
+reply_cache_available = False
+try:
+    import reply_cache
+    reply_cache_available = True
+except Exception as e:
+    print(f"回复缓存不可用: {e}")
+    reply_cache_available = False
 
 # 获取插件目录的绝对路径，然后构建正确的配置文件路径
 plugin_dir = os.path.dirname(os.path.abspath(__file__))
@@ -19,10 +36,17 @@ env_path = os.path.join(project_root, "bot_config", ".env")
 load_dotenv(env_path)
 
 config_path = os.path.join(project_root, "bot_config", "config.yaml")
-with open(config_path, 'r', encoding='utf-8') as f:
-    yaml_config = yaml.safe_load(f)
+# 机器人配置在第一次用到时才读取
+_yaml_config = None
+
+def get_yaml_config():
+    """读取 config.yaml（只读一次）"""
+    global _yaml_config
+    if _yaml_config is None:
+        with open(config_path, 'r', encoding='utf-8') as f:
+            _yaml_config = yaml.safe_load(f)
+    return _yaml_config
 
-SALT = os.getenv("SALT", "salt1245")
 # 插件信息
 PLUGIN_NAME = "ai插件"
 PLUGIN_VERSION = "1.0.0"
@@ -34,6 +58,32 @@ plugin_enabled = True
 # 插件优先级 (数值越小优先级越高，默认100)
 PRIORITY = 11
 
+SYS_HELP = """AI回复缓存命令:
+/cache_clear [关键词] - 删除本群包含关键词的回复缓存，不带关键词时清空本群缓存"""
+
+# 连续消息合并判断: 群里安静 DEBOUNCE_QUIET 秒后（一串消息最多等 DEBOUNCE_MAX_WAIT 秒）才判断是否回复，
+# 等待期间有新消息时把判断交给最新的消息，一串消息只判断一次
+DEBOUNCE_QUIET = 1.5
+DEBOUNCE_MAX_WAIT = 5
+DEBOUNCE_POLL = 0.1
+# 群号 -> {"start": 这一串消息开始等待的时间, "last": 最近一条开始等待的时间, "addressed": 其中是否有消息@或引用了机器人,
+#         "seq": 已经开始等待的消息数，只有最新的一条接着等待}
+_bursts = {}
+# 正在发送流式回复的群: 群号 -> 开始时间；回复异常中断没有清理时，超过 STREAM_MAX_SECONDS 也视为结束
+_streaming = {}
+STREAM_MAX_SECONDS = 120
+
+# 最多参考最近多少条聊天记录（实际条数还受 token 预算限制）
+CONTEXT_MAX_TURNS = 50
+# 一次回复最多进行几轮工具调用
+MAX_TOOL_ROUNDS = 10
+
+# 每个工具的超时（秒）
+TOOL_TIMEOUTS = {
+    "search": 20,
+    "url": 30,
+}
+
 tools = [
   {
     "type": "function",
@@ -64,6 +114,10 @@ tools = [
             "type": "string",
             "description": "URL",
           },
+          "question": {
+            "type": "string",
+            "description": "想从网页中了解的问题（网页太长时只返回相关的段落）",
+          },
         },
         "required": ["url"],
       },
@@ -100,146 +154,304 @@ tools = [
   },
 ]
 
-def hash_qq(qq_number):
-    """Hash QQ number for anonymity"""
-    import hashlib
-    return hashlib.sha256((str(qq_number) + SALT).encode()).hexdigest()[:10]
+def system_prompt():
+    """AI对话的系统提示词，只取决于人设，每次请求完全相同（和工具定义一起作为可缓存的前缀）"""
+    return f"""[Role]
+你是一个专业的QQ群AI助手，扮演群成员角色，具备自然对话能力和工具调用能力。
+
+[Context]
+你身处一个活跃的QQ群环境中，需要以群成员的身份与其他群员进行日常交流互动，解答疑问，参与话题讨论。你的人设为：{get_yaml_config()["persona"]}
+
+[Task]
+1. 以自然、符合群成员语言习惯的方式与群员交流，避免机械化的回复
+2. 解答群员提出的各类问题
+3. 根据对话需要，合理调用可用工具辅助完成任务
+4. 在不确定信息时优先使用工具获取准确答案"""
+
+async def add_message(group_id, parts):
+    """
+    记录机器人的回复，parts 为发出的每一条消息 [(内容, 消息ID)]，等写线程提交后再放进最近消息
+    记下消息 ID 和机器人的QQ号，群员引用机器人的消息时能认出是在和机器人说话
+    （还没加载过的群第一次读取时从数据库加载，先放进内存的话，提交前加载的群会漏掉这条回复）
+    """
+    bot_qq = reply_gate.bot_qq()
+    qq_number = int(bot_qq) if bot_qq.isdigit() else None
+    now = time.time()
+    messages = [chat_db.Message(message_id=message_id, qq_number=qq_number, nickname=None, ts=now, is_bot=1, content=content)
+                for content, message_id in parts]
+    try:
+        await asyncio.wrap_future(chat_db.insert_messages([(group_id, message) for message in messages]))
+    except Exception as e:
+        print(f"记录机器人回复失败: {e}")
+    remember(group_id, messages)
+
+async def ask_should_reply(group_id):
+    """让低成本模型判断是否需要回复，请求失败时返回 None"""
+    dialog = recent_dialog(group_id, 5)
+    cleaned = " ".join([n["content"] for n in dialog])
+    try:
+        response = await llm_gateway.request(
+            "cheap", "gate", group_id,
+            model=os.getenv("LOW_COST_MODEL"),
+            messages=[{
+                "role": "user",
+                "content": "请判断以下群聊中，机器人是否有必要回话？如果需要，请回复y，否则输出简短原因，不要输出其他内容：" + cleaned,
+            }],
+        )
+        answer = response.choices[0].message.content
+    except Exception as e:
+        print(f"判断是否回复失败: {e}")
+        return None
+    print(answer)
+    return answer == "y"
 
+async def wait_for_quiet(group_id, addressed):
+    """
+    等群里安静下来再判断是否回复
+    等待期间有新消息进入群队列、或同一个群有更新的消息也开始等待（没有经过群队列直接调用时）时返回 None，
+    由最新的消息接着等待；否则返回这一串消息中是否有消息明确在和机器人说话
+    机器人的流式回复还没发完时一直等待，回复期间收到的消息在回复之后合并成一次判断
+    """
+    quiet_since = time.monotonic()
+    burst = _bursts.get(group_id)
+    if burst is None or quiet_since - burst["last"] > DEBOUNCE_MAX_WAIT:
+        # 上一串消息的后续消息被其他插件处理掉了，没有走到这里，重新开始
+        burst = _bursts[group_id] = {"start": quiet_since, "addressed": False, "seq": 0}
+    burst["last"] = quiet_since
+    burst["addressed"] = burst["addressed"] or bool(addressed)
+    burst["seq"] += 1
+    seq = burst["seq"]
+    while True:
+        if brain.queued_messages(group_id) or _bursts.get(group_id) is not burst or burst["seq"] != seq:
+            metrics.inc("reply_debounce_total", result="coalesced")
+            return None
+        now = time.monotonic()
+        if is_streaming(group_id):
+            quiet_since = burst["start"] = now
+        elif now - quiet_since >= DEBOUNCE_QUIET or now - burst["start"] >= DEBOUNCE_MAX_WAIT:
+            metrics.inc("reply_debounce_total", result="evaluated")
+            _bursts.pop(group_id, None)
+            return burst["addressed"]
+        # 等待期间不占用 io 并发名额，名额只留给判断和大模型请求；醒来后重新获取名额再检查
+        async with brain.slot_released():
+            await asyncio.sleep(DEBOUNCE_POLL)
 
-def replace_qq_with_hash(content):
-    """Replace [#QQ号#] pattern with [hash:xxx]"""
-    return re.sub(r'\[#(\d+)#\]', lambda m: f"[hash:{hash_qq(m.group(1))}]", content)
+def is_streaming(group_id):
+    """这个群是否有还没发完的流式回复（超过 STREAM_MAX_SECONDS 的视为已经结束）"""
+    started = _streaming.get(group_id)
+    return started is not None and time.monotonic() - started < STREAM_MAX_SECONDS
 
+async def single_part(text):
+    """只有一段的回复（缓存的回复），和模型的回复一样经过 stream_reply 发送和记录"""
+    yield text
 
-def convert_messages_to_dialog(group_id):
-    """将群消息转换为对话格式"""
-    conn = sqlite3.connect('qq_chat.db')
-    cursor = conn.cursor()
-    
-    # 获取群的所有消息（按时间顺序）
-    cursor.execute('SELECT qq_number, content FROM messages WHERE group_id = ? ORDER BY rowid', (group_id,))
-    messages = cursor.fetchall()
-    conn.close()
-    
-    # Convert to dialog format
-    dialog = []
-    for qq, content in messages:
-        content = replace_qq_with_hash(content)
-        
-        if '[AI][QQ BOT]' in content:
-            role = "assistant"
-        else:
-            role = "user"
-        
-        dialog.append({
-            "role": role,
-            "content": content.replace('[AI][QQ BOT]', ''),
-        })
-    
-    return dialog
-
-def add_message(group_id, qq_number, content):
-    """添加消息（现在包含QQ号）"""
-    conn = sqlite3.connect('qq_chat.db')
-    cursor = conn.cursor()
-    cursor.execute('INSERT INTO messages (group_id, qq_number, content) VALUES (?, ?, ?)', 
-                (group_id, qq_number, content))
-    conn.commit()
-    conn.close()
-
-def handle_message(msg: GroupMessage):
+async def stream_reply(group_id, chunks, trigger=None, vector=None):
+    """
+    边接收边产出回复的每一段，发完后把每一段（一条 QQ 消息）记入聊天记录
+    brain.send_reply 发出一段后通过 asend 传回这条消息的 ID，和这一段一起记录
+    trigger / vector 为触发消息及其句向量，完整发出的回复会放进回复缓存（没有 trigger 时不放）
+    """
+    completed = False
+    parts = []
+    try:
+        async for part in chunks:
+            sent = [part, None]
+            parts.append(sent)
+            sent[1] = yield part
+        completed = True
+    finally:
+        try:
+            await chunks.aclose()
+            # 和 brain.send_reply 一样，空白的段不会发出
+            sent_parts = [(part.strip(), message_id) for part, message_id in parts if part.strip()]
+            if sent_parts:
+                await add_message(group_id, sent_parts)
+        finally:
+            # 回复记入聊天记录之后才结束等待，之后的判断能看到这条回复
+            _streaming.pop(group_id, None)
+        if completed and parts and trigger is not None and reply_cache_available:
+            reply_cache.store(group_id, trigger, "".join(part for part, message_id in parts), vector)
+
+async def run_tool(call, trigger=""):
+    """
+    执行一个工具调用（超时或失败时告诉模型不要再试），返回对应的 tool 消息
+    trigger 为触发这次回复的消息，模型没有给出问题时用它挑选网页中相关的段落
+    """
+    name = call["function"]["name"]
+    try:
+        # arguments 通常是 JSON 字符串
+        args_dict = json.loads(call["function"]["arguments"] or "{}")
+    except ValueError:
+        args_dict = {}
+    print(f"调用工具：{name}，参数：{args_dict}")
+
+    if name == "search":
+        from call_ai_search import search
+        func, args, failed = search, (args_dict.get("query", ""), os.getenv("SEARCH_KEY")), "搜索失败，请不要再次尝试"
+    elif name == "url":
+        from call_ai_url import url_query
+        question = args_dict.get("question") or trigger
+        func, args, failed = url_query, (args_dict.get("url", ""), question), "url查询失败，请不要再次尝试"
+    elif name == "image":
+        return {"role": "tool", "tool_call_id": call["id"], "content": "图片生成还在开发中，请不要再次尝试"}
+    else:
+        return {"role": "tool", "tool_call_id": call["id"], "content": f"没有名为{name}的工具"}
+
+    result = None
+    try:
+        with metrics.timer("tool_call", tool=name):
+            # 超时后不再等待结果（线程中的请求会自己结束）
+            result = await asyncio.wait_for(brain.run_blocking("io", func, *args), TOOL_TIMEOUTS[name])
+    except asyncio.TimeoutError:
+        metrics.inc("tool_timeouts_total", tool=name)
+        print(f"工具 {name} 超时")
+    except Exception as e:
+        print(f"工具 {name} 失败: {e}")
+    print(f"工具 {name} {'成功' if result else '失败'}")
+    content = context_builder.truncate_tool_output(str(result)) if result else failed
+    return {"role": "tool", "tool_call_id": call["id"], "content": content}
+
+async def use_tools(t_chat, tool_calls, trigger, content=None):
+    """
+    并发执行同一轮的所有工具调用，把调用和结果一起放进下一次请求
+    模型选择不回复（pass）或工具调用轮数用完时返回 False
+    content 为模型在调用工具之前已经回复的文本
+    """
+    names = [call["function"]["name"] for call in tool_calls]
+    print(f"本轮调用工具：{names}")
+    if "pass" in names:
+        print("pass")
+        return False
+    if sum(1 for m in t_chat if m.get("tool_calls")) >= MAX_TOOL_ROUNDS:
+        print(f"工具调用超过 {MAX_TOOL_ROUNDS} 轮，不再继续")
+        return False
+    t_chat.append({"role": "assistant", "content": content, "tool_calls": tool_calls})
+    t_chat.extend(await asyncio.gather(*(run_tool(call, trigger) for call in tool_calls)))
+    return True
+
+async def next_reply(group_id, t_chat, trigger):
+    """
+    请求模型，执行它调用的工具，直到它开始回复文本，返回按句产出的回复（llm_client.ReplyStream）
+    模型选择不回复、工具调用轮数用完或请求失败时返回 None
+    失败重试由 llm_gateway 处理（退避、限流、熔断）
+    """
+    while True:
+        try:
+            # 计时到能确定是调用工具还是开始回复为止
+            tool_calls, chunks = await llm_gateway.request(
+                "main", "chat", group_id,
+                prepare=llm_client.start_stream,
+                model=os.getenv("MODEL"),
+                messages=t_chat,
+                tools=tools,
+                tool_choice="auto",
+                stream=True,
+            )
+        except Exception as e:
+            print(f"AI回复失败: {e}")
+            return None
+        if not tool_calls:
+            return chunks
+        if not await use_tools(t_chat, tool_calls, trigger):
+            return None
+
+async def reply_parts(group_id, t_chat, chunks, trigger):
+    """逐段产出回复；模型先回复了一段文本再调用工具时，执行完工具后接着产出下一次请求的回复"""
+    while chunks is not None:
+        text = []
+        try:
+            async for part in chunks:
+                text.append(part)
+                yield part
+        finally:
+            await chunks.aclose()
+        if not chunks.tool_calls or not await use_tools(t_chat, chunks.tool_calls, trigger, "".join(text)):
+            return
+        chunks = await next_reply(group_id, t_chat, trigger)
+
+async def handle_message(msg: GroupMessage):
     """
     处理群消息
-    返回值格式: (回复内容, 是否@发送者, 图片路径)
+    返回值格式: (回复内容, 是否@发送者, 图片路径)，回复内容为按句产出的异步迭代器
     如果不需要回复，返回 None
     """
     if not plugin_enabled:
         return None
     
     raw_msg = msg.raw_message.strip()
+    # 这个群的最近消息还没加载过时在 io 线程池中从数据库加载，之后的读取都只访问内存
+    await load_recent(msg.group_id)
 
-    dialog = convert_messages_to_dialog(msg.group_id)[-5:]
-    cleaned = " ".join([n["content"] for n in dialog])
-    try:
-        from openai import OpenAI
-        client_cheap = OpenAI(api_key=os.getenv("LOW_COST_API_KEY"),base_url=os.getenv("LOW_COST_API_URL"))
-    except:
+    # 一串连续的消息只对最后一条做判断；机器人回复期间收到的消息也在回复之后合并成一次判断
+    # 被引用的消息不在最近几条中时，到这个群内存中的最近消息里按消息 ID 查找
+    find = functools.partial(find_message, msg.group_id)
+    addressed = await wait_for_quiet(msg.group_id, reply_gate.addressed_to_bot(raw_msg, recent_messages(msg.group_id, 5), find))
+    if addressed is None:
         return None
-    response = client_cheap.chat.completions.create(
-        model=os.getenv("LOW_COST_MODEL"),
-        messages=[{
-            "role": "user",
-            "content": "请判断以下群聊中，机器人是否有必要回话？如果需要，请回复y，否则输出简短原因，不要输出其他内容：" + cleaned,
-        }],
-    )
-    print(response.choices[0].message.content)
-    if response.choices[0].message.content == "y":
-        # ai回答
-        prompt = f"""[Role]
-你是一个专业的QQ群AI助手，扮演群成员角色，具备自然对话能力和工具调用能力。
-
-[Context]
-你身处一个活跃的QQ群环境中，需要以群成员的身份与其他群员进行日常交流互动，解答疑问，参与话题讨论。你的人设为：{yaml_config["persona"]}
 
-[Task]
-1. 以自然、符合群成员语言习惯的方式与群员交流，避免机械化的回复
-2. 解答群员提出的各类问题
-3. 根据对话需要，合理调用可用工具辅助完成任务
-4. 在不确定信息时优先使用工具获取准确答案"""
-        t_chat = convert_messages_to_dialog(msg.group_id)[-15:]
-        t_chat.insert(0, {"role": "system", "content": prompt})
-        t_chat.append({"role": "user", "content": "现在请回复最新的消息并参考之前的消息"})
-        client = OpenAI(api_key=os.getenv("API_KEY"),base_url=os.getenv("API_URL"))
-        for i in range(10):
+    # 先在本地判断，有把握时不用再问低成本模型（句向量编码放进 cpu 线程池）
+    local, features = await brain.run_blocking("cpu", reply_gate.decide, raw_msg, recent_messages(msg.group_id, 5), find)
+    if addressed and not local:
+        # 这一串消息中有人@或引用了机器人
+        local = True
+        features["burst_addressed"] = True
+    should_reply = local
+    if local is None:
+        should_reply = await ask_should_reply(msg.group_id)
+        if should_reply is None:
+            return None
+    # 记录判断结果，用于以后重新训练本地模型
+    reply_gate.log_decision(msg.group_id, reply_gate.plain_text(raw_msg), features,
+                            local, None if local is not None else should_reply)
+    if should_reply:
+        # 相似的问题最近回答过时直接使用缓存的回复
+        trigger = reply_gate.plain_text(raw_msg)
+        vector = None
+        if reply_cache_available:
             try:
-                response = client.chat.completions.create(
-                    model=os.getenv("MODEL"),
-                    messages=t_chat,
-                    tools=tools,
-                    tool_choice="auto"
-                )
-                if hasattr(response.choices[0].message, "tool_calls") and response.choices[0].message.tool_calls:
-                    call = response.choices[0].message.tool_calls[0]           # 只取第一个调用
-                    func_call = call.function
-
-                    # arguments 通常是 JSON 字符串
-                    args_dict = json.loads(func_call.arguments)
-
-                    print(f"调用工具：{func_call.name}，参数：{args_dict}")
-
-                    t_chat.append({"role": "assistant", "tool_calls": response.choices[0].message.tool_calls})
-                    if func_call.name == "pass":
-                        print("pass")
-                        return None
-                    elif func_call.name == "search":
-                        from call_ai_search import search
-                        search_result = search(args_dict["query"], os.getenv("SEARCH_KEY"))
-                        if search_result:
-                            t_chat.append({"role": "tool", "tool_call_id": call.id, "content": str(search_result)})
-                            print("搜索成功")
-                        else:
-                            t_chat.append({"role": "tool", "tool_call_id": call.id, "content": "搜索失败，请不要再次尝试"})
-                            print("搜索失败")
-                    elif func_call.name == "url":
-                        from call_ai_url import url_query
-                        url_result = url_query(args_dict["url"])
-                        if url_result:
-                            t_chat.append({"role": "tool", "tool_call_id": call.id, "content": str(url_result)})
-                            print("url查询成功")
-                        else:
-                            t_chat.append({"role": "tool", "tool_call_id": call.id, "content": "url查询失败，请不要再次尝试"})
-                            print("url查询失败")
-                    elif func_call.name == "image":
-                        t_chat.append({"role": "tool", "tool_call_id": call.id, "content": "图片生成还在开发中，请不要再次尝试"})
-                else:
-                    add_message(msg.group_id, msg.user_id, "[AI][QQ BOT]" + response.choices[0].message.content)
-                    return response.choices[0].message.content, False, None
+                cached, vector = await brain.run_blocking("cpu", reply_cache.lookup, msg.group_id, trigger)
             except Exception as e:
-                print({e})
-                continue
+                print(f"查询回复缓存失败: {e}")
+                cached = None
+            if cached:
+                # 发出后再记入聊天记录，记下消息 ID；记录之前这个群的新消息先不判断
+                _streaming[msg.group_id] = time.monotonic()
+                return stream_reply(msg.group_id, single_part(cached)), False, None
+
+        # ai回答：系统提示词固定放在最前面，聊天记录按 token 预算从最新的往前放
+        t_chat = context_builder.build_messages(
+            [{"role": "system", "content": system_prompt()}],
+            recent_dialog(msg.group_id, CONTEXT_MAX_TURNS),
+            [{"role": "user", "content": "现在请回复最新的消息并参考之前的消息"}],
+        )
+        chunks = await next_reply(msg.group_id, t_chat, trigger)
+        if chunks is None:
+            return None
+        # 回复按句发送，发完之前这个群的新消息先不判断
+        _streaming[msg.group_id] = time.monotonic()
+        return stream_reply(msg.group_id, reply_parts(msg.group_id, t_chat, chunks, trigger),
+                            trigger, vector), False, None
     
     return None
 
+def is_root(msg: GroupMessage):
+    return str(msg.user_id) == os.getenv("ROOT_QQ")
+
+def clear_cache(msg: GroupMessage):
+    """/cache_clear [关键词] - 删除本群问题或回复中包含关键词的缓存，不带关键词时清空本群缓存"""
+    if not is_root(msg):
+        return None
+    if not reply_cache_available:
+        return "回复缓存不可用", True, None
+    keyword = msg.raw_message.strip().replace("/cache_clear", "", 1).strip()
+    removed = reply_cache.get_cache().invalidate(msg.group_id, keyword)
+    return f"已删除 {removed} 条回复缓存", True, None
+
+# 插件命令表: 命令 -> 处理函数
+COMMANDS = {
+    "/cache_clear": clear_cache,
+}
+
 # 插件初始化检查
 if __name__ == "__main__":
     print("问答系统插件测试:")
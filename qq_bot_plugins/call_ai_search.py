@@ -1,13 +1,193 @@
+import os
+import sys
+import json
+import time
+import sqlite3
+import threading
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import Future
 from tavily import TavilyClient
 
-def search(text: str,key: str):
-    client = TavilyClient(key)
-    for i in range(3):
+# 添加当前插件目录到Python路径，确保可以导入同目录模块
+if os.path.dirname(__file__) not in sys.path:
+    sys.path.append(os.path.dirname(__file__))
+import metrics
+import brain
+
+# AI对话的搜索工具（Tavily）
+# 同一个问题在多个群里被问到时只搜索一次: 结果按规范化后的查询词缓存在内存（LRU）和磁盘（SQLite）中，
+# 过期前直接使用；同时进行的相同查询只发出一次请求，其他调用等待它的结果
+# 在 io 线程池中调用（见 call_ai.run_tool）
+#
+# 相关设置（写在 .env 中，可选）
+# SEARCH_CACHE_TTL: 搜索结果的有效期（秒），默认 3600
+# SEARCH_CACHE_SIZE: 内存中最多缓存的查询数，默认 256
+# SEARCH_CACHE_DISK_SIZE: 磁盘上最多缓存的查询数，默认 5000
+
+CACHE_FILE = os.path.join("bot_config", "search_cache.db")
+# 搜索失败时的重试次数和第一次重试前的等待（秒），之后每次翻倍
+SEARCH_RETRIES = 3
+RETRY_DELAY = 0.5
+# 等待其他线程的相同查询最多多少秒
+SHARED_WAIT = 30
+
+
+def setting(name, default):
+    return type(default)(os.getenv(name, str(default)))
+
+
+def normalize(query):
+    """规范化查询词: 全角转半角、英文小写、合并空白"""
+    return " ".join(unicodedata.normalize("NFKC", query).lower().split())
+
+
+class SearchCache:
+    """内存 LRU + 磁盘缓存，以及正在进行中的查询"""
+    def __init__(self, cache_file=CACHE_FILE):
+        self._lock = threading.Lock()
+        # 查询词 -> (搜索时间, 结果)，按最近使用的顺序排列
+        self._memory = OrderedDict()
+        # 查询词 -> Future，同一个查询只有第一个调用真正去搜索
+        self._inflight = {}
+        self._conn = None
         try:
-            response = client.search(
-                query=text
-            )
-            return response
-        except:
-            continue
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            self._conn = sqlite3.connect(cache_file, check_same_thread=False)
+            with self._conn:
+                self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS search_cache (
+                    query TEXT PRIMARY KEY,
+                    created REAL NOT NULL,
+                    result TEXT NOT NULL
+                )
+                ''')
+        except sqlite3.Error as e:
+            print(f"搜索缓存文件不可用，只使用内存缓存: {e}")
+            self._conn = None
+
+    def _remember(self, query, created, result):
+        self._memory[query] = (created, result)
+        self._memory.move_to_end(query)
+        while len(self._memory) > setting("SEARCH_CACHE_SIZE", 256):
+            self._memory.popitem(last=False)
+
+    def _get(self, query):
+        """返回 (结果, 来源 memory/disk)，没有或已过期时返回 (None, None)，调用方持有锁"""
+        now = time.time()
+        ttl = setting("SEARCH_CACHE_TTL", 3600)
+        entry = self._memory.get(query)
+        if entry is not None:
+            if now - entry[0] <= ttl:
+                self._memory.move_to_end(query)
+                return entry[1], "memory"
+            del self._memory[query]
+        if self._conn is None:
+            return None, None
+        row = self._conn.execute('SELECT created, result FROM search_cache WHERE query = ?', (query,)).fetchone()
+        if row is None or now - row[0] > ttl:
+            return None, None
+        result = json.loads(row[1])
+        self._remember(query, row[0], result)
+        return result, "disk"
+
+    def get(self, query):
+        with self._lock:
+            return self._get(query)
+
+    def lookup(self, query):
+        """
+        查缓存，没有时加入（或发起）进行中的查询，两步在同一把锁中完成，相同的查询只会有一个去搜索
+        返回 (结果, 来源, Future, 是否由自己搜索):
+        - 命中缓存: (结果, memory/disk, None, False)
+        - 相同的查询正在进行: (None, None, 它的 Future, False)
+        - 需要自己搜索: (None, None, 新的 Future, True)，搜索完后调用 leave
+        """
+        with self._lock:
+            result, layer = self._get(query)
+            if result is not None:
+                return result, layer, None, False
+            future = self._inflight.get(query)
+            if future is not None:
+                return None, None, future, False
+            future = self._inflight[query] = Future()
+            return None, None, future, True
+
+    def put(self, query, result):
+        now = time.time()
+        with self._lock:
+            self._remember(query, now, result)
+            if self._conn is None:
+                return
+            try:
+                with self._conn:
+                    self._conn.execute('INSERT OR REPLACE INTO search_cache (query, created, result) VALUES (?, ?, ?)',
+                                       (query, now, json.dumps(result, ensure_ascii=False)))
+                    # 超出上限时删除最早的结果（过期的也一起清掉）
+                    self._conn.execute('DELETE FROM search_cache WHERE created < ? OR query NOT IN '
+                                       '(SELECT query FROM search_cache ORDER BY created DESC LIMIT ?)',
+                                       (now - setting("SEARCH_CACHE_TTL", 3600), setting("SEARCH_CACHE_DISK_SIZE", 5000)))
+            except (sqlite3.Error, TypeError, ValueError) as e:
+                print(f"写入搜索缓存失败: {e}")
+
+    def leave(self, query):
+        with self._lock:
+            self._inflight.pop(query, None)
+
+
+def get_cache():
+    """获取全局唯一的搜索缓存，插件热重载后仍然保留"""
+    return brain.shared_resource("search_cache", SearchCache)
+
+
+def get_client(key):
+    """每个密钥共用一个 TavilyClient（复用底层的 HTTP 连接）"""
+    clients = brain.shared_resource("tavily_clients", lambda: {"clients": {}, "lock": threading.Lock()})
+    with clients["lock"]:
+        client = clients["clients"].get(key)
+        if client is None:
+            client = clients["clients"][key] = TavilyClient(key)
+    return client
+
+
+def fetch(text, key):
+    """调用 Tavily 搜索，失败时退避重试，都失败时返回 None"""
+    client = get_client(key)
+    for i in range(SEARCH_RETRIES):
+        try:
+            with metrics.timer("search_request"):
+                return client.search(query=text)
+        except Exception as e:
+            print(f"搜索失败（第 {i + 1} 次）: {e}")
+            if i + 1 < SEARCH_RETRIES:
+                time.sleep(RETRY_DELAY * 2 ** i)
     return None
+
+
+def search(text: str, key: str):
+    query = normalize(text)
+    if not query:
+        return None
+    cache = get_cache()
+    result, layer, future, leader = cache.lookup(query)
+    if result is not None:
+        metrics.inc("search_cache_total", result="hit", layer=layer)
+        return result
+    if not leader:
+        # 相同的查询正在进行，等它的结果
+        metrics.inc("search_cache_total", result="shared")
+        try:
+            return future.result(timeout=SHARED_WAIT)
+        except Exception:
+            return None
+
+    metrics.inc("search_cache_total", result="miss")
+    result = None
+    try:
+        result = fetch(text, key)
+        if result is not None:
+            cache.put(query, result)
+    finally:
+        cache.leave(query)
+        future.set_result(result)
+    return result
@@ -1,8 +1,37 @@
-import requests
-import json
+import os
 import re
+import sys
+import json
+import time
+import sqlite3
+import threading
+import urllib.parse
+import requests
+from requests.adapters import HTTPAdapter
 from bs4 import BeautifulSoup
 
+# 添加当前插件目录到Python路径，确保可以导入同目录模块
+if os.path.dirname(__file__) not in sys.path:
+    sys.path.append(os.path.dirname(__file__))
+import metrics
+import brain
+import passage_ranker
+
+# AI对话的网页读取工具
+# - 共用一个 requests.Session，连接池保持长连接
+# - 先看响应头: 图片、视频、压缩包等不支持的类型不下载正文；正文边下载边计数，超过上限就停止
+# - 提取出的文本连同 ETag / Last-Modified 缓存在 bot_config/url_cache.db 中：
+#   有效期内直接使用，过期后带上 If-None-Match / If-Modified-Since 请求，304 时继续使用缓存
+# - 装了 lxml 时用它解析 HTML，比 html.parser 快很多
+# - HTML 只保留正文（去掉导航、页脚、侧栏等），返回前再按问题挑出相关的段落（见 passage_ranker）
+# 在 io 线程池中调用（见 call_ai.run_tool）
+#
+# 相关设置（写在 .env 中，可选）
+# URL_MAX_BYTES: 最多下载的字节数，默认 2000000
+# URL_CACHE_TTL: 缓存多少秒内不再请求，默认 600
+# URL_CACHE_SIZE: 最多缓存的网页数，默认 500
+# URL_POOL_SIZE: 连接池大小，默认 10
+
 # 域名黑名单
 BLACKLIST_DOMAINS = [
     'zhihu.com',
@@ -10,26 +39,326 @@ BLACKLIST_DOMAINS = [
     'zhihu.io'
 ]
 
-def url_query(url):
+# 模拟不同浏览器的User-Agent列表
+USER_AGENTS = [
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.1.1 Safari/605.1.15',
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:89.0) Gecko/20100101 Firefox/89.0'
+]
+
+CACHE_FILE = os.path.join("bot_config", "url_cache.db")
+# (连接超时, 两次读取之间的最长间隔)
+TIMEOUT = (5, 15)
+CHUNK_SIZE = 64 * 1024
+# 除 text/* 以外可以读取的类型
+TEXT_TYPES = ('application/json', 'application/xml', 'application/xhtml+xml', 'application/javascript',
+              'application/rss+xml', 'application/atom+xml')
+CHARSET_PATTERN = re.compile(rb'<meta[^>]+charset=["\']?([\w-]+)', re.I)
+
+# 正文提取: 这些标签和 class/id 像导航、页脚、评论的元素直接去掉
+NOISE_TAGS = ['script', 'style', 'noscript', 'template', 'nav', 'header', 'footer', 'aside', 'form',
+              'iframe', 'svg', 'button', 'select']
+NOISE_PATTERN = re.compile(r'comment|footer|sidebar|side-bar|\bnav|menu|breadcrumb|share|social|related|recommend|'
+                           r'advert|\bads?\b|banner|popup|login|copyright|toolbar|pagination', re.I)
+CONTENT_PATTERN = re.compile(r'article|content|post|entry|main|text|detail|body', re.I)
+# 段落类标签，转成文本时各占一行
+BLOCK_TAGS = ['p', 'div', 'section', 'article', 'main', 'li', 'pre', 'blockquote', 'table', 'tr',
+              'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'br', 'dd', 'dt']
+# 正文至少多少个字，不到时退回整个页面
+MIN_CONTENT_CHARS = 200
+
+# 有 lxml 时用它解析，否则用标准库的 html.parser
+HTML_PARSER = "html.parser"
+try:
+    import lxml
+    HTML_PARSER = "lxml"
+except ImportError:
+    pass
+
+
+def setting(name, default):
+    return type(default)(os.getenv(name, str(default)))
+
+
+def create_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=setting("URL_POOL_SIZE", 10), pool_maxsize=setting("URL_POOL_SIZE", 10))
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_session():
+    """获取共享的 Session，插件热重载后仍然复用原来的连接池"""
+    return brain.shared_resource("url_session", create_session)
+
+
+class UrlCache:
+    """网页文本和校验信息（ETag / Last-Modified）的磁盘缓存"""
+    def __init__(self, cache_file=CACHE_FILE):
+        self._lock = threading.Lock()
+        self._conn = None
+        try:
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            self._conn = sqlite3.connect(cache_file, check_same_thread=False)
+            self._conn.row_factory = sqlite3.Row
+            with self._conn:
+                self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS url_cache (
+                    url TEXT PRIMARY KEY,
+                    fetched REAL NOT NULL,
+                    etag TEXT,
+                    last_modified TEXT,
+                    final_url TEXT,
+                    status_code INTEGER,
+                    content_type TEXT,
+                    truncated INTEGER NOT NULL DEFAULT 0,
+                    content TEXT
+                )
+                ''')
+        except sqlite3.Error as e:
+            print(f"网页缓存文件不可用，不使用缓存: {e}")
+            self._conn = None
+
+    def get(self, url):
+        if self._conn is None:
+            return None
+        with self._lock:
+            row = self._conn.execute('SELECT * FROM url_cache WHERE url = ?', (url,)).fetchone()
+        return dict(row) if row else None
+
+    def put(self, url, entry):
+        if self._conn is None:
+            return
+        with self._lock:
+            try:
+                with self._conn:
+                    self._conn.execute(
+                        'INSERT OR REPLACE INTO url_cache (url, fetched, etag, last_modified, final_url, status_code, '
+                        'content_type, truncated, content) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        (url, entry["fetched"], entry["etag"], entry["last_modified"], entry["final_url"],
+                         entry["status_code"], entry["content_type"], int(entry["truncated"]), entry["content"]))
+                    # 超出上限时删除最早的网页
+                    self._conn.execute('DELETE FROM url_cache WHERE url NOT IN '
+                                       '(SELECT url FROM url_cache ORDER BY fetched DESC LIMIT ?)',
+                                       (setting("URL_CACHE_SIZE", 500),))
+            except sqlite3.Error as e:
+                print(f"写入网页缓存失败: {e}")
+
+    def touch(self, url, fetched):
+        """304 之后刷新缓存时间"""
+        if self._conn is None:
+            return
+        with self._lock:
+            with self._conn:
+                self._conn.execute('UPDATE url_cache SET fetched = ? WHERE url = ?', (fetched, url))
+
+
+def get_cache():
+    """获取全局唯一的网页缓存，插件热重载后仍然保留"""
+    return brain.shared_resource("url_cache", UrlCache)
+
+
+def media_type(content_type):
+    return content_type.split(";", 1)[0].strip().lower()
+
+
+def is_text_type(content_type):
+    """响应是不是可以读取的文本（没有 Content-Type 时先当作可以，下载开头后再判断）"""
+    kind = media_type(content_type)
+    return not kind or kind.startswith("text/") or kind in TEXT_TYPES or kind.endswith("+json") or kind.endswith("+xml")
+
+
+def sniff_type(head):
+    """没有 Content-Type 时根据正文开头猜测类型"""
+    start = head.lstrip()[:512].lower()
+    if start.startswith((b"<!doctype html", b"<html")) or b"<head" in start or b"<body" in start:
+        return "text/html"
+    if start.startswith((b"{", b"[")):
+        return "application/json"
+    if b"\x00" in head[:1024]:
+        return "application/octet-stream"
+    return "text/plain"
+
+
+def read_limited(response, max_bytes):
+    """边下载边计数，最多读 max_bytes 字节，返回 (正文, 是否被截断)"""
+    chunks = []
+    size = 0
+    for chunk in response.iter_content(CHUNK_SIZE):
+        chunks.append(chunk)
+        size += len(chunk)
+        if size >= max_bytes:
+            return b"".join(chunks)[:max_bytes], True
+    return b"".join(chunks), False
+
+
+def decode(body, response):
+    """按响应头或 <meta charset> 中的编码解码，都没有时按 UTF-8（不做耗时的编码猜测）"""
+    encoding = None
+    if "charset=" in response.headers.get("Content-Type", "").lower():
+        encoding = response.encoding
+    if not encoding:
+        match = CHARSET_PATTERN.search(body[:4096])
+        if match:
+            encoding = match.group(1).decode("ascii", "ignore")
+    try:
+        return body.decode(encoding or "utf-8", errors="replace")
+    except LookupError:
+        return body.decode("utf-8", errors="replace")
+
+
+def remove_noise(soup):
+    for tag in soup(NOISE_TAGS):
+        tag.decompose()
+    for tag in soup.find_all(['div', 'section', 'ul', 'ol', 'span', 'table']):
+        if getattr(tag, "decomposed", False) or tag.attrs is None:
+            continue
+        names = " ".join(tag.get("class") or []) + " " + (tag.get("id") or "")
+        if NOISE_PATTERN.search(names) and not CONTENT_PATTERN.search(names):
+            tag.decompose()
+
+
+def link_density(tag, text_length):
+    links = sum(len(a.get_text(strip=True)) for a in tag.find_all('a'))
+    return links / text_length if text_length else 1.0
+
+
+def main_content(soup):
+    """
+    找出正文所在的元素（readability 的简化版）:
+    有 <article> / <main> 时用其中最长的一个；否则给每个段落的父元素和祖父元素累加分数
+    （段落越长、逗号句号越多分越高），按链接密度打折，取分数最高的元素
+    """
+    for tags in (soup.find_all('article'), soup.find_all('main'), soup.find_all(attrs={"role": "main"})):
+        if tags:
+            best = max(tags, key=lambda t: len(t.get_text(strip=True)))
+            if len(best.get_text(strip=True)) >= MIN_CONTENT_CHARS:
+                return best
+
+    scores = {}
+    for paragraph in soup.find_all(['p', 'pre', 'blockquote']):
+        text = paragraph.get_text(" ", strip=True)
+        if len(text) < 25:
+            continue
+        score = 1 + len(re.findall(r'[，,。.、；;]', text)) + min(len(text) // 100, 3)
+        parent = paragraph.parent
+        for ancestor, weight in ((parent, 1.0), (parent.parent if parent else None, 0.5)):
+            if ancestor is None or ancestor.name in ('html', '[document]'):
+                continue
+            entry = scores.setdefault(id(ancestor), [ancestor, 0.0])
+            entry[1] += score * weight
+
+    best, best_score = None, 0.0
+    for tag, score in scores.values():
+        names = " ".join(tag.get("class") or []) + " " + (tag.get("id") or "")
+        if CONTENT_PATTERN.search(names):
+            score *= 1.25
+        score *= 1 - link_density(tag, len(tag.get_text(strip=True)))
+        if score > best_score:
+            best, best_score = tag, score
+    if best is None or len(best.get_text(strip=True)) < MIN_CONTENT_CHARS:
+        return soup.body or soup
+    return best
+
+
+def element_text(tag):
+    """元素的文本，每个段落一行，行内空白合并"""
+    for block in tag.find_all(BLOCK_TAGS):
+        block.append("\n")
+    lines = (re.sub(r'\s+', ' ', line).strip() for line in tag.get_text().split("\n"))
+    return "\n".join(line for line in lines if line)
+
+
+def html_to_text(html):
+    """提取网页正文，标题放在第一行"""
+    soup = BeautifulSoup(html, HTML_PARSER)
+    title = soup.title.get_text(strip=True) if soup.title else ""
+    remove_noise(soup)
+    text = element_text(main_content(soup))
+    if title and not text.startswith(title):
+        text = title + "\n" + text
+    return text
+
+
+def extract_text(text, content_type):
+    """根据内容类型把正文转成纯文本"""
+    kind = media_type(content_type)
+    if kind in ('text/html', 'application/xhtml+xml'):
+        # 对HTML内容进行简单清洗
+        return html_to_text(text)
+    if kind == 'application/json' or kind.endswith('+json'):
+        # JSON内容直接解析
+        try:
+            return json.dumps(json.loads(text), ensure_ascii=False, indent=2)
+        except json.JSONDecodeError:
+            return text
+    # 其他类型内容简单处理
+    return re.sub(r'<[^>]+>', '', text)
+
+
+def fetch(url, headers):
+    """
+    读取网页，返回缓存格式的字典 {"fetched", "etag", "last_modified", "final_url", "status_code",
+    "content_type", "truncated", "content"} 和来源（fresh 缓存未过期 / not_modified 304 / fetched 重新下载）
+    不支持的内容类型抛出 ValueError
+    """
+    cache = get_cache()
+    cached = cache.get(url)
+    now = time.time()
+    if cached and now - cached["fetched"] < setting("URL_CACHE_TTL", 600):
+        return cached, "fresh"
+
+    headers = dict(headers)
+    if cached and cached["etag"]:
+        headers["If-None-Match"] = cached["etag"]
+    if cached and cached["last_modified"]:
+        headers["If-Modified-Since"] = cached["last_modified"]
+
+    with metrics.timer("url_request"):
+        with get_session().get(url, headers=headers, timeout=TIMEOUT, allow_redirects=True, stream=True) as response:
+            if response.status_code == 304 and cached:
+                cache.touch(url, now)
+                cached["fetched"] = now
+                return cached, "not_modified"
+            response.raise_for_status()
+
+            # 先看响应头，不支持的类型不下载正文
+            content_type = response.headers.get('Content-Type', '')
+            if not is_text_type(content_type):
+                raise ValueError(f"不支持的内容类型: {media_type(content_type)}")
+            body, truncated = read_limited(response, setting("URL_MAX_BYTES", 2000000))
+            if not content_type:
+                content_type = sniff_type(body)
+                if not is_text_type(content_type):
+                    raise ValueError("不支持的内容类型: 二进制文件")
+            entry = {
+                "fetched": now,
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+                "final_url": response.url,
+                "status_code": response.status_code,
+                "content_type": content_type,
+                "truncated": truncated,
+                "content": extract_text(decode(body, response), content_type),
+            }
+    cache.put(url, entry)
+    return entry, "fetched"
+
+
+def url_query(url, question=""):
     """
     访问指定URL并返回处理后的内容
-    
+
     参数:
     url (str): 目标URL
-    
+    question (str): 想从网页中了解的问题，内容太长时只返回和问题相关的段落
+
     返回:
     dict: 包含状态、内容和相关信息的字典
     """
-    # 模拟不同浏览器的User-Agent列表
-    USER_AGENTS = [
-        'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-        'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.1.1 Safari/605.1.15',
-        'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:89.0) Gecko/20100101 Firefox/89.0'
-    ]
-    
     try:
         # 黑名单检查
-        import urllib.parse
         parsed_url = urllib.parse.urlparse(url)
         domain = parsed_url.netloc
         for black_domain in BLACKLIST_DOMAINS:
@@ -39,57 +368,33 @@ def url_query(url):
                     "error": "域名在黑名单中，无法访问，请勿尝试继续访问该网站",
                     "url": url
                 }
-        
+
         # 确保URL格式正确
         if not url.startswith(('http://', 'https://')):
             url = 'http://' + url
-        
+
         # 设置请求头
         headers = {
             'User-Agent': USER_AGENTS[hash(url) % len(USER_AGENTS)],  # 基于URL选择相对固定的User-Agent
             'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
             'Accept-Language': 'zh-CN,zh;q=0.8,en-US;q=0.3,en;q=0.2'
         }
-        
-        # 发送请求并获取内容
-        response = requests.get(url, headers=headers, timeout=30, allow_redirects=True)
-        response.raise_for_status()
-        
-        # 获取基本信息
-        content_type = response.headers.get('Content-Type', '')
-        status_code = response.status_code
-        final_url = response.url
-        
-        # 根据内容类型进行适当的处理
-        if 'text/html' in content_type:
-            # 对HTML内容进行简单清洗
-            soup = BeautifulSoup(response.text, 'html.parser')
-            for script in soup(['script', 'style']):
-                script.decompose()
-            text = soup.get_text(separator='\n', strip=True)
-            cleaned_content = re.sub(r'\s+', ' ', text)
-        elif 'application/json' in content_type:
-            # JSON内容直接解析
-            try:
-                json_data = response.json()
-                cleaned_content = json.dumps(json_data, ensure_ascii=False, indent=2)
-            except json.JSONDecodeError:
-                cleaned_content = response.text
-        else:
-            # 其他类型内容简单处理
-            cleaned_content = re.sub(r'<[^>]+>', '', response.text)
-        
+
+        entry, source = fetch(url, headers)
+        metrics.inc("url_fetch_total", result=source)
         return {
             "status": "success",
             "url": url,
-            "final_url": final_url,
-            "status_code": status_code,
-            "content_type": content_type,
-            "content": cleaned_content
+            "final_url": entry["final_url"],
+            "status_code": entry["status_code"],
+            "content_type": entry["content_type"],
+            "truncated": bool(entry["truncated"]),
+            "content": passage_ranker.select_passages(entry["content"] or "", question)
         }
     except Exception as e:
+        metrics.inc("url_fetch_total", result="error")
         return {
             "status": "error",
             "error": str(e),
             "url": url
-        }
\ No newline at end of file
+        }
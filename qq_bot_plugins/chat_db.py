@@ -0,0 +1,243 @@
+import os
+import time
+import queue
+import sqlite3
+import threading
+import datetime
+from collections import OrderedDict, namedtuple
+from concurrent.futures import Future
+import metrics
+import shared
+
+# qq_chat.db 的统一读写入口
+# 写: 所有写操作进入队列，由唯一的后台写线程按数量或时间攒成一个事务提交（group commit）
+# 读: 每个线程各自持有一个只读连接，数据库使用 WAL 模式，读写互不阻塞
+
+DB_FILE = 'qq_chat.db'
+# 一个事务最多包含的写操作数
+WRITE_BATCH_SIZE = 500
+# 收到第一个写操作后最多等待多久再提交（秒）
+WRITE_FLUSH_INTERVAL = 0.2
+# 成员缓存最多保存的 (群号, QQ号) 数量
+MEMBER_CACHE_SIZE = 200000
+
+# messages 表（v2 结构）中的一条消息，brain 中还没落库的消息也转换成同样的格式
+Message = namedtuple("Message", "message_id qq_number nickname ts is_bot content")
+MESSAGE_COLUMNS = "message_id, qq_number, nickname, ts, is_bot, content"
+BOT_MARK = "[AI][QQ BOT]"
+# 写队列中的屏障，代替写语句放进队列，不执行任何操作，它之前的写操作提交后完成
+BARRIER = object()
+
+
+class ChatDBWriter:
+    """qq_chat.db 的唯一写连接，运行在后台线程中"""
+    def __init__(self, db_file=DB_FILE, batch_size=WRITE_BATCH_SIZE, flush_interval=WRITE_FLUSH_INTERVAL):
+        self.db_file = db_file
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._requests = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="chat-db-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, sql, rows):
+        """
+        提交一条写语句及其参数列表，立即返回 Future，事务提交后完成
+        需要确认数据已落库的调用方可以 future.result() 等待
+        """
+        future = Future()
+        self._requests.put((sql, list(rows), future))
+        return future
+
+    def barrier(self):
+        """返回一个 Future，此前提交的写操作全部提交后完成（写线程按提交顺序处理）"""
+        future = Future()
+        self._requests.put((BARRIER, [], future))
+        return future
+
+    def _collect(self):
+        """取出一个写操作，并在 flush_interval 内合并后续到达的写操作"""
+        pending = [self._requests.get()]
+        deadline = time.monotonic() + self.flush_interval
+        while len(pending) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                pending.append(self._requests.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return pending
+
+    def _run(self):
+        conn = sqlite3.connect(self.db_file)
+        # WAL 模式下读连接不会被写事务阻塞；NORMAL 只在检查点时 fsync
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        while True:
+            pending = self._collect()
+            try:
+                with metrics.timer("sqlite_commit"):
+                    with conn:
+                        for sql, rows, future in pending:
+                            if sql is not BARRIER:
+                                conn.executemany(sql, rows)
+                metrics.inc("sqlite_write_ops_total", sum(1 for sql, rows, future in pending if sql is not BARRIER))
+            except Exception as e:
+                # 整批失败时逐条重试，避免一条错误的写操作连累同批的其他数据
+                print(f"批量写入聊天记录失败，逐条重试: {e}")
+                self._write_one_by_one(conn, pending)
+                continue
+            for sql, rows, future in pending:
+                future.set_result(len(rows))
+
+    def _write_one_by_one(self, conn, pending):
+        for sql, rows, future in pending:
+            if sql is BARRIER:
+                future.set_result(0)
+                continue
+            try:
+                with conn:
+                    conn.executemany(sql, rows)
+                future.set_result(len(rows))
+            except Exception as e:
+                print(f"写入聊天记录失败: {e}")
+                future.set_exception(e)
+
+
+def get_writer():
+    """获取全局唯一的写线程，插件热重载后仍然是同一个"""
+    return shared.shared_resource("chat_db_writer", ChatDBWriter)
+
+
+def warm_up():
+    """启动后提前打开写连接、预加载成员缓存"""
+    get_writer()
+    get_membership()
+
+
+def write(sql, rows):
+    """把写操作交给后台写线程，返回 Future"""
+    return get_writer().submit(sql, rows)
+
+
+def flush(timeout=None):
+    """等待此前交给写线程的写操作全部落库"""
+    get_writer().barrier().result(timeout)
+
+
+class MembershipCache:
+    """
+    已写入数据库的群和群成员，启动时从数据库预加载
+    记录消息时只有缓存中没有的群和成员才需要写库；按群取成员时（group_members，总结时还原QQ号用）也优先使用这里
+    成员数量超过上限时淘汰最久没发言的成员，此后 members_of 不再保证完整，调用方需要回退到查库
+    """
+    def __init__(self, max_size=MEMBER_CACHE_SIZE):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._groups = set()
+        # (群号, QQ号) -> None，按最近出现的顺序排列
+        self._pairs = OrderedDict()
+        # 群号 -> {QQ号}
+        self._group_members = {}
+        self.complete = True
+
+    def load(self):
+        """从数据库预加载全部群和成员"""
+        groups = query('SELECT group_id FROM groups')
+        members = query('SELECT group_id, qq_number FROM members')
+        self.add_groups(group_id for (group_id,) in groups)
+        self.add_members(members)
+        print(f"成员缓存加载完成: {len(self._groups)} 个群，{len(self._pairs)} 个成员")
+        return self
+
+    def missing_groups(self, group_ids):
+        with self._lock:
+            return {group_id for group_id in group_ids if group_id not in self._groups}
+
+    def missing_members(self, pairs):
+        """返回不在缓存中的 (群号, QQ号)，缓存中已有的顺便标记为最近出现"""
+        missing = set()
+        with self._lock:
+            for pair in pairs:
+                if pair in self._pairs:
+                    self._pairs.move_to_end(pair)
+                else:
+                    missing.add(pair)
+        return missing
+
+    def add_groups(self, group_ids):
+        with self._lock:
+            self._groups.update(group_ids)
+
+    def add_members(self, pairs):
+        with self._lock:
+            for group_id, qq_number in pairs:
+                self._pairs[(group_id, qq_number)] = None
+                self._pairs.move_to_end((group_id, qq_number))
+                self._group_members.setdefault(group_id, set()).add(qq_number)
+            while len(self._pairs) > self.max_size:
+                (group_id, qq_number), _ = self._pairs.popitem(last=False)
+                self._group_members[group_id].discard(qq_number)
+                self.complete = False
+
+    def members_of(self, group_id):
+        """群成员的 QQ 号集合；缓存发生过淘汰时返回 None，调用方需要查库"""
+        with self._lock:
+            if not self.complete:
+                return None
+            return set(self._group_members.get(group_id, ()))
+
+
+def get_membership():
+    """获取全局唯一的成员缓存（第一次调用时从数据库预加载），插件热重载后仍然是同一个"""
+    return shared.shared_resource("membership_cache", lambda: MembershipCache().load())
+
+
+def group_members(group_id):
+    """群成员的 QQ 号列表，优先使用成员缓存"""
+    members = get_membership().members_of(group_id)
+    if members is None:
+        members = [row[0] for row in query('SELECT DISTINCT qq_number FROM members WHERE group_id = ?', (group_id,))]
+    return list(members)
+
+
+_local = threading.local()
+
+
+def read_connection():
+    """当前线程的只读连接（第一次调用时创建，之后复用）"""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(f"file:{os.path.abspath(DB_FILE)}?mode=ro", uri=True)
+        _local.conn = conn
+    return conn
+
+
+def query(sql, params=()):
+    """用只读连接执行查询，返回全部结果"""
+    with metrics.timer("sqlite_read"):
+        return read_connection().execute(sql, params).fetchall()
+
+
+def insert_messages(group_id_and_messages):
+    """写入 [(群号, Message), ...]，返回 Future"""
+    return write(f'INSERT INTO messages (group_id, {MESSAGE_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                 [(group_id, *message) for group_id, message in group_id_and_messages])
+
+
+def recent_messages(group_id, limit):
+    """某个群最近的 limit 条消息，按时间顺序排列（走 (group_id, ts) 索引倒序取）"""
+    rows = query(f'SELECT {MESSAGE_COLUMNS} FROM messages WHERE group_id = ? ORDER BY ts DESC, id DESC LIMIT ?',
+                 (group_id, limit))
+    return [Message(*row) for row in reversed(rows)]
+
+
+def packed_content(message):
+    """还原成 v1 的文本格式: 群员消息为 [#QQ号#][昵称][时间]消息，机器人回复为 [AI][QQ BOT]回复"""
+    if message.is_bot:
+        return BOT_MARK + message.content
+    if message.nickname is None:
+        # 升级前无法解析的旧消息，原样返回
+        return message.content
+    time_str = datetime.datetime.fromtimestamp(message.ts).strftime('%Y-%m-%d %H:%M:%S')
+    return f"[#{message.qq_number}#][{message.nickname}][{time_str}]{message.content}"
@@ -0,0 +1,89 @@
+import os
+import re
+
+# 按 token 预算组装发给大模型的上下文
+# 固定前缀（系统提示词、工具定义）放在最前面且每次完全相同，方便服务端的前缀缓存命中；
+# 聊天记录从最新的一条往前放，直到用完预算，过长的单条消息和工具结果截掉中间部分
+#
+# 相关设置（写在 .env 中，可选）
+# CONTEXT_TOKEN_BUDGET: AI对话聊天记录部分的 token 预算，默认 3000
+# SUMMARY_TOKEN_BUDGET: 群聊总结聊天记录部分的 token 预算，默认 24000
+# MESSAGE_TOKEN_LIMIT: 单条聊天记录最多保留的 token 数，默认 500
+# TOOL_TOKEN_LIMIT: 单个工具结果最多保留的 token 数，默认 2000
+
+# 有 tiktoken 时用它计数，否则按字符估算（中文约一字一 token，其他约四个字符一 token）
+tiktoken_available = False
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("cl100k_base")
+    tiktoken_available = True
+except Exception as e:
+    print(f"tiktoken 不可用，按字符估算 token 数: {e}")
+    tiktoken_available = False
+
+# 每条消息除内容外的格式开销
+MESSAGE_OVERHEAD = 4
+ELISION = "\n……（中间省略）……\n"
+CJK_PATTERN = re.compile(r'[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uff00-\uffef]')
+
+
+def budget(name, default):
+    return int(os.getenv(name, str(default)))
+
+
+def count_tokens(text):
+    """估算文本的 token 数"""
+    if not text:
+        return 0
+    if tiktoken_available:
+        return len(_encoding.encode(text, disallowed_special=()))
+    cjk = len(CJK_PATTERN.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def message_tokens(message):
+    return count_tokens(message.get("content") or "") + MESSAGE_OVERHEAD
+
+
+def truncate(text, max_tokens):
+    """超过 max_tokens 的文本保留开头和结尾，截掉中间部分"""
+    tokens = count_tokens(text)
+    if tokens <= max_tokens:
+        return text
+    # 按比例换算成字符数，开头保留多一些
+    keep = int(len(text) * max(max_tokens - count_tokens(ELISION), 0) / tokens)
+    head = keep * 2 // 3
+    tail = keep - head
+    return text[:head] + ELISION + (text[-tail:] if tail else "")
+
+
+def build_messages(prefix, history, suffix=(), token_budget=None, message_limit=None):
+    """
+    组装消息列表: prefix + 放得下的最近聊天记录 + suffix
+    :param prefix: 固定前缀（系统提示词等），原样放在最前面
+    :param history: 按时间顺序排列的聊天记录（对话格式）
+    :param suffix: 放在最后的消息（例如"请回复最新的消息"）
+    :param token_budget: 聊天记录部分的 token 预算，默认 CONTEXT_TOKEN_BUDGET
+    :param message_limit: 单条聊天记录最多保留的 token 数，默认 MESSAGE_TOKEN_LIMIT
+    """
+    if token_budget is None:
+        token_budget = budget("CONTEXT_TOKEN_BUDGET", 3000)
+    if message_limit is None:
+        message_limit = budget("MESSAGE_TOKEN_LIMIT", 500)
+
+    packed = []
+    used = 0
+    for message in reversed(history):
+        message = dict(message, content=truncate(message.get("content") or "", message_limit))
+        tokens = message_tokens(message)
+        if used + tokens > token_budget:
+            break
+        packed.append(message)
+        used += tokens
+    packed.reverse()
+    return list(prefix) + packed + list(suffix)
+
+
+def truncate_tool_output(text):
+    """工具结果（搜索结果、网页内容）超过 TOOL_TOKEN_LIMIT 时截掉中间部分"""
+    return truncate(text, budget("TOOL_TOKEN_LIMIT", 2000))
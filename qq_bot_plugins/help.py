@@ -1,9 +1,7 @@
-import random
 from ncatbot.core import GroupMessage
 import importlib
 import os
 from dotenv import load_dotenv
-import time
 
 # 插件信息
 PLUGIN_NAME = "帮助插件"
@@ -16,6 +14,9 @@ plugin_enabled = True
 # 插件优先级 (数值越小优先级越高，默认100)
 PRIORITY = 2
 
+# 回复前随机等待的秒数范围，模拟真人打字，由调度器在发送时异步等待
+REPLY_DELAY = (0.5, 2)
+
 env_path = os.path.join("..", "bot_config", ".env")
 load_dotenv(env_path)
 
@@ -48,22 +49,18 @@ def get_help(system: bool):
     
     return help_text
 
-def handle_message(msg: GroupMessage):
+def show_help(msg: GroupMessage):
     """
-    处理群消息
+    处理 /help 命令
     返回值格式: (回复内容, 是否@发送者, 图片路径)
     如果不需要回复，返回 None
     """
-    if not plugin_enabled:
-        return None
-    
-    raw_msg = msg.raw_message.strip()
-    time.sleep(random.uniform(0.5, 2))
-    # 处理插件命令
-    if "/help" in raw_msg:
-        return get_help(os.getenv("ROOT_QQ") == msg.user_id), True, None
-    
-    return None
+    return get_help(os.getenv("ROOT_QQ") == msg.user_id), True, None
+
+# 插件命令表: 命令 -> 处理函数，只有以该命令开头的消息才会交给对应函数
+COMMANDS = {
+    "/help": show_help,
+}
 
 # 插件初始化检查
 if __name__ == "__main__":
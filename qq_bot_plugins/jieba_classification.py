@@ -1,5 +1,9 @@
 import jieba
 
+def warm_up():
+    """启动后在后台加载jieba词典，避免第一次提问时才加载"""
+    jieba.initialize()
+
 def get_answer(question, qa_json):
     """
     智能问答核心函数
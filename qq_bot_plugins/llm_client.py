@@ -0,0 +1,155 @@
+import os
+import re
+import sys
+
+# 添加当前插件目录到Python路径，确保可以导入同目录模块
+if os.path.dirname(__file__) not in sys.path:
+    sys.path.append(os.path.dirname(__file__))
+import shared
+
+# 共享的大模型客户端
+# 每组 (API地址, 密钥) 只创建一个 AsyncOpenAI 客户端，底层连接池保持长连接，
+# 各插件的请求复用已经建立好的 TCP/TLS 连接；插件热重载后仍然是同一个客户端
+#
+# 相关设置（写在 .env 中，可选）
+# LLM_MAX_CONNECTIONS: 每个客户端最多同时打开的连接数，默认 20
+# LLM_MAX_KEEPALIVE: 每个客户端最多保持的空闲长连接数，默认 10
+# LLM_KEEPALIVE_EXPIRY: 空闲长连接保留多少秒，默认 60
+# LLM_TIMEOUT: 单次请求超时（秒），默认 120；流式响应时为两段数据之间的最长间隔
+# LLM_CONNECT_TIMEOUT: 建立连接超时（秒），默认 10
+
+# 客户端种类 -> (密钥的环境变量, 地址的环境变量)
+CLIENT_KINDS = {
+    "main": ("API_KEY", "API_URL"),
+    "cheap": ("LOW_COST_API_KEY", "LOW_COST_API_URL"),
+}
+
+# 流式回复按句切分: 遇到句末标点或换行、且攒够 min_chars 个字时发出一段
+SENTENCE_END = re.compile(r'[。！？!?；;…\n]+')
+STREAM_MIN_CHARS = 20
+
+
+def create_client(api_key, base_url):
+    import httpx
+    from openai import AsyncOpenAI
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=int(os.getenv("LLM_MAX_CONNECTIONS", "20")),
+            max_keepalive_connections=int(os.getenv("LLM_MAX_KEEPALIVE", "10")),
+            keepalive_expiry=float(os.getenv("LLM_KEEPALIVE_EXPIRY", "60")),
+        ),
+        timeout=httpx.Timeout(float(os.getenv("LLM_TIMEOUT", "120")),
+                              connect=float(os.getenv("LLM_CONNECT_TIMEOUT", "10"))),
+    )
+    # 重试由 llm_gateway 统一处理（退避、限流、熔断），SDK 自己不再重试
+    return AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=http_client, max_retries=0)
+
+
+def get_client(kind="main"):
+    """
+    获取共享的 AsyncOpenAI 客户端，kind 为 main（主模型）或 cheap（低成本模型）
+    客户端绑定在机器人的事件循环上，只能在 async 插件函数中使用
+    """
+    key_env, url_env = CLIENT_KINDS[kind]
+    api_key, base_url = os.getenv(key_env), os.getenv(url_env)
+    clients = shared.shared_resource("llm_clients", dict)
+    client = clients.get((api_key, base_url))
+    if client is None:
+        client = clients[(api_key, base_url)] = create_client(api_key, base_url)
+    return client
+
+
+def split_point(text, min_chars):
+    """返回可以切分的位置（最后一个满足长度要求的句末之后），不能切分时返回 0"""
+    # 代码块中间不切分
+    if text.count("```") % 2 == 1:
+        return 0
+    cut = 0
+    for match in SENTENCE_END.finditer(text):
+        if match.end() >= min_chars:
+            cut = match.end()
+    return cut
+
+
+class EmptyResponse(Exception):
+    """流式响应结束时既没有文本也没有工具调用"""
+
+
+def add_tool_deltas(calls, delta):
+    """把一段流式响应中的工具调用片段按 index 拼接到 calls 中，返回这段是否有工具调用"""
+    deltas = getattr(delta, "tool_calls", None) or []
+    for call in deltas:
+        entry = calls.setdefault(call.index, {"id": "", "type": "function", "function": {"name": "", "arguments": ""}})
+        if call.id:
+            entry["id"] = call.id
+        if call.function and call.function.name:
+            entry["function"]["name"] += call.function.name
+        if call.function and call.function.arguments:
+            entry["function"]["arguments"] += call.function.arguments
+    return bool(deltas)
+
+
+async def start_stream(stream, min_chars=STREAM_MIN_CHARS):
+    """
+    读取流式响应的开头，直到能确定模型是在调用工具还是在回复文本
+    返回 (tool_calls, chunks):
+    - 调用工具时 tool_calls 为完整的工具调用列表 [{"id", "type", "function": {"name", "arguments"}}]，chunks 为 None
+    - 回复文本时 tool_calls 为 None，chunks 为按句切分的 ReplyStream，边接收边产出；
+      模型先写了一段文本再调用工具时，读完 chunks 后可以从 chunks.tool_calls 取到这些工具调用
+    :raises EmptyResponse: 响应中既没有文本也没有工具调用
+    """
+    calls = {}
+    # 只创建一个迭代器，回复文本时交给 ReplyStream 接着读
+    iterator = stream.__aiter__()
+    async for chunk in iterator:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta
+        add_tool_deltas(calls, delta)
+        if delta.content and not calls:
+            return None, ReplyStream(delta.content, stream, iterator, min_chars)
+    if calls:
+        return [calls[index] for index in sorted(calls)], None
+    raise EmptyResponse("大模型返回了空回复")
+
+
+class ReplyStream:
+    """
+    把流式响应剩下的文本按句切分后逐段产出（异步迭代器），first 为已经读到的开头
+    文本之后又出现工具调用时，读完后 tool_calls 为完整的工具调用列表，否则为 None
+    """
+    def __init__(self, first, stream, iterator, min_chars=STREAM_MIN_CHARS):
+        self.tool_calls = None
+        self._stream = stream
+        self._chunks = self._read(first, iterator, min_chars)
+
+    def __aiter__(self):
+        return self._chunks
+
+    async def aclose(self):
+        await self._chunks.aclose()
+
+    async def _read(self, first, iterator, min_chars):
+        buffer = first
+        calls = {}
+        try:
+            async for chunk in iterator:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta
+                if add_tool_deltas(calls, delta) or not delta.content:
+                    continue
+                buffer += delta.content
+                cut = split_point(buffer, min_chars)
+                if cut:
+                    yield buffer[:cut]
+                    buffer = buffer[cut:]
+            if buffer.strip():
+                yield buffer
+            if calls:
+                self.tool_calls = [calls[index] for index in sorted(calls)]
+        finally:
+            # 提前停止读取时关闭连接，把连接还给连接池
+            close = getattr(self._stream, "close", None)
+            if close is not None:
+                await close()
@@ -0,0 +1,351 @@
+import os
+import sys
+import time
+import heapq
+import random
+import asyncio
+import itertools
+import email.utils
+
+# 添加当前插件目录到Python路径，确保可以导入同目录模块
+if os.path.dirname(__file__) not in sys.path:
+    sys.path.append(os.path.dirname(__file__))
+import llm_client
+import context_builder
+import metrics
+import shared
+
+# 大模型请求网关，所有插件的大模型请求都经过这里
+# - 令牌桶限流: 全局和每个群各有一个请求数桶和一个 token 数桶，桶空了就排队等待
+# - 优先级: 排队时 AI对话 > 群聊总结 > 是否回复的判断
+# - 重试: 限流(429)、服务端错误、连接失败时指数退避加随机抖动，服务端给了 Retry-After 时按它等待，
+#   并且暂停所有请求到那个时间
+# - 熔断: 连续失败多次后一段时间内直接失败，不再请求；冷却后放一个请求试探，成功后恢复
+# SDK 自带的重试已经关闭（见 llm_client），重试只在这里进行
+#
+# 相关设置（写在 .env 中，可选）
+# LLM_RPM / LLM_TPM: 全局每分钟最多的请求数 / token 数，默认 60 / 200000
+# LLM_GROUP_RPM / LLM_GROUP_TPM: 每个群每分钟最多的请求数 / token 数，默认 10 / 40000
+# LLM_COMPLETION_TOKENS: 预估每次回复的 token 数（计入 token 桶），默认 500
+# LLM_MAX_RETRIES: 最多重试次数，默认 3
+# LLM_BACKOFF_BASE / LLM_BACKOFF_MAX: 退避的基础秒数 / 最长秒数，默认 1 / 30
+# LLM_BREAKER_THRESHOLD: 连续失败多少次后熔断，默认 5
+# LLM_BREAKER_COOLDOWN: 熔断多少秒后试探恢复，默认 30
+# LLM_QUEUE_TIMEOUT: 排队最多等待的秒数，超过后放弃这次请求，默认 60
+
+# 用途 -> 优先级（数值越小越先处理）
+PRIORITIES = {
+    "chat": 0,
+    "summary": 1,
+    "gate": 2,
+}
+# 排队时检查一次的最长间隔（秒）
+QUEUE_POLL = 0.2
+# 可以重试的 HTTP 状态码
+RETRY_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+
+def setting(name, default):
+    return type(default)(os.getenv(name, str(default)))
+
+
+class LLMUnavailable(Exception):
+    """熔断中或排队超时，这次请求没有发出"""
+
+
+class TokenBucket:
+    """令牌桶: 容量为每分钟的额度，按时间匀速补充"""
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        """还要等多少秒才够 amount 个令牌（超过容量的按容量算）"""
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) * 60 / self.capacity
+
+    def take(self, amount):
+        self.tokens -= min(amount, self.capacity)
+
+    def refund(self, amount):
+        """退还 take 拿走的令牌（拿到令牌后没有发出请求时）"""
+        self.tokens = min(self.capacity, self.tokens + min(amount, self.capacity))
+
+    def adjust(self, amount):
+        """按实际用量修正预估（amount 为实际减去预估，可以是负数）"""
+        self.tokens = min(self.capacity, self.tokens - amount)
+
+
+class CircuitBreaker:
+    def __init__(self):
+        self.failures = 0
+        self.opened_at = None
+        # 半开状态下正在试探的请求
+        self.probing = False
+
+    def state(self, now):
+        if self.opened_at is None:
+            return "closed"
+        if now - self.opened_at < setting("LLM_BREAKER_COOLDOWN", 30.0):
+            return "open"
+        return "half_open"
+
+    def allow(self, now):
+        """是否允许发出请求；半开状态只放行一个试探请求"""
+        state = self.state(now)
+        if state == "closed":
+            return True
+        if state == "half_open" and not self.probing:
+            self.probing = True
+            return True
+        return False
+
+    def record_success(self):
+        if self.opened_at is not None:
+            print("大模型服务已恢复")
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def record_failure(self, now):
+        self.failures += 1
+        if self.probing or self.failures >= setting("LLM_BREAKER_THRESHOLD", 5):
+            if self.opened_at is None or self.probing:
+                print(f"大模型连续失败 {self.failures} 次，暂停请求 {setting('LLM_BREAKER_COOLDOWN', 30.0):.0f} 秒")
+                metrics.inc("llm_breaker_open_total")
+            self.opened_at = now
+        self.probing = False
+
+
+class Gateway:
+    """限流和熔断状态，绑定在机器人的事件循环上，只在 async 插件函数中使用"""
+    def __init__(self):
+        self.requests = TokenBucket(setting("LLM_RPM", 60))
+        self.tokens = TokenBucket(setting("LLM_TPM", 200000))
+        # 群号 -> (请求数桶, token 数桶)
+        self.groups = {}
+        self.breaker = CircuitBreaker()
+        # 服务端要求暂停到的时间（Retry-After）
+        self.paused_until = 0.0
+        # 排队中的请求 (优先级, 序号)，堆顶的先拿令牌
+        self.waiters = []
+        self._counter = itertools.count()
+
+    def group_buckets(self, group_id):
+        buckets = self.groups.get(group_id)
+        if buckets is None:
+            buckets = self.groups[group_id] = (TokenBucket(setting("LLM_GROUP_RPM", 10)),
+                                               TokenBucket(setting("LLM_GROUP_TPM", 40000)))
+        return buckets
+
+    def check_breaker(self, now):
+        if not self.breaker.allow(now):
+            metrics.inc("llm_rejected_total", reason="circuit_open")
+            raise LLMUnavailable("大模型服务暂时不可用（熔断中）")
+
+    async def acquire(self, purpose, group_id, tokens):
+        """
+        排队拿到一个请求令牌和 tokens 个 token 令牌
+        先等本群的桶（不同群之间互不阻塞），再按优先级等全局的桶
+        等全局的桶时排队超时、熔断或被取消，会退还已经拿到的本群令牌
+        """
+        start = time.monotonic()
+        # 熔断中直接失败，不用排队
+        if self.breaker.state(start) == "open":
+            metrics.inc("llm_rejected_total", reason="circuit_open")
+            raise LLMUnavailable("大模型服务暂时不可用（熔断中）")
+        deadline = start + setting("LLM_QUEUE_TIMEOUT", 60.0)
+        # 已经拿到令牌的本群桶
+        taken = None
+        try:
+            if group_id is not None:
+                group_requests, group_tokens = self.group_buckets(group_id)
+                while True:
+                    now = time.monotonic()
+                    wait = max(group_requests.wait_time(1, now), group_tokens.wait_time(tokens, now))
+                    if wait == 0:
+                        break
+                    self.check_deadline(now, deadline)
+                    await asyncio.sleep(min(wait, QUEUE_POLL))
+                group_requests.take(1)
+                group_tokens.take(tokens)
+                taken = group_requests, group_tokens
+
+            entry = (PRIORITIES.get(purpose, len(PRIORITIES)), next(self._counter))
+            heapq.heappush(self.waiters, entry)
+            try:
+                while True:
+                    now = time.monotonic()
+                    if self.waiters[0] != entry:
+                        wait = QUEUE_POLL
+                    else:
+                        wait = max(self.paused_until - now,
+                                   self.requests.wait_time(1, now),
+                                   self.tokens.wait_time(tokens, now))
+                        if wait <= 0:
+                            self.check_breaker(now)
+                            self.requests.take(1)
+                            self.tokens.take(tokens)
+                            return
+                    self.check_deadline(now, deadline)
+                    await asyncio.sleep(min(wait, QUEUE_POLL))
+            finally:
+                self.waiters.remove(entry)
+                heapq.heapify(self.waiters)
+        except BaseException:
+            # 没有发出请求，本群的令牌还回去
+            if taken is not None:
+                taken[0].refund(1)
+                taken[1].refund(tokens)
+            raise
+        finally:
+            metrics.observe("llm_queue_seconds", time.monotonic() - start, purpose=purpose)
+
+    def check_deadline(self, now, deadline):
+        if now > deadline:
+            metrics.inc("llm_rejected_total", reason="queue_timeout")
+            raise LLMUnavailable("大模型请求排队超时")
+
+    def settle(self, group_id, estimate, actual):
+        """按响应中的实际 token 用量修正令牌桶"""
+        self.tokens.adjust(actual - estimate)
+        if group_id is not None:
+            self.group_buckets(group_id)[1].adjust(actual - estimate)
+
+    def gauges(self):
+        now = time.monotonic()
+        return {
+            "llm_queue_depth": len(self.waiters),
+            "llm_breaker_open": 0 if self.breaker.state(now) == "closed" else 1,
+            "llm_paused": 1 if self.paused_until > now else 0,
+        }
+
+
+def create_gateway():
+    gateway = Gateway()
+    metrics.register_gauges(gateway.gauges)
+    return gateway
+
+
+def get_gateway():
+    """获取全局唯一的网关，插件热重载后限流和熔断状态仍然保留"""
+    return shared.shared_resource("llm_gateway", create_gateway)
+
+
+def status_code(error):
+    return getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+
+
+def retry_after(error):
+    """从 429/503 响应头中读取服务端要求等待的秒数，没有时返回 None"""
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        # HTTP 日期格式
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def is_retryable(error):
+    """限流、服务端错误、连接失败和超时可以重试，其他错误（参数错误、密钥无效等）直接失败"""
+    status = status_code(error)
+    if status is not None:
+        return status in RETRY_STATUS
+    # openai 的连接错误，以及读取流式响应时 httpx 的网络错误
+    return isinstance(error, (asyncio.TimeoutError, OSError)) or \
+        type(error).__name__ in ("APIConnectionError", "APITimeoutError") or \
+        type(error).__module__.startswith("httpx")
+
+
+def backoff(attempt):
+    """第 attempt 次重试前等待的秒数: 指数退避，全随机抖动"""
+    ceiling = min(setting("LLM_BACKOFF_MAX", 30.0), setting("LLM_BACKOFF_BASE", 1.0) * 2 ** attempt)
+    return random.uniform(0, ceiling)
+
+
+def estimate_tokens(kwargs):
+    """预估一次请求的 token 数: 提示词 + 回复"""
+    prompt = sum(context_builder.message_tokens(m) for m in kwargs.get("messages", []))
+    return prompt + (kwargs.get("max_tokens") or setting("LLM_COMPLETION_TOKENS", 500))
+
+
+async def prepare_response(prepare, response):
+    """调用 prepare 处理响应，出错时关闭流式响应，把连接还给连接池"""
+    try:
+        return await prepare(response)
+    except BaseException:
+        close = getattr(response, "close", None)
+        if close is not None:
+            await close()
+        raise
+
+
+async def request(kind, purpose, group_id=None, prepare=None, **kwargs):
+    """
+    通过网关发出一次 chat.completions.create 请求，失败时按规则退避重试
+    :param kind: 客户端种类，main 或 cheap（见 llm_client.get_client）
+    :param purpose: 用途，决定排队优先级: chat / summary / gate
+    :param group_id: 发起请求的群，用于每个群的限流
+    :param prepare: 可选，对响应做进一步处理的 async 函数（例如 llm_client.start_stream），
+                    处理过程中出错也会重试，返回它的结果
+    :param kwargs: 传给 chat.completions.create 的参数
+    :raises LLMUnavailable: 熔断中或排队超时
+    """
+    gateway = get_gateway()
+    client = llm_client.get_client(kind)
+    estimate = estimate_tokens(kwargs)
+    max_retries = setting("LLM_MAX_RETRIES", 3)
+    for attempt in range(max_retries + 1):
+        await gateway.acquire(purpose, group_id, estimate)
+        try:
+            with metrics.timer("llm_request", purpose=purpose):
+                response = await client.chat.completions.create(**kwargs)
+                if prepare is not None:
+                    response = await prepare_response(prepare, response)
+        except Exception as e:
+            retryable = is_retryable(e)
+            if retryable and status_code(e) != 429:
+                gateway.breaker.record_failure(time.monotonic())
+            else:
+                # 限流说明服务还在，其他错误不是服务的问题，都不计入熔断；半开状态时让下一个请求接着试探
+                gateway.breaker.probing = False
+            if not retryable or attempt == max_retries:
+                raise
+            wait = retry_after(e)
+            if wait is not None:
+                # 服务端要求等待时所有请求一起暂停
+                gateway.paused_until = max(gateway.paused_until, time.monotonic() + wait)
+            else:
+                wait = backoff(attempt)
+            metrics.inc("llm_retries_total", purpose=purpose, status=status_code(e) or type(e).__name__)
+            print(f"大模型请求失败（{e}），{wait:.1f} 秒后第 {attempt + 1} 次重试")
+            await asyncio.sleep(wait)
+            continue
+        gateway.breaker.record_success()
+        usage = getattr(response, "usage", None)
+        if usage is not None and getattr(usage, "total_tokens", None):
+            gateway.settle(group_id, estimate, usage.total_tokens)
+        return response
@@ -0,0 +1,168 @@
+import os
+import re
+import sys
+import math
+
+# 添加当前插件目录到Python路径，确保可以导入同目录模块
+if os.path.dirname(__file__) not in sys.path:
+    sys.path.append(os.path.dirname(__file__))
+import context_builder
+import metrics
+
+# 从长文本中挑出和问题相关的段落，放进 token 预算
+# 正文先按段落切成小块，用 BM25 打分初筛，句向量模型可用时再对候选块按语义相似度重排，
+# 最后按原文顺序拼接得分最高的几块（开头一块总是保留，通常是标题和导语）
+#
+# 相关设置（写在 .env 中，可选）
+# URL_TOKEN_BUDGET: 网页内容最多放进上下文的 token 数，默认 1500
+# URL_CHUNK_TOKENS: 每块的 token 数上限，默认 160（句向量模型最多只看 128 个词）
+
+# 交给句向量模型重排的候选块数
+RERANK_CANDIDATES = 32
+BM25_K1 = 1.5
+BM25_B = 0.75
+# 不相邻的两块之间的分隔
+SEPARATOR = "\n……\n"
+TERM_PATTERN = re.compile(r'[a-z0-9]+|[\u3400-\u4dbf\u4e00-\u9fff]+')
+SENTENCE_PATTERN = re.compile(r'[^。！？!?；;\n]*[。！？!?；;]+|[^。！？!?；;\n]+')
+
+# 句向量模型不可用时只提示一次
+_encoder_warned = False
+
+
+def terms(text):
+    """BM25 用的词: 英文和数字按单词，中文按相邻两个字（单独一个字时用这个字）"""
+    result = []
+    for run in TERM_PATTERN.findall(text.lower()):
+        if run[0].isascii():
+            result.append(run)
+        elif len(run) == 1:
+            result.append(run)
+        else:
+            result.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return result
+
+
+def split_long(paragraph, chunk_tokens):
+    """把超过 chunk_tokens 的段落按句切开，单句仍然太长时按字数硬切"""
+    pieces = []
+    for sentence in SENTENCE_PATTERN.findall(paragraph):
+        tokens = context_builder.count_tokens(sentence)
+        if tokens <= chunk_tokens:
+            pieces.append(sentence)
+            continue
+        step = max(len(sentence) * chunk_tokens // tokens, 1)
+        pieces.extend(sentence[i:i + step] for i in range(0, len(sentence), step))
+    return pieces
+
+
+def split_chunks(text, chunk_tokens):
+    """按段落切块，短段落合并到同一块，每块不超过 chunk_tokens"""
+    chunks = []
+    current, used = [], 0
+    for line in text.split("\n"):
+        line = line.strip()
+        if not line:
+            continue
+        for piece in split_long(line, chunk_tokens) if context_builder.count_tokens(line) > chunk_tokens else [line]:
+            tokens = context_builder.count_tokens(piece)
+            if current and used + tokens > chunk_tokens:
+                chunks.append("\n".join(current))
+                current, used = [], 0
+            current.append(piece)
+            used += tokens
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+
+def bm25_scores(question, chunks):
+    query = set(terms(question))
+    documents = [terms(chunk) for chunk in chunks]
+    if not query or not documents:
+        return [0.0] * len(chunks)
+    average = sum(len(d) for d in documents) / len(documents) or 1
+    frequency = {term: sum(1 for d in documents if term in d) for term in query}
+    scores = []
+    for document in documents:
+        counts = {}
+        for term in document:
+            if term in query:
+                counts[term] = counts.get(term, 0) + 1
+        score = 0.0
+        for term, count in counts.items():
+            idf = math.log(1 + (len(documents) - frequency[term] + 0.5) / (frequency[term] + 0.5))
+            score += idf * count * (BM25_K1 + 1) / (count + BM25_K1 * (1 - BM25_B + BM25_B * len(document) / average))
+        scores.append(score)
+    return scores
+
+
+def encoder_scores(question, chunks):
+    """问题和每一块的句向量相似度，模型不可用时返回 None"""
+    global _encoder_warned
+    try:
+        from sentence_encoder import get_encoder
+        vectors = get_encoder().encode([question] + chunks)
+    except Exception as e:
+        if not _encoder_warned:
+            _encoder_warned = True
+            print(f"句向量模型不可用，网页段落只按 BM25 排序: {e}")
+        return None
+    # 句向量已归一化，点积即余弦相似度
+    return [float(score) for score in vectors[1:] @ vectors[0]]
+
+
+def rank(question, chunks):
+    """按和问题的相关程度从高到低返回块的下标"""
+    bm25 = bm25_scores(question, chunks)
+    # BM25 初筛（同分时靠前的优先），句向量重排候选块
+    order = sorted(range(len(chunks)), key=lambda i: (-bm25[i], i))
+    candidates = order[:RERANK_CANDIDATES]
+    similarities = encoder_scores(question, [chunks[i] for i in candidates])
+    if similarities is None:
+        metrics.inc("passage_rank_total", ranker="bm25")
+        return order
+    metrics.inc("passage_rank_total", ranker="encoder")
+    reranked = [i for similarity, i in sorted(zip(similarities, candidates), key=lambda x: -x[0])]
+    return reranked + order[RERANK_CANDIDATES:]
+
+
+def select_passages(text, question="", token_budget=None, chunk_tokens=None):
+    """
+    从 text 中挑出和 question 最相关的几块，总长度不超过 token_budget，按原文顺序拼接
+    text 本来就放得下时原样返回；没有问题时按原文顺序取开头的几块
+    """
+    if token_budget is None:
+        token_budget = context_builder.budget("URL_TOKEN_BUDGET", 1500)
+    if chunk_tokens is None:
+        chunk_tokens = context_builder.budget("URL_CHUNK_TOKENS", 160)
+    total = context_builder.count_tokens(text)
+    metrics.inc("passage_tokens_total", total, stage="input")
+    if total <= token_budget:
+        metrics.inc("passage_tokens_total", total, stage="selected")
+        return text
+
+    chunks = split_chunks(text, chunk_tokens)
+    order = rank(question, chunks) if question.strip() else list(range(len(chunks)))
+    chosen = []
+    used = 0
+    # 块之间的分隔符也计入预算；选完之前不知道哪些块相邻，每块都按较长的 SEPARATOR 计算
+    separator_tokens = context_builder.count_tokens(SEPARATOR)
+    # 开头一块通常是标题和导语，总是保留
+    for i in [0] + [i for i in order if i != 0]:
+        tokens = context_builder.count_tokens(chunks[i]) + (separator_tokens if chosen else 0)
+        if used + tokens > token_budget:
+            continue
+        chosen.append(i)
+        used += tokens
+
+    parts = []
+    previous = None
+    for i in sorted(chosen):
+        if previous is not None:
+            parts.append("\n" if i == previous + 1 else SEPARATOR)
+        parts.append(chunks[i])
+        previous = i
+    selected = "".join(parts)
+    metrics.inc("passage_tokens_total", context_builder.count_tokens(selected), stage="selected")
+    return selected
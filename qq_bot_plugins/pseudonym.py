@@ -0,0 +1,115 @@
+import os
+import re
+import sys
+import hashlib
+import threading
+from functools import lru_cache
+from dotenv import load_dotenv
+
+# 添加当前插件目录到Python路径，确保可以导入同目录模块
+if os.path.dirname(__file__) not in sys.path:
+    sys.path.append(os.path.dirname(__file__))
+import chat_db
+import brain
+
+# QQ号匿名化: 发给大模型的聊天记录中QQ号替换成加盐 hash，大模型输出的 hash 再还原成QQ号
+# 正向（QQ号 -> hash）做了缓存；反向（hash -> QQ号）保存在数据库的 pseudonyms 表中，
+# 新成员写入 members 表时由记录插件同时登记，还原时只需查字典
+
+plugin_dir = os.path.dirname(os.path.abspath(__file__))
+project_root = os.path.dirname(plugin_dir)
+
+env_path = os.path.join(project_root, "bot_config", ".env")
+load_dotenv(env_path)
+
+SALT = os.getenv("SALT", "salt1245")
+HASH_LENGTH = 10
+
+QQ_PATTERN = re.compile(r'\[#(\d+)#\]')
+HASH_PATTERN = re.compile(r'[a-f0-9]{%d}' % HASH_LENGTH)
+
+
+@lru_cache(maxsize=65536)
+def _hash(qq_number):
+    return hashlib.sha256((qq_number + SALT).encode()).hexdigest()[:HASH_LENGTH]
+
+
+def hash_qq(qq_number):
+    """QQ号对应的匿名 hash"""
+    return _hash(str(qq_number))
+
+
+def pseudonymize(content):
+    """把 [#QQ号#] 替换成 [hash:xxx]"""
+    return QQ_PATTERN.sub(lambda m: f"[hash:{hash_qq(m.group(1))}]", content)
+
+
+def load_reverse_map():
+    """从 pseudonyms 表加载 hash -> QQ号，并补登记表中还没有的成员（例如更换了 SALT）"""
+    reverse = {h: str(qq) for h, qq in chat_db.query('SELECT hash, qq_number FROM pseudonyms')}
+    members = [row[0] for row in chat_db.query('SELECT DISTINCT qq_number FROM members')]
+    missing = [(hash_qq(qq), qq) for qq in members if hash_qq(qq) not in reverse]
+    if missing:
+        chat_db.write('INSERT OR REPLACE INTO pseudonyms (hash, qq_number) VALUES (?, ?)', missing).result()
+        reverse.update((h, str(qq)) for h, qq in missing)
+    print(f"匿名映射加载完成: {len(reverse)} 个成员")
+    return {"map": reverse, "lock": threading.Lock()}
+
+
+def get_reverse_map():
+    """获取全局唯一的 hash -> QQ号 映射，插件热重载后仍然是同一个"""
+    return brain.shared_resource("pseudonym_reverse_map", load_reverse_map)
+
+
+def register(qq_numbers):
+    """
+    登记新成员的 hash，返回写入的 Future（都已登记过时返回 None）
+    由记录插件在写入新成员时调用；写入成功后才算登记过，写入失败的成员下次还会重试
+    """
+    reverse = get_reverse_map()
+    with reverse["lock"]:
+        rows = [(hash_qq(qq), qq) for qq in set(qq_numbers) if hash_qq(qq) not in reverse["map"]]
+    if not rows:
+        return None
+    future = chat_db.write('INSERT OR REPLACE INTO pseudonyms (hash, qq_number) VALUES (?, ?)', rows)
+
+    def mark_registered(done):
+        # 在写线程中调用
+        if not done.cancelled() and done.exception() is None:
+            with reverse["lock"]:
+                reverse["map"].update((h, str(qq)) for h, qq in rows)
+
+    future.add_done_callback(mark_registered)
+    return future
+
+
+def reveal(content, members):
+    """
+    把文本中出现的成员 hash 还原成QQ号
+    只还原 members（QQ号字符串的集合，通常是被总结的群的成员，见 load）中的成员，其他群成员的 hash 保持原样，
+    大模型编造或照抄的其他群的 hash 不会被还原出QQ号
+    反向映射还没加载时会查库甚至写库，在事件循环中调用前先用 load() 在 io 线程池中加载
+    """
+    reverse = get_reverse_map()["map"]
+
+    def restore(match):
+        qq_number = reverse.get(match.group(0))
+        return qq_number if qq_number in members else match.group(0)
+
+    return HASH_PATTERN.sub(restore, content)
+
+
+def revealable_members(group_id):
+    """加载反向映射，返回某个群成员的QQ号集合（字符串），作为 reveal 的 members"""
+    get_reverse_map()
+    return {str(qq_number) for qq_number in chat_db.group_members(group_id)}
+
+
+async def load(group_id):
+    """在 io 线程池中加载反向映射（已经加载过时立即返回）和群成员，返回 reveal 用的群成员QQ号集合"""
+    return await brain.run_blocking("io", revealable_members, group_id)
+
+
+def warm_up():
+    """启动后提前加载反向映射"""
+    get_reverse_map()
@@ -1,7 +1,16 @@
-import random
 from ncatbot.core import GroupMessage
 import os
-import datetime
+import sys
+import time
+import threading
+from collections import deque
+
+# 添加当前插件目录到Python路径，确保可以导入同目录模块
+if os.path.dirname(__file__) not in sys.path:
+    sys.path.append(os.path.dirname(__file__))
+import chat_db
+import pseudonym
+import brain
 
 # 插件信息
 PLUGIN_NAME = "群聊记录插件"
@@ -14,54 +23,214 @@ plugin_enabled = True
 # 插件优先级 (数值越小优先级越高，默认100)
 PRIORITY = 1
 
+# 每个群在内存中保留最近多少条消息，构建对话上下文时不用查库
+HISTORY_WINDOW = 200
+
+
+def to_turn(message):
+    """把一条消息转换成发给大模型的对话格式，群员的QQ号替换成匿名 hash"""
+    if message.is_bot:
+        return {"role": "assistant", "content": message.content}
+    return {"role": "user", "content": pseudonym.pseudonymize(chat_db.packed_content(message))}
 
-def handle_message(msg: GroupMessage):
+
+def get_history():
     """
-    处理群消息
-    返回值格式: (回复内容, 是否@发送者, 图片路径)
-    如果不需要回复，返回 None
+    每个群最近的消息: {群号: deque[(chat_db.Message, 对话格式)]}，插件热重载后仍然是同一个
+    只保存已经交给数据库写线程的消息；某个群第一次被读取前由 load_recent 从数据库加载，之后由 observe_batch 和机器人回复追加
+    对话格式在追加时就转换好，构建上下文时不再做匿名化
+    loading: 正在从数据库加载的群 -> 加载期间提交的消息，加载完成后合并
     """
-    if not plugin_enabled:
-        return None
-    
-    raw_msg = msg.raw_message.strip()
-
-    import sqlite3
-
-    def add_group(group_id):
-        """添加一个群聊"""
-        conn = sqlite3.connect('qq_chat.db')
-        cursor = conn.cursor()
-        cursor.execute('INSERT OR IGNORE INTO groups (group_id) VALUES (?)', (group_id,))
-        conn.commit()
-        conn.close()
-        print(f"群聊 {group_id} 添加成功")
-
-    def add_member(group_id, qq_number):
-        """向群聊添加成员（相当于往members数组加QQ号）"""
-        conn = sqlite3.connect('qq_chat.db')
-        cursor = conn.cursor()
-        cursor.execute('INSERT OR IGNORE INTO members (group_id, qq_number) VALUES (?, ?)', (group_id, qq_number))
-        conn.commit()
-        conn.close()
-        print(f"成员 {qq_number} 添加到群 {group_id}")
-
-    def add_message(group_id, qq_number, content):
-        """添加消息（现在包含QQ号）"""
-        conn = sqlite3.connect('qq_chat.db')
-        cursor = conn.cursor()
-        cursor.execute('INSERT INTO messages (group_id, qq_number, content) VALUES (?, ?, ?)', 
-                    (group_id, qq_number, content))
-        conn.commit()
-        conn.close()
-        print(f"消息添加成功: {content}")
-
-    add_group(msg.group_id)
-    add_member(msg.group_id, msg.user_id)
-    add_message(msg.group_id, msg.user_id, "[#" + str(msg.user_id) + "#][" + msg.sender.nickname + "][" + datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S') + "]" + raw_msg)
-    
+    history = brain.shared_resource("recent_history", lambda: {"groups": {}, "loading": {}, "lock": threading.Lock()})
+    # 热重载前的旧版本创建的共享资源没有 loading
+    history.setdefault("loading", {})
+    return history
+
+
+def remember(group_id, messages):
+    """把已交给数据库写线程的消息追加到群的最近消息中（还没加载过的群不用追加，第一次读取时会从数据库加载）"""
+    history = get_history()
+    entries = [(message, to_turn(message)) for message in messages]
+    with history["lock"]:
+        recent = history["groups"].get(group_id)
+        if recent is None:
+            recent = history["loading"].get(group_id)
+        if recent is not None:
+            recent.extend(entries)
+
+
+def load_group(group_id):
+    """
+    从数据库加载某个群最近的消息（阻塞，在线程中执行；事件循环中用 load_recent）
+    查询时不持有锁，查询期间 remember 的消息先放在 loading 中，查询完成后去掉已经查到的再接在后面
+    """
+    history = get_history()
+    with history["lock"]:
+        if group_id in history["groups"]:
+            return
+        loading = history["loading"].setdefault(group_id, deque(maxlen=HISTORY_WINDOW))
+    try:
+        messages = chat_db.recent_messages(group_id, HISTORY_WINDOW)
+    except Exception:
+        with history["lock"]:
+            if history["loading"].get(group_id) is loading:
+                del history["loading"][group_id]
+        raise
+    entries = [(message, to_turn(message)) for message in messages]
+    with history["lock"]:
+        if group_id in history["groups"]:
+            # 同时在加载的另一个线程已经完成
+            return
+        loaded = set(messages)
+        recent = deque(entries, maxlen=HISTORY_WINDOW)
+        recent.extend(entry for entry in loading if entry[0] not in loaded)
+        history["groups"][group_id] = recent
+        history["loading"].pop(group_id, None)
+
+
+async def load_recent(group_id):
+    """读取某个群的最近消息之前调用: 还没加载过的群在 io 线程池中从数据库加载，不阻塞事件循环"""
+    if group_id not in get_history()["groups"]:
+        await brain.run_blocking("io", load_group, group_id)
+
+
+def _stored_entries(group_id, limit):
+    """
+    已交给数据库写线程的最近 limit 条消息及其对话格式，只从内存中取（最多 HISTORY_WINDOW 条）
+    事件循环中的调用方要先 await load_recent；在线程中调用时，还没加载过的群在这里同步加载
+    """
+    history = get_history()
+    with history["lock"]:
+        recent = history["groups"].get(group_id)
+        if recent is not None:
+            return list(recent)[-limit:]
+    load_group(group_id)
+    with history["lock"]:
+        return list(history["groups"][group_id])[-limit:]
+
+
+def find_message(group_id, message_id):
+    """
+    在群的最近消息中按消息 ID 查找（包括机器人的回复），找不到返回 None
+    只查内存中的最近消息，不查数据库，可以在事件循环中调用
+    """
+    message_id = str(message_id)
+    history = get_history()
+    with history["lock"]:
+        recent = history["groups"].get(group_id)
+        if recent is None:
+            return None
+        for message, turn in reversed(recent):
+            if message.message_id == message_id:
+                return message
     return None
 
+
+def to_message(msg: GroupMessage):
+    """把群消息转换成数据库中的一条记录 chat_db.Message"""
+    # 使用消息本身的时间，批量写入时记录的仍然是收到消息的时间
+    timestamp = getattr(msg, "time", None) or time.time()
+    message_id = getattr(msg, "message_id", None)
+    return chat_db.Message(
+        message_id=None if message_id is None else str(message_id),
+        qq_number=msg.user_id,
+        nickname=msg.sender.nickname,
+        ts=timestamp,
+        is_bot=0,
+        content=msg.raw_message.strip(),
+    )
+
+
+def format_message(msg: GroupMessage):
+    """拼接成文本格式: [#QQ号#][昵称][时间]消息"""
+    return chat_db.packed_content(to_message(msg))
+
+
+def _recent_entries(group_id, limit, exclude_message_id=None):
+    """
+    某个群最近的 limit 条消息及其对话格式，包括已收到但还没写入数据库的消息
+    先取出还没写入数据库的消息再读取已写入的（顺序反过来的话，刚好在两次读取之间写入的消息会两边都取不到）
+    耗时只和 limit 有关，和群里的历史消息总数无关
+    exclude_message_id: 不包括这条消息（例如触发命令的消息本身），仍然返回 limit 条
+    """
+    # 要去掉一条时多取一条
+    fetch = limit if exclude_message_id is None else limit + 1
+    pending = [to_message(m) for m in brain.pending_messages(group_id)]
+    entries = _stored_entries(group_id, fetch)
+    if pending:
+        # 两次读取之间已经写入数据库的消息会出现两次，按消息 ID 去重（没有 ID 的按内容）
+        stored = {m.message_id or (m.qq_number, m.content) for m, turn in entries[-len(pending):]}
+        entries += [(m, to_turn(m)) for m in pending if (m.message_id or (m.qq_number, m.content)) not in stored]
+    if exclude_message_id is not None:
+        entries = [(m, turn) for m, turn in entries if m.message_id != str(exclude_message_id)]
+    return entries[-limit:]
+
+
+def recent_messages(group_id, limit):
+    """某个群最近的 limit 条消息（chat_db.Message）"""
+    return [message for message, turn in _recent_entries(group_id, limit)]
+
+
+def recent_dialog(group_id, limit, exclude_message_id=None):
+    """
+    某个群最近的 limit 条消息，转换为对话格式（调用方可以随意修改返回的列表和字典）
+    exclude_message_id: 不包括这条消息，见 _recent_entries
+    """
+    return [dict(turn) for message, turn in _recent_entries(group_id, limit, exclude_message_id)]
+
+
+def observe_batch(msgs):
+    """
+    记录一批群消息（观察者，不产生回复）
+    写操作交给 chat_db 的后台写线程合并提交，这里等到数据落库再返回，
+    保证消息离开 brain.pending_messages 时已经能从数据库中读到
+    消息写入失败时抛出异常，brain 会在稍后重试这一批，期间消息仍然留在 pending_messages 中
+    """
+    # 只有成员缓存中没有的群和成员才需要写库
+    membership = chat_db.get_membership()
+    new_groups = membership.missing_groups({msg.group_id for msg in msgs})
+    new_members = membership.missing_members({(msg.group_id, msg.user_id) for msg in msgs})
+
+    group_futures = []
+    member_futures = []
+    if new_groups:
+        # 添加群聊
+        group_futures.append(chat_db.write('INSERT OR IGNORE INTO groups (group_id) VALUES (?)',
+                                           [(group_id,) for group_id in new_groups]))
+    if new_members:
+        # 向群聊添加成员（相当于往members数组加QQ号）
+        member_futures.append(chat_db.write('INSERT OR IGNORE INTO members (group_id, qq_number) VALUES (?, ?)',
+                                            new_members))
+        # 登记新成员的匿名 hash，总结时用来还原QQ号
+        future = pseudonym.register(qq_number for group_id, qq_number in new_members)
+        if future is not None:
+            member_futures.append(future)
+    # 添加消息
+    records = [(msg.group_id, to_message(msg)) for msg in msgs]
+    message_future = chat_db.insert_messages(records)
+
+    # 写入成功后再更新缓存，写入失败的群和成员下次发言时还会重试
+    if wait_all(group_futures):
+        membership.add_groups(new_groups)
+    if wait_all(member_futures):
+        membership.add_members(new_members)
+    # 群和成员用 INSERT OR IGNORE 写入，消息写入失败后整批重试不会重复
+    message_future.result()
+    for group_id, message in records:
+        remember(group_id, [message])
+
+
+def wait_all(futures):
+    """等待写操作全部完成，返回是否都成功"""
+    ok = True
+    for future in futures:
+        try:
+            future.result()
+        except Exception as e:
+            print(f"写入群或成员失败: {e}")
+            ok = False
+    return ok
+
 # 插件初始化检查
 if __name__ == "__main__":
     print("问答系统插件测试:")
@@ -0,0 +1,141 @@
+import os
+import sys
+import time
+import threading
+from collections import OrderedDict
+import numpy as np
+
+# 添加当前插件目录到Python路径，确保可以导入同目录模块
+if os.path.dirname(__file__) not in sys.path:
+    sys.path.append(os.path.dirname(__file__))
+from sentence_encoder import get_encoder
+import metrics
+import brain
+
+# AI对话的语义回复缓存
+# 群里反复问的问题（服务器IP、群规、活动时间……）用触发消息的句向量在本群的缓存中查找，
+# 相似度超过阈值且没有过期时直接用缓存的回复，不再调用大模型
+#
+# 相关设置（写在 .env 中，可选）
+# REPLY_CACHE_THRESHOLD: 相似度阈值，默认 0.92
+# REPLY_CACHE_TTL: 缓存有效期（秒），默认 86400
+# REPLY_CACHE_SIZE: 每个群最多缓存的问题数，超出时淘汰最久没用过的，默认 200
+# REPLY_CACHE_MIN_CHARS: 触发消息至少多少个字才缓存，太短的消息没有明确含义，默认 4
+
+def setting(name, default):
+    return type(default)(os.getenv(name, str(default)))
+
+
+class GroupReplyCache:
+    """一个群的缓存: 句向量矩阵 + 按最近使用排序的条目"""
+    def __init__(self):
+        # 问题 -> {"vector", "reply", "created"}，按最近使用的顺序排列
+        self.entries = OrderedDict()
+        self._matrix = None
+
+    def matrix(self):
+        """所有问题的句向量矩阵（条目变化后重新拼接）"""
+        if self._matrix is None:
+            self._matrix = np.array([entry["vector"] for entry in self.entries.values()], dtype='float32')
+        return self._matrix
+
+    def changed(self):
+        self._matrix = None
+
+
+class ReplyCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._groups = {}
+
+    def _expire(self, group, now, ttl):
+        expired = [text for text, entry in group.entries.items() if now - entry["created"] > ttl]
+        for text in expired:
+            del group.entries[text]
+        if expired:
+            group.changed()
+
+    def lookup(self, group_id, text, vector):
+        """查找相似的问题，命中时返回 (缓存的问题, 回复, 相似度)，否则返回 None"""
+        threshold = setting("REPLY_CACHE_THRESHOLD", 0.92)
+        ttl = setting("REPLY_CACHE_TTL", 86400)
+        with self._lock:
+            group = self._groups.get(group_id)
+            if group is None:
+                return None
+            self._expire(group, time.time(), ttl)
+            if not group.entries:
+                return None
+            # 句向量已归一化，点积即余弦相似度
+            similarities = group.matrix() @ vector
+            best = int(np.argmax(similarities))
+            if similarities[best] < threshold:
+                return None
+            question = list(group.entries)[best]
+            group.entries.move_to_end(question)
+            group.changed()
+            return question, group.entries[question]["reply"], float(similarities[best])
+
+    def store(self, group_id, text, vector, reply):
+        size = setting("REPLY_CACHE_SIZE", 200)
+        with self._lock:
+            group = self._groups.setdefault(group_id, GroupReplyCache())
+            group.entries[text] = {"vector": vector, "reply": reply, "created": time.time()}
+            group.entries.move_to_end(text)
+            while len(group.entries) > size:
+                group.entries.popitem(last=False)
+            group.changed()
+
+    def invalidate(self, group_id, keyword=""):
+        """删除本群问题或回复中包含 keyword 的缓存（keyword 为空时清空本群缓存），返回删除的条数"""
+        with self._lock:
+            group = self._groups.get(group_id)
+            if group is None:
+                return 0
+            removed = [text for text, entry in group.entries.items()
+                       if keyword in text or keyword in entry["reply"]]
+            for text in removed:
+                del group.entries[text]
+            group.changed()
+            return len(removed)
+
+    def size(self):
+        with self._lock:
+            return sum(len(group.entries) for group in self._groups.values())
+
+
+def get_cache():
+    """获取全局唯一的回复缓存，插件热重载后仍然保留"""
+    return brain.shared_resource("reply_cache", ReplyCache)
+
+
+def cacheable(text):
+    return len(text) >= setting("REPLY_CACHE_MIN_CHARS", 4)
+
+
+def encode(text):
+    return get_encoder().encode([text])[0]
+
+
+def lookup(group_id, text):
+    """
+    查找缓存的回复，返回 (回复, 触发消息的句向量)，未命中时回复为 None（阻塞，需要放进线程池调用）
+    未命中时句向量可以直接交给 store，不用再编码一次；消息太短不缓存时两者都是 None
+    """
+    if not cacheable(text):
+        return None, None
+    vector = encode(text)
+    hit = get_cache().lookup(group_id, text, vector)
+    metrics.inc("reply_cache_total", result="hit" if hit else "miss")
+    if hit is None:
+        return None, vector
+    question, reply, similarity = hit
+    print(f"回复缓存命中 ({similarity:.3f}): {text} -> {question}")
+    return reply, vector
+
+
+def store(group_id, text, reply, vector):
+    """缓存一次回复，vector 为 lookup 返回的句向量"""
+    if vector is None or not reply:
+        return
+    get_cache().store(group_id, text, vector, reply)
@@ -0,0 +1,196 @@
+import os
+import re
+import sys
+import json
+import time
+import queue
+import logging
+import logging.handlers
+
+# 添加当前插件目录到Python路径，确保可以导入同目录模块
+if os.path.dirname(__file__) not in sys.path:
+    sys.path.append(os.path.dirname(__file__))
+import metrics
+import shared
+
+# AI插件的"是否需要回复"本地预判
+# 先用几条规则和句向量相似度打分，有把握的情况直接决定，拿不准的才交给低成本模型判断
+# 每次判断都写入 bot_config/reply_gate_log.jsonl（只记录去掉 CQ 码的纯文本），以后可以用来重新训练本地模型
+# 写文件在后台线程中进行，文件超过大小上限时轮转（保留几个旧文件）
+#
+# 相关设置（写在 .env 中，可选）
+# REPLY_GATE_LOG_MAX_BYTES: 判断记录文件的大小上限，默认 10000000
+# REPLY_GATE_LOG_BACKUPS: 轮转后保留的旧文件数，默认 3
+
+LOG_FILE = os.path.join("bot_config", "reply_gate_log.jsonl")
+
+# 分数达到 REPLY_SCORE 直接回复，不超过 SKIP_SCORE 直接不回复，介于两者之间的交给大模型
+REPLY_SCORE = 2
+SKIP_SCORE = 0
+# 句向量与原型句的平均相似度超过这个值才计分
+SIMILARITY_THRESHOLD = 0.6
+
+CQ_PATTERN = re.compile(r'\[CQ:[^\]]*\]')
+AT_PATTERN = re.compile(r'\[CQ:at,qq=(\w+)[^\]]*\]')
+REPLY_PATTERN = re.compile(r'\[CQ:reply,id=(-?\d+)[^\]]*\]')
+QUESTION_PATTERN = re.compile(r'[?？]|吗|怎么|为什么|为啥|什么|如何|哪|谁|能不能|可以吗|是不是')
+
+# 句向量原型: 像是在向机器人提问/求助的消息，和普通闲聊
+PROTOTYPES = [
+    {"text": "有没有人知道这个怎么弄", "label": "reply"},
+    {"text": "请问一下这是什么意思", "label": "reply"},
+    {"text": "帮我查一下", "label": "reply"},
+    {"text": "机器人你怎么看", "label": "reply"},
+    {"text": "谁能解释一下这个问题", "label": "reply"},
+    {"text": "哈哈哈哈", "label": "skip"},
+    {"text": "好的", "label": "skip"},
+    {"text": "晚安", "label": "skip"},
+    {"text": "确实", "label": "skip"},
+    {"text": "草", "label": "skip"},
+]
+
+# 句向量模型不可用时只提示一次
+_similarity_warned = False
+
+
+def create_decision_logger():
+    """判断记录的 logger: 调用方只把记录放进队列，由 QueueListener 的后台线程写入按大小轮转的文件"""
+    os.makedirs(os.path.dirname(LOG_FILE), exist_ok=True)
+    handler = logging.handlers.RotatingFileHandler(
+        LOG_FILE, encoding="utf-8", delay=True,
+        maxBytes=int(os.getenv("REPLY_GATE_LOG_MAX_BYTES", "10000000")),
+        backupCount=int(os.getenv("REPLY_GATE_LOG_BACKUPS", "3")),
+    )
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    records = queue.SimpleQueue()
+    logging.handlers.QueueListener(records, handler).start()
+    logger = logging.getLogger("qqbot.reply_gate")
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    logger.addHandler(logging.handlers.QueueHandler(records))
+    return logger
+
+
+def get_decision_logger():
+    """获取全局唯一的判断记录 logger，插件热重载后不会重复添加 handler"""
+    return shared.shared_resource("reply_gate_logger", create_decision_logger)
+
+
+def bot_qq():
+    return os.getenv("BOT_QQ", "")
+
+
+def plain_text(raw_message):
+    """去掉 CQ 码后的纯文本"""
+    return CQ_PATTERN.sub("", raw_message).strip()
+
+
+def is_bot_message(message):
+    return bool(message.is_bot) or (bool(bot_qq()) and str(message.qq_number) == bot_qq())
+
+
+def is_reply_to_bot(raw_message, recent, find=None):
+    """
+    消息是否引用了机器人发的消息
+    recent 为最近的 chat_db.Message；find(消息ID) 在更早的消息中查找被引用的消息（找不到返回 None）
+    """
+    match = REPLY_PATTERN.search(raw_message)
+    if not match:
+        return False
+    replied = match.group(1)
+    for m in recent:
+        if m.message_id == replied:
+            return is_bot_message(m)
+    found = find(replied) if find is not None else None
+    return found is not None and is_bot_message(found)
+
+
+def addressed_to_bot(raw_message, recent, find=None):
+    """消息是否明确在和机器人说话，返回对应的特征名（at_bot / reply_to_bot），否则返回 None"""
+    if bot_qq() and bot_qq() in AT_PATTERN.findall(raw_message):
+        return "at_bot"
+    if is_reply_to_bot(raw_message, recent, find):
+        return "reply_to_bot"
+    return None
+
+
+def similarity_score(text):
+    """句向量特征: 像提问 +1，像闲聊 -1，模型不可用或拿不准时为 0"""
+    global _similarity_warned
+    try:
+        from onnx_classification import classify_text
+        label, confidence = classify_text(text, PROTOTYPES)
+    except Exception as e:
+        if not _similarity_warned:
+            _similarity_warned = True
+            print(f"回复预判句向量特征不可用，只使用规则判断: {e}")
+        return 0
+    if confidence < SIMILARITY_THRESHOLD:
+        return 0
+    return 1 if label == "reply" else -1
+
+
+def decide(raw_message, recent, find=None):
+    """
+    本地判断是否需要回复
+    :param raw_message: 原始消息
+    :param recent: 这个群最近的几条消息（chat_db.Message，包括这条）
+    :param find: find(消息ID) 查找被引用的更早的消息，见 is_reply_to_bot
+    :return: (True/False/None, 特征)，None 表示拿不准，需要交给大模型
+    """
+    features = {}
+    addressed = addressed_to_bot(raw_message, recent, find)
+    if addressed:
+        features[addressed] = True
+        return True, features
+
+    ats = AT_PATTERN.findall(raw_message)
+    text = plain_text(raw_message)
+    features["length"] = len(text)
+    # 纯图片/表情、只有一个字、命令（由其他插件处理）
+    if len(text) <= 1 or text.startswith("/"):
+        return False, features
+
+    score = 0
+    if ats:
+        # @了别人，多半不是在和机器人说话
+        features["at_other"] = True
+        score -= 1
+    if QUESTION_PATTERN.search(text):
+        features["question"] = True
+        score += 1
+    if any(m.is_bot for m in recent[-4:]):
+        # 机器人刚刚参与过对话
+        features["bot_recent"] = True
+        score += 1
+    features["similarity"] = similarity_score(text)
+    score += features["similarity"]
+    features["score"] = score
+
+    if score >= REPLY_SCORE:
+        return True, features
+    if score <= SKIP_SCORE:
+        return False, features
+    return None, features
+
+
+def log_decision(group_id, text, features, local, llm=None):
+    """
+    记录一次判断，local 为本地结果（None 为拿不准），llm 为大模型的结果（没有调用时为 None）
+    text 为去掉 CQ 码的纯文本，不包含被@的QQ号
+    """
+    source = "local" if local is not None else "llm"
+    decision = local if local is not None else llm
+    metrics.inc("reply_gate_total", source=source, decision="reply" if decision else "skip")
+    record = {
+        "time": time.time(),
+        "group_id": group_id,
+        "text": text,
+        "features": features,
+        "local": local,
+        "llm": llm,
+    }
+    try:
+        get_decision_logger().info(json.dumps(record, ensure_ascii=False))
+    except (OSError, TypeError, ValueError) as e:
+        print(f"写入回复预判记录失败: {e}")
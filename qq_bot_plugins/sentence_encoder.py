@@ -0,0 +1,145 @@
+import os
+import time
+import queue
+import threading
+from concurrent.futures import Future
+import numpy as np
+import onnxruntime
+from tokenizers import BertWordPieceTokenizer
+import metrics
+import brain
+
+# 共享的句向量编码服务
+# 聊天记录索引（add_index）和问答匹配（onnx_classification）共用同一个 ONNX 会话，
+# 各插件的编码请求由后台线程合并成一批推理
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+ONNX_DIR = os.path.join(SCRIPT_DIR, "onnx_models")
+ONNX_MODEL_PATH = os.path.join(ONNX_DIR, "model.onnx")
+TOKENIZER_VOCAB_PATH = os.path.join(ONNX_DIR, "vocab.txt")
+
+# 一次推理最多包含的句子数
+MAX_BATCH_SIZE = 64
+# 收到请求后最多再等多久，让其他插件的并发请求合并进同一批（秒）
+MAX_BATCH_WAIT = 0.005
+
+
+class ONNXSentenceEncoder:
+    """ONNX 句向量模型封装，按批推理，每批只补齐到批内最长的句子"""
+    def __init__(self, model_path, vocab_path, max_seq_len=128):
+        # 强制使用 CPU 提高兼容性
+        self.session = onnxruntime.InferenceSession(model_path, providers=['CPUExecutionProvider'])
+        self.tokenizer = BertWordPieceTokenizer(vocab=vocab_path, lowercase=True)
+        self.tokenizer.enable_truncation(max_length=max_seq_len)
+        self.max_seq_len = max_seq_len
+        self.input_names = [inp.name for inp in self.session.get_inputs()]
+
+    def _run_batch(self, encodings):
+        """对一批已分词的句子做一次推理，返回归一化后的句向量"""
+        seq_len = max(len(e.ids) for e in encodings)
+        input_ids = np.zeros((len(encodings), seq_len), dtype=np.int64)
+        attention_mask = np.zeros((len(encodings), seq_len), dtype=np.int64)
+        token_type_ids = np.zeros((len(encodings), seq_len), dtype=np.int64)
+        for i, e in enumerate(encodings):
+            input_ids[i, :len(e.ids)] = e.ids
+            attention_mask[i, :len(e.ids)] = e.attention_mask
+            token_type_ids[i, :len(e.ids)] = e.type_ids
+
+        # 只传模型需要的输入
+        inputs = {"input_ids": input_ids, "attention_mask": attention_mask, "token_type_ids": token_type_ids}
+        inputs = {name: value for name, value in inputs.items() if name in self.input_names}
+        with metrics.timer("embedding"):
+            last_hidden_state = self.session.run(None, inputs)[0]
+        metrics.inc("embedding_texts_total", len(encodings))
+
+        # 平均池化，忽略补齐的位置
+        mask_expanded = np.expand_dims(attention_mask, axis=-1).astype(np.float32)
+        sentence_embedding = np.sum(last_hidden_state * mask_expanded, axis=1) / np.clip(mask_expanded.sum(axis=1), 1e-9, None)
+        # 归一化
+        norm = np.linalg.norm(sentence_embedding, axis=1, keepdims=True)
+        return (sentence_embedding / norm).astype('float32')
+
+    def encode(self, texts):
+        """把文本（或文本列表）编码成句向量矩阵，每行对应一个文本"""
+        if isinstance(texts, str):
+            texts = [texts]
+        encodings = self.tokenizer.encode_batch(list(texts))
+        # 按长度排序后再分批，长短相近的句子放在一起，减少补齐的计算量
+        order = sorted(range(len(encodings)), key=lambda i: len(encodings[i].ids))
+        result = [None] * len(encodings)
+        for start in range(0, len(order), MAX_BATCH_SIZE):
+            chunk = order[start:start + MAX_BATCH_SIZE]
+            vectors = self._run_batch([encodings[i] for i in chunk])
+            for i, vector in zip(chunk, vectors):
+                result[i] = vector
+        return np.array(result, dtype='float32')
+
+
+class BatchingEncoder:
+    """
+    合并并发编码请求的编码服务
+    调用方在各自的线程中调用 encode()，后台线程把同一时间到达的请求合并成一次推理
+    """
+    def __init__(self, encoder, max_batch_size=MAX_BATCH_SIZE, max_wait=MAX_BATCH_WAIT):
+        self.encoder = encoder
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._requests = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="sentence-encoder", daemon=True)
+        self._thread.start()
+
+    def encode(self, texts):
+        """编码文本（或文本列表），阻塞到结果返回"""
+        if isinstance(texts, str):
+            texts = [texts]
+        future = Future()
+        self._requests.put((list(texts), future))
+        return future.result()
+
+    def _collect(self):
+        """取出一个请求，并在短时间内合并后续到达的请求"""
+        pending = [self._requests.get()]
+        count = len(pending[0][0])
+        deadline = time.monotonic() + self.max_wait
+        while count < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._requests.get(timeout=remaining)
+            except queue.Empty:
+                break
+            pending.append(item)
+            count += len(item[0])
+        return pending
+
+    def _run(self):
+        while True:
+            pending = self._collect()
+            texts = [text for request_texts, future in pending for text in request_texts]
+            try:
+                vectors = self.encoder.encode(texts) if texts else None
+            except Exception as e:
+                for request_texts, future in pending:
+                    future.set_exception(e)
+                continue
+            offset = 0
+            for request_texts, future in pending:
+                future.set_result(vectors[offset:offset + len(request_texts)] if request_texts else np.zeros((0, 0), dtype='float32'))
+                offset += len(request_texts)
+
+
+def load_encoder():
+    encoder = BatchingEncoder(ONNXSentenceEncoder(ONNX_MODEL_PATH, TOKENIZER_VOCAB_PATH))
+    print("句向量模型加载完成")
+    return encoder
+
+
+def get_encoder():
+    """获取全局唯一的编码服务，首次调用时加载模型，插件热重载后不会重新加载"""
+    return brain.shared_resource("sentence_encoder", load_encoder)
+
+
+def warm_up():
+    """启动后在后台加载模型"""
+    get_encoder()
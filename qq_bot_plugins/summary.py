@@ -1,14 +1,15 @@
 from ncatbot.core import GroupMessage
 import sys
 import os
-import re
 # 添加当前插件目录到Python路径，确保可以导入同目录模块
-sys.path.append(os.path.dirname(__file__))
-from text_classification import classification
-import yaml
+if os.path.dirname(__file__) not in sys.path:
+    sys.path.append(os.path.dirname(__file__))
+from record import recent_dialog, load_recent
+import pseudonym
+import llm_client
+import llm_gateway
+import context_builder
 from dotenv import load_dotenv
-import sqlite3
-import datetime
 
 # 获取插件目录的绝对路径，然后构建正确的配置文件路径
 plugin_dir = os.path.dirname(os.path.abspath(__file__))
@@ -17,11 +18,6 @@ project_root = os.path.dirname(plugin_dir)
 env_path = os.path.join(project_root, "bot_config", ".env")
 load_dotenv(env_path)
 
-config_path = os.path.join(project_root, "bot_config", "config.yaml")
-with open(config_path, 'r', encoding='utf-8') as f:
-    yaml_config = yaml.safe_load(f)
-
-SALT = os.getenv("SALT", "salt1245")
 # 插件信息
 PLUGIN_NAME = "总结插件"
 PLUGIN_VERSION = "1.0.0"
@@ -33,86 +29,11 @@ plugin_enabled = True
 # 插件优先级 (数值越小优先级越高，默认100)
 PRIORITY = 10
 
-HELP = """总结系统命令:
-/summary - 总结最近的150条消息"""
-
-def hash_qq(qq_number):
-    """Hash QQ number for anonymity"""
-    import hashlib
-    return hashlib.sha256((str(qq_number) + SALT).encode()).hexdigest()[:10]
-
-
-def replace_qq_with_hash(content):
-    """Replace [#QQ号#] pattern with [hash:xxx]"""
-    return re.sub(r'\[#(\d+)#\]', lambda m: f"[hash:{hash_qq(m.group(1))}]", content)
-
-
-def replace_hash_with_qq(content, group_id):
-    """Replace hash values back to QQ numbers"""
-    conn = sqlite3.connect('qq_chat.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT DISTINCT qq_number FROM members WHERE group_id = ?', (group_id,))
-    members = [row[0] for row in cursor.fetchall()]
-    conn.close()
-    
-    hash_map = {hash_qq(qq): str(qq) for qq in members}
-    
-    def replace_hash(match):
-        hash_value = match.group(1)
-        return hash_map.get(hash_value, match.group(0))
-    
-    return re.sub(r'([a-f0-9]{10})', replace_hash, content)
-
-
-def convert_messages_to_dialog(group_id):
-    """将群消息转换为对话格式"""
-    conn = sqlite3.connect('qq_chat.db')
-    cursor = conn.cursor()
-    
-    # 获取群的所有消息（按时间顺序）
-    cursor.execute('SELECT qq_number, content FROM messages WHERE group_id = ? ORDER BY rowid', (group_id,))
-    messages = cursor.fetchall()
-    conn.close()
-    
-    # Convert to dialog format
-    dialog = []
-    for qq, content in messages:
-        content = replace_qq_with_hash(content)
-        
-        if '[AI][QQ BOT]' in content:
-            role = "assistant"
-        else:
-            role = "user"
-        
-        dialog.append({
-            "role": role,
-            "content": content
-        })
-    
-    return dialog
-
-def handle_message(msg: GroupMessage):
-    """
-    处理群消息
-    返回值格式: (回复内容, 是否@发送者, 图片路径)
-    如果不需要回复，返回 None
-    """
-    if not plugin_enabled:
-        return None
-    
-    raw_msg = msg.raw_message.strip()
-
-    if "summary" not in raw_msg:
-        return None
+# 总结较长，流式发送时每段至少攒够这么多字再发
+SUMMARY_CHUNK_CHARS = 300
 
-    # 总结
-    try:
-        from openai import OpenAI
-        client = OpenAI(api_key=os.getenv("API_KEY"),base_url=os.getenv("API_URL"))
-    except:
-        return None
-    t_chat = convert_messages_to_dialog(msg.group_id)[-150:-1]
-    t_chat.append({"role": "user", "content": '''[Constraints]:
+# 总结提示词（每次请求完全相同，作为前缀可以被服务端缓存）
+SUMMARY_PROMPT = '''[Constraints]:
 
 - 当需要指代特定参与者时，只输出hash值本身（如"abc123"），严禁输出[hash:abc123]或hash:abc123格式
 - 保持客观中立，不添加个人观点或主观评价
@@ -157,22 +78,62 @@ def handle_message(msg: GroupMessage):
 
 【其他要点】 如有遗漏的重要信息或值得注意的事项
 
-确保内容详实、完整，充分反映群聊的讨论深度和价值。'''})
-    for i in range(2):
-        try:
-            response = client.chat.completions.create(
-                model=os.getenv("MODEL"),
-                messages=t_chat
-            )
-            
-            summary = response.choices[0].message.content
-            summary = replace_hash_with_qq(summary, msg.group_id)
-            print(summary)
-            return summary, False, None
-        except:
-            continue
-    
-    return None
+确保内容详实、完整，充分反映群聊的讨论深度和价值。'''
+
+HELP = """总结系统命令:
+/summary - 总结最近的150条消息"""
+
+async def reveal_chunks(chunks, members):
+    """逐段还原总结中本群成员的QQ号（按句切分，hash 不会被切断）"""
+    try:
+        async for part in chunks:
+            yield pseudonym.reveal(part, members)
+    finally:
+        await chunks.aclose()
+
+async def summarize(msg: GroupMessage):
+    """
+    处理 /summary 命令
+    返回值格式: (回复内容, 是否@发送者, 图片路径)，回复内容为按段产出的异步迭代器
+    如果不需要回复，返回 None
+    """
+    # 总结
+    # 这个群的最近消息还没加载过时在 io 线程池中从数据库加载
+    await load_recent(msg.group_id)
+    # 总结提示词作为固定前缀放在最前面，聊天记录按 token 预算从最新的往前放
+    t_chat = context_builder.build_messages(
+        [{"role": "system", "content": SUMMARY_PROMPT}],
+        recent_dialog(msg.group_id, 150, exclude_message_id=getattr(msg, "message_id", None)),
+        [{"role": "user", "content": "请按照要求总结以上群聊内容"}],
+        token_budget=context_builder.budget("SUMMARY_TOKEN_BUDGET", 24000),
+    )
+    # 还原QQ号用的反向映射还没加载时在 io 线程池中加载，不阻塞事件循环；只还原本群成员的QQ号
+    try:
+        members = await pseudonym.load(msg.group_id)
+    except Exception as e:
+        print(f"加载匿名映射失败: {e}")
+        return None
+    # 失败重试由 llm_gateway 处理（退避、限流、熔断），排队时让位于AI对话
+    try:
+        # 计时到收到第一段内容为止，之后边生成边发送
+        tool_calls, chunks = await llm_gateway.request(
+            "main", "summary", msg.group_id,
+            prepare=lambda stream: llm_client.start_stream(stream, SUMMARY_CHUNK_CHARS),
+            model=os.getenv("MODEL"),
+            messages=t_chat,
+            stream=True,
+        )
+    except llm_gateway.LLMUnavailable:
+        return "大模型服务繁忙，请稍后再试", True, None
+    except Exception as e:
+        print(f"群聊总结失败: {e}")
+        return None
+    return reveal_chunks(chunks, members), False, None
+
+# 插件命令表: 命令 -> 处理函数
+COMMANDS = {
+    "/summary": summarize,
+}
 
 # 插件初始化检查
 if __name__ == "__main__":
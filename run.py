@@ -6,7 +6,8 @@ import threading
 from ncatbot.core import BotClient, MessageArray, Text, At, Image, Face, Reply
 import os
 from dotenv import load_dotenv
-from brain import handle_group_message, init_plugins
+from brain import submit_group_message, init_plugins, warm_up_plugins
+from migrate_db import migrate, create_database_with_tables
 
 setup_config()
 print("开始连接qq机器人...")
@@ -50,56 +51,23 @@ def smart_database_init(db_file='qq_chat.db'):
     # 3. 如果需要创建表
     if need_create_tables:
         create_database_with_tables(db_file)
+    else:
+        # 4. 旧版本的数据库先升级表结构（已经是最新版本时直接跳过）
+        migrate(db_file)
     
-    return sqlite3.connect(db_file)
-
-def create_database_with_tables(db_file):
-    """创建数据库和所有表"""
     conn = sqlite3.connect(db_file)
-    cursor = conn.cursor()
-    
-    # 删除可能存在的旧表（避免冲突）
-    cursor.execute('DROP TABLE IF EXISTS messages')
-    cursor.execute('DROP TABLE IF EXISTS members')
-    cursor.execute('DROP TABLE IF EXISTS groups')
-    
-    # 重新创建表（最简化结构）
-    cursor.execute('''
-    CREATE TABLE groups (
-        group_id INTEGER PRIMARY KEY
-    )
-    ''')
-    
-    cursor.execute('''
-    CREATE TABLE members (
-        group_id INTEGER,
-        qq_number INTEGER,
-        PRIMARY KEY (group_id, qq_number),
-        FOREIGN KEY (group_id) REFERENCES groups(group_id)
-    )
-    ''')
-    
-    cursor.execute('''
-    CREATE TABLE messages (
-        group_id INTEGER,
-        qq_number INTEGER,
-        content TEXT,
-        FOREIGN KEY (group_id) REFERENCES groups(group_id)
-    )
-    ''')
-    
-    conn.commit()
-    conn.close()
-    print("✅ 数据库创建完成！")
-
+    # WAL 模式：记录插件的后台写线程和各插件的只读连接互不阻塞（设置会保存在数据库文件中）
+    conn.execute('PRAGMA journal_mode=WAL')
+    return conn
 
 # 初始化数据库
 conn = smart_database_init('qq_chat.db')
 print("✅ 数据库初始化完成")
 
 
-# 初始化插件
+# 初始化插件，模型等重资源在后台预热，不阻塞连接
 init_plugins()
+warm_up_plugins()
 print("插件初始化完成")
 
 from ncatbot.core import BotClient
@@ -111,13 +79,7 @@ bot = BotClient()
 async def on_group_message(msg:GroupMessage):
     if msg.group_id == 1:
         return
-    try:
-        result, is_at, image= handle_group_message(msg)
-    except:
-        return
-    if is_at:
-        await msg.reply(text=result, at=True, image=image)
-    else:
-        await msg.reply(text=result, image=image)
+    # 放进群消息队列后立即返回，由 brain 的调度器处理并发送回复
+    submit_group_message(msg)
 
 bot.run()
\ No newline at end of file
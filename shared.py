@@ -0,0 +1,26 @@
+import threading
+
+# 跨热重载保留的共享资源（模型、向量索引、客户端等）
+# 这个模块不在插件目录中，不会被热重载，插件重新加载后拿到的仍然是同一个对象
+# 不依赖机器人的运行环境，单独导入插件模块（例如测试中）时也能使用
+
+# 名字 -> 对象
+_shared_resources = {}
+_shared_locks = {}
+_shared_lock = threading.Lock()
+
+
+def shared_resource(name, factory):
+    """
+    获取共享资源，第一次调用时用 factory() 创建
+    同一个名字只创建一次，插件热重载后不会重新加载模型或索引
+    """
+    resource = _shared_resources.get(name)
+    if resource is not None:
+        return resource
+    with _shared_lock:
+        lock = _shared_locks.setdefault(name, threading.Lock())
+    with lock:
+        if name not in _shared_resources:
+            _shared_resources[name] = factory()
+    return _shared_resources[name]
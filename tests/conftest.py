@@ -0,0 +1,8 @@
+import os
+import sys
+
+# 测试直接导入项目根目录和插件目录下的模块（和插件之间互相导入的方式相同）
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in (ROOT, os.path.join(ROOT, "qq_bot_plugins")):
+    if path not in sys.path:
+        sys.path.insert(0, path)
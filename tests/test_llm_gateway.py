@@ -0,0 +1,94 @@
+import time
+import asyncio
+
+import pytest
+
+import llm_gateway
+
+
+@pytest.fixture
+def limits(monkeypatch):
+    """全局每分钟只能发 1 个请求，每个群 2 个，排队 0.3 秒超时"""
+    monkeypatch.setenv("LLM_RPM", "1")
+    monkeypatch.setenv("LLM_GROUP_RPM", "2")
+    monkeypatch.setenv("LLM_QUEUE_TIMEOUT", "0.3")
+    monkeypatch.setenv("LLM_BREAKER_THRESHOLD", "2")
+    monkeypatch.setenv("LLM_BREAKER_COOLDOWN", "0.1")
+
+
+def test_group_tokens_refunded_on_queue_timeout(limits):
+    gateway = llm_gateway.Gateway()
+
+    async def run():
+        await gateway.acquire("chat", 1, 10)
+        # 全局的桶已经空了，本群还有令牌: 排队超时后本群的令牌要还回去
+        for _ in range(3):
+            with pytest.raises(llm_gateway.LLMUnavailable):
+                await gateway.acquire("chat", 1, 10)
+
+    asyncio.run(run())
+    group_requests, group_tokens = gateway.group_buckets(1)
+    assert group_requests.tokens == pytest.approx(1, abs=0.1)
+    assert group_tokens.tokens == pytest.approx(group_tokens.capacity - 10, abs=50)
+    assert gateway.waiters == []
+
+
+def test_group_tokens_refunded_when_breaker_rejects(limits):
+    gateway = llm_gateway.Gateway()
+    # 半开状态，已经有一个试探请求在进行: 新请求通过本群的桶后在全局阶段被熔断拒绝
+    gateway.breaker.opened_at = time.monotonic() - 1
+    gateway.breaker.probing = True
+
+    with pytest.raises(llm_gateway.LLMUnavailable):
+        asyncio.run(gateway.acquire("chat", 1, 10))
+    group_requests, group_tokens = gateway.group_buckets(1)
+    assert group_requests.tokens == pytest.approx(2, abs=0.1)
+    assert gateway.requests.tokens == pytest.approx(1, abs=0.1)
+
+
+def test_open_breaker_fails_fast_without_taking_tokens(limits):
+    gateway = llm_gateway.Gateway()
+    gateway.breaker.record_failure(time.monotonic())
+    gateway.breaker.record_failure(time.monotonic())
+
+    start = time.monotonic()
+    with pytest.raises(llm_gateway.LLMUnavailable):
+        asyncio.run(gateway.acquire("chat", 1, 10))
+    assert time.monotonic() - start < 0.1
+    assert gateway.group_buckets(1)[0].tokens == pytest.approx(2, abs=0.1)
+
+
+def test_breaker_transitions(limits):
+    breaker = llm_gateway.CircuitBreaker()
+    now = time.monotonic()
+    assert breaker.state(now) == "closed"
+
+    # 连续失败达到阈值后熔断
+    breaker.record_failure(now)
+    assert breaker.state(now) == "closed"
+    breaker.record_failure(now)
+    assert breaker.state(now) == "open"
+    assert not breaker.allow(now)
+
+    # 冷却后半开，只放行一个试探请求；试探失败重新熔断
+    later = now + 0.2
+    assert breaker.state(later) == "half_open"
+    assert breaker.allow(later)
+    assert not breaker.allow(later)
+    breaker.record_failure(later)
+    assert breaker.state(later) == "open"
+
+    # 再次冷却后试探成功，恢复正常
+    latest = later + 0.2
+    assert breaker.allow(latest)
+    breaker.record_success()
+    assert breaker.state(latest) == "closed"
+    assert breaker.allow(latest) and breaker.allow(latest)
+
+
+def test_token_bucket_refund_is_capped():
+    bucket = llm_gateway.TokenBucket(10)
+    bucket.take(3)
+    bucket.refund(3)
+    bucket.refund(3)
+    assert bucket.tokens == pytest.approx(10)
@@ -0,0 +1,83 @@
+import sqlite3
+import datetime
+
+import migrate_db
+
+
+def create_v1_database(db_file, rows):
+    """创建升级前（v1）结构的数据库: messages(group_id, qq_number, content)，没有版本表和索引"""
+    conn = sqlite3.connect(db_file)
+    with conn:
+        conn.execute('CREATE TABLE groups (group_id INTEGER PRIMARY KEY)')
+        conn.execute('CREATE TABLE members (group_id INTEGER, qq_number INTEGER, PRIMARY KEY (group_id, qq_number))')
+        conn.execute('CREATE TABLE messages (group_id INTEGER, qq_number INTEGER, content TEXT)')
+        conn.execute('INSERT INTO groups (group_id) VALUES (100)')
+        conn.executemany('INSERT INTO messages (group_id, qq_number, content) VALUES (?, ?, ?)', rows)
+    conn.close()
+
+
+def timestamp(time_str):
+    return datetime.datetime.strptime(time_str, '%Y-%m-%d %H:%M:%S').timestamp()
+
+
+V1_ROWS = [
+    (100, 111, "[#111#][小明][2024-05-01 10:00:00]大家好"),
+    (100, 222, "[#222#][小红][2024-05-01 10:00:05]多行\n消息"),
+    (100, 999, "[AI][QQ BOT]你们好"),
+    (100, 333, "没有前缀的旧消息"),
+    (100, 111, "[#111#][小明][2024-05-01 10:01:00]再见"),
+]
+
+
+def test_migrate_v1_database(tmp_path):
+    db_file = str(tmp_path / "qq_chat.db")
+    create_v1_database(db_file, V1_ROWS)
+
+    # 每批 2 行，覆盖分批复制和最后补齐剩余行
+    assert migrate_db.migrate(db_file, batch_size=2) is True
+
+    conn = sqlite3.connect(db_file)
+    assert migrate_db.get_schema_version(conn) == migrate_db.SCHEMA_VERSION
+    rows = conn.execute('SELECT id, group_id, qq_number, nickname, ts, is_bot, content FROM messages ORDER BY id').fetchall()
+    assert rows == [
+        (1, 100, 111, "小明", timestamp("2024-05-01 10:00:00"), 0, "大家好"),
+        (2, 100, 222, "小红", timestamp("2024-05-01 10:00:05"), 0, "多行\n消息"),
+        # 机器人回复和无法解析的行沿用上一条消息的时间
+        (3, 100, 999, None, timestamp("2024-05-01 10:00:05"), 1, "你们好"),
+        (4, 100, 333, None, timestamp("2024-05-01 10:00:05"), 0, "没有前缀的旧消息"),
+        (5, 100, 111, "小明", timestamp("2024-05-01 10:01:00"), 0, "再见"),
+    ]
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+    assert "messages_v2" not in tables
+    assert "pseudonyms" in tables
+    indexes = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='index'")}
+    assert "idx_messages_group_ts" in indexes
+    conn.close()
+
+    # 已经是最新版本时什么都不做
+    assert migrate_db.migrate(db_file) is False
+
+
+def test_migrate_resumes_after_interruption(tmp_path):
+    db_file = str(tmp_path / "qq_chat.db")
+    create_v1_database(db_file, V1_ROWS)
+
+    # 模拟上次升级只复制了前两行就中断
+    conn = sqlite3.connect(db_file)
+    with conn:
+        migrate_db.create_messages_table(conn.cursor(), "messages_v2")
+        migrate_db._copy_rows(conn, 0, 0, limit=2)
+    conn.close()
+
+    assert migrate_db.migrate(db_file, batch_size=2) is True
+
+    conn = sqlite3.connect(db_file)
+    contents = [row[0] for row in conn.execute('SELECT content FROM messages ORDER BY id')]
+    assert contents == ["大家好", "多行\n消息", "你们好", "没有前缀的旧消息", "再见"]
+    conn.close()
+
+
+def test_new_database_is_current_version(tmp_path):
+    db_file = str(tmp_path / "qq_chat.db")
+    migrate_db.create_database_with_tables(db_file)
+    assert migrate_db.migrate(db_file) is False
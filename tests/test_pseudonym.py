@@ -0,0 +1,26 @@
+import threading
+
+import pytest
+
+# pseudonym 通过 brain 在 io 线程池中加载，brain 依赖机器人的运行环境
+pytest.importorskip("ncatbot")
+pytest.importorskip("dotenv")
+import chat_db
+import pseudonym
+import shared
+
+
+@pytest.fixture(autouse=True)
+def two_groups(monkeypatch):
+    reverse = {pseudonym.hash_qq(qq): str(qq) for qq in (111, 222)}
+    membership = chat_db.MembershipCache()
+    membership.add_members([(1, 111), (2, 222)])
+    monkeypatch.setitem(shared._shared_resources, "pseudonym_reverse_map", {"map": reverse, "lock": threading.Lock()})
+    monkeypatch.setitem(shared._shared_resources, "membership_cache", membership)
+
+
+def test_reveal_only_restores_members_of_the_group():
+    members = pseudonym.revealable_members(1)
+    text = f"{pseudonym.hash_qq(111)} 回复了 {pseudonym.hash_qq(222)}"
+    assert members == {"111"}
+    assert pseudonym.reveal(text, members) == f"111 回复了 {pseudonym.hash_qq(222)}"
@@ -0,0 +1,76 @@
+import asyncio
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+# record 通过 brain 取还没写入数据库的消息，brain 依赖机器人的运行环境
+pytest.importorskip("ncatbot")
+pytest.importorskip("dotenv")
+import brain
+import chat_db
+import record
+import shared
+
+
+@pytest.fixture(autouse=True)
+def fresh_history():
+    shared._shared_resources.pop("recent_history", None)
+    yield
+    shared._shared_resources.pop("recent_history", None)
+
+
+def stored(message_id, content, ts):
+    return chat_db.Message(message_id=message_id, qq_number=123, nickname="群员", ts=ts, is_bot=0, content=content)
+
+
+def pending(message_id, content, ts):
+    return SimpleNamespace(group_id=1, user_id=123, sender=SimpleNamespace(nickname="群员"),
+                           raw_message=content, message_id=message_id, time=ts)
+
+
+def test_recent_entries_dedup_pending_already_stored(monkeypatch):
+    monkeypatch.setattr(chat_db, "recent_messages", lambda group_id, limit: [stored("1", "早上好", 1.0), stored("2", "吃了吗", 2.0)])
+    # 消息 2 在两次读取之间写入了数据库，pending 和数据库中各有一份
+    monkeypatch.setattr(brain, "pending_messages", lambda group_id: [pending("2", "吃了吗", 2.0), pending("3", "还没", 3.0)])
+
+    messages = record.recent_messages(1, 10)
+    assert [m.message_id for m in messages] == ["1", "2", "3"]
+    assert [m.message_id for m in record.recent_messages(1, 2)] == ["2", "3"]
+
+
+def test_cold_load_runs_off_loop_and_keeps_messages_committed_during_load(monkeypatch):
+    threads = []
+
+    def slow_query(group_id, limit):
+        threads.append(threading.current_thread())
+        # 查询期间又提交了两条: 一条已经被查询读到，一条没有
+        record.remember(group_id, [stored("2", "吃了吗", 2.0), stored("3", "还没", 3.0)])
+        return [stored("1", "早上好", 1.0), stored("2", "吃了吗", 2.0)]
+
+    async def run_blocking(kind, func, *args):
+        return await asyncio.to_thread(func, *args)
+
+    monkeypatch.setattr(chat_db, "recent_messages", slow_query)
+    monkeypatch.setattr(brain, "run_blocking", run_blocking)
+    monkeypatch.setattr(brain, "pending_messages", lambda group_id: [])
+
+    asyncio.run(record.load_recent(1))
+    assert threads and threads[0] is not threading.main_thread()
+    assert [m.message_id for m in record.recent_messages(1, 10)] == ["1", "2", "3"]
+    assert record.find_message(1, 3).content == "还没"
+
+    # 已经加载过的群不再查询数据库
+    asyncio.run(record.load_recent(1))
+    record.remember(1, [stored("4", "那一起吧", 4.0)])
+    assert [m.message_id for m in record.recent_messages(1, 2)] == ["3", "4"]
+    assert len(threads) == 1
+
+
+def test_recent_dialog_excludes_trigger_by_id(monkeypatch):
+    monkeypatch.setattr(chat_db, "recent_messages", lambda group_id, limit: [stored("1", "早上好", 1.0), stored("2", "吃了吗", 2.0)])
+    # 触发命令的消息还没写入数据库，后面又来了一条
+    monkeypatch.setattr(brain, "pending_messages", lambda group_id: [pending("3", "/summary", 3.0), pending("4", "还没", 4.0)])
+
+    dialog = record.recent_dialog(1, 3, exclude_message_id=3)
+    assert [turn["content"].rsplit("]", 1)[1] for turn in dialog] == ["早上好", "吃了吗", "还没"]
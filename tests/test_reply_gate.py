@@ -0,0 +1,49 @@
+import pytest
+
+import chat_db
+import reply_gate
+
+BOT_QQ = "10000"
+
+
+@pytest.fixture(autouse=True)
+def bot_qq(monkeypatch):
+    monkeypatch.setenv("BOT_QQ", BOT_QQ)
+
+
+def member_message(message_id, qq_number=123, content="你好"):
+    return chat_db.Message(message_id=message_id, qq_number=qq_number, nickname="群员", ts=1.0, is_bot=0, content=content)
+
+
+def bot_message(message_id, content="我是机器人"):
+    return chat_db.Message(message_id=message_id, qq_number=int(BOT_QQ), nickname=None, ts=1.0, is_bot=1, content=content)
+
+
+def test_reply_to_bot_message_outside_recent_window():
+    # 被引用的机器人消息不在最近几条中，通过 find 在更早的消息里找到
+    earlier = {"555": bot_message("555")}
+    recent = [member_message(str(i)) for i in range(5)]
+    raw = "[CQ:reply,id=555]这是什么意思"
+
+    assert reply_gate.is_reply_to_bot(raw, recent) is False
+    assert reply_gate.addressed_to_bot(raw, recent, earlier.get) == "reply_to_bot"
+    decision, features = reply_gate.decide(raw, recent, earlier.get)
+    assert decision is True
+    assert features["reply_to_bot"] is True
+
+
+def test_reply_to_bot_message_in_recent_window():
+    recent = [member_message("1"), bot_message("2"), member_message("3")]
+    assert reply_gate.addressed_to_bot("[CQ:reply,id=2]谢谢", recent) == "reply_to_bot"
+
+
+def test_bot_qq_identifies_bot_message():
+    # 只记下了QQ号的机器人消息（is_bot 为 0）也算
+    recent = [member_message("7", qq_number=int(BOT_QQ))]
+    assert reply_gate.is_reply_to_bot("[CQ:reply,id=7]好的", recent)
+
+
+def test_reply_to_member_message_is_not_addressed():
+    earlier = {"8": member_message("8")}
+    assert reply_gate.addressed_to_bot("[CQ:reply,id=8]同意", [member_message("9")], earlier.get) is None
+    assert reply_gate.addressed_to_bot("[CQ:reply,id=404]同意", [], earlier.get) is None